@@ -1,3 +1,5 @@
+import argparse
+
 import ldm_patched.modules.args_parser as args_parser
 
 args_parser.parser.add_argument("--share", action='store_true', help="Set whether to share on Gradio.")
@@ -40,6 +42,69 @@ args_parser.parser.add_argument("--always-download-new-model", action='store_tru
 args_parser.parser.add_argument("--rebuild-hash-cache", help="Generates missing model and LoRA hashes.",
                                 type=int, nargs="?", metavar="CPU_NUM_THREADS", const=-1)
 
+args_parser.parser.add_argument("--enable-batched-sampling", action='store_true',
+                                help="Sample all images of a task in batches instead of one by one when possible.")
+
+args_parser.parser.add_argument("--max-sampling-batch-size", type=int, default=8, metavar="BATCH_SIZE",
+                                help="Upper bound for the batch size of batched sampling, "
+                                     "the actual size is further limited by free VRAM.")
+
+args_parser.parser.add_argument("--task-queue-path", type=str, default=None, metavar="PATH",
+                                help="Persist queued tasks to this folder so they are processed after a restart.")
+
+args_parser.parser.add_argument("--enable-model-affinity", action='store_true',
+                                help="Process queued tasks using the currently loaded models first to reduce model swaps.")
+
+args_parser.parser.add_argument("--model-affinity-max-wait", type=float, default=60.0, metavar="SECONDS",
+                                help="Queued tasks waiting longer than this are processed next regardless of model affinity.")
+
+args_parser.parser.add_argument("--model-cache-size", type=float, default=0, metavar="GB",
+                                help="Keep recently used checkpoints in RAM up to this size in GB, 0 disables the cache.")
+
+args_parser.parser.add_argument("--lora-cache-size", type=float, default=0, metavar="GB",
+                                help="Keep model weights with merged LoRAs in RAM up to this size in GB, "
+                                     "0 disables the cache.")
+
+args_parser.parser.add_argument("--lora-cache-path", type=str, default=None, metavar="PATH",
+                                help="Write merged LoRA weights evicted from RAM to this folder and reuse them later.")
+
+args_parser.parser.add_argument("--checkpoint-cache-path", type=str, default=None, metavar="PATH",
+                                help="Store checkpoints split into UNet, CLIP and VAE weights converted to the runtime "
+                                     "dtypes in this folder and load them from there. Needs disk space for each "
+                                     "checkpoint and dtype setting used.")
+
+args_parser.parser.add_argument("--clip-cache-size", type=int, default=256, metavar="NUM_PROMPTS",
+                                help="Number of encoded prompts kept in RAM across tasks and model refreshes.")
+
+args_parser.parser.add_argument("--clip-cache-path", type=str, default=None, metavar="PATH",
+                                help="Also store encoded prompts in this folder so they survive restarts.")
+
+args_parser.parser.add_argument("--expansion-cache-size", type=int, default=1024, metavar="NUM_PROMPTS",
+                                help="Number of Fooocus V2 prompt expansions kept in RAM, keyed by prompt and seed.")
+
+args_parser.parser.add_argument("--image-writer-threads", type=int, default=2, metavar="NUM_THREADS",
+                                help="Number of threads encoding and saving generated images in the background.")
+
+args_parser.parser.add_argument("--max-pending-images", type=int, default=8, metavar="NUM_IMAGES",
+                                help="Maximum number of generated images waiting to be saved before generation pauses.")
+
+args_parser.parser.add_argument("--worker-pool-devices", type=str, default=None, nargs='+', metavar="DEVICE",
+                                help="Run tasks in one worker process per device, a device is a GPU id or cpu.")
+
+args_parser.parser.add_argument("--worker-cpu-threads", type=int, default=None, metavar="CPU_NUM_THREADS",
+                                help="Number of CPU threads used by each worker process.")
+
+args_parser.parser.add_argument("--enable-api", action='store_true',
+                                help="Serve the JSON generation API under /api/v1 next to the Gradio UI.")
+
+args_parser.parser.add_argument("--batch-file", type=str, default=None, metavar="PATH",
+                                help="Run the generation jobs of this JSONL file without the UI, see batch.py.")
+
+args_parser.parser.add_argument("--batch-manifest", type=str, default=None, metavar="PATH",
+                                help="Manifest of finished batch jobs, defaults to the batch file with .manifest.jsonl.")
+
+args_parser.parser.add_argument("--worker-pool-connect", type=str, default=None, help=argparse.SUPPRESS)
+
 args_parser.parser.set_defaults(
     disable_cuda_malloc=True,
     in_browser=True,
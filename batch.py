@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import traceback
+
+
+def read_jobs(filename):
+    jobs = []
+    with open(filename, 'rt', encoding='utf-8') as fp:
+        for line_number, line in enumerate(fp, start=1):
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f'[Batch] Skipping invalid line {line_number}: {e}')
+                continue
+            job_id = str(job.pop('id', f'line-{line_number}'))
+            jobs.append((job_id, job))
+    return jobs
+
+
+def read_finished_jobs(manifest_filename):
+    finished = set()
+    if not os.path.exists(manifest_filename):
+        return finished
+
+    with open(manifest_filename, 'rt', encoding='utf-8') as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # last line of a crashed run
+                continue
+            if entry.get('status') == 'finished':
+                finished.add(entry['id'])
+    return finished
+
+
+def get_job_status(task, images):
+    # stopped or crashed tasks return fewer images than requested, they are run again on resume
+    if len(images) == 0:
+        return 'failed'
+    if len(images) < task.image_number:
+        return 'partial'
+    return 'finished'
+
+
+def get_model_key(request):
+    return (request.base_model_name, request.refiner_model_name, request.vae_name,
+            str([(lora.model_name, lora.weight) for lora in request.loras if lora.enabled]),
+            request.performance_selection)
+
+
+def order_jobs(requests):
+    # stable sort keeps the file order of jobs using the same models, groups are ordered by first appearance
+    first_index = {}
+    for index, (job_id, request) in enumerate(requests):
+        first_index.setdefault(get_model_key(request), index)
+    return sorted(requests, key=lambda item: first_index[get_model_key(item[1])])
+
+
+def run_batch(filename, manifest_filename=None):
+    from modules.api import GenerationRequest, get_task_args
+    from modules.private_logger import wait_for_images
+    import modules.async_worker as worker
+
+    manifest_filename = manifest_filename or os.path.splitext(filename)[0] + '.manifest.jsonl'
+    finished = read_finished_jobs(manifest_filename)
+
+    requests = []
+    skipped = 0
+    with open(manifest_filename, 'at', encoding='utf-8') as manifest:
+        def write_manifest(entry):
+            manifest.write(json.dumps(entry) + '\n')
+            manifest.flush()
+
+        for job_id, job in read_jobs(filename):
+            if job_id in finished:
+                skipped += 1
+                continue
+            try:
+                requests.append((job_id, GenerationRequest(**job)))
+            except Exception as e:
+                print(f'[Batch] Invalid job {job_id}: {e}')
+                write_manifest({'id': job_id, 'status': 'failed', 'error': str(e)})
+
+        requests = order_jobs(requests)
+        print(f'[Batch] {len(requests)} jobs to run, {skipped} already finished, manifest: {manifest_filename}')
+
+        def submit(job_id, request):
+            task = worker.AsyncTask(args=get_task_args(request))
+            # nobody is watching the previews
+            task.disable_preview = True
+            task.priority = request.priority
+            worker.async_tasks.put(task)
+            return job_id, task
+
+        start_time = time.perf_counter()
+        last_finish_time = start_time
+        image_count = 0
+        step_count = 0
+        done = 0
+        jobs = iter(requests)
+        pending = []
+
+        def fill_pending():
+            # keep the next job queued so the worker does not wait while results are written
+            while len(pending) < 2:
+                item = next(jobs, None)
+                if item is None:
+                    return
+                try:
+                    pending.append(submit(*item))
+                except Exception as e:
+                    traceback.print_exc()
+                    write_manifest({'id': item[0], 'status': 'failed', 'error': str(e)})
+
+        fill_pending()
+        while len(pending) > 0:
+            job_id, task = pending.pop(0)
+            while True:
+                if not task.yields.wait(timeout=1.0):
+                    continue
+                flag, product = task.yields.pop(0)
+                if flag == 'finish':
+                    break
+            fill_pending()
+
+            wait_for_images(task.results)
+            images = [result for result in task.results if isinstance(result, str)]
+            image_count += len(images)
+            step_count += task.steps * len(images)
+            done += 1
+
+            now = time.perf_counter()
+            write_manifest({
+                'id': job_id,
+                'status': get_job_status(task, images),
+                'images': images,
+                'seed': task.seed,
+                'base_model_name': task.base_model_name,
+                'elapsed': round(now - last_finish_time, 3)
+            })
+            last_finish_time = now
+
+            elapsed = now - start_time
+            # wall time of the whole run, including model loading, decoding and saving, per sampling step
+            print(f'[Batch] {done}/{len(requests)} jobs, {image_count} images, '
+                  f'{image_count / elapsed * 60:.2f} images/min, {elapsed / max(step_count, 1):.3f} s/step overall')
+
+    print(f'[Batch] Finished {image_count} images in {time.perf_counter() - start_time:.2f} seconds.')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1].startswith('-'):
+        print('Usage: python batch.py JOBS.jsonl [--batch-manifest PATH] [launch arguments]')
+        sys.exit(1)
+
+    sys.argv = [sys.argv[0], '--batch-file'] + sys.argv[1:]
+    import launch
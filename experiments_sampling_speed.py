@@ -0,0 +1,51 @@
+import os
+import time
+import torch
+
+import modules.patch
+import modules.sample_hijack
+import modules.default_pipeline as pipeline
+import ldm_patched.ldm.modules.diffusionmodules.openaimodel as openaimodel
+
+from modules.patch import PatchSettings, patch_settings, patch_all
+
+patch_all()
+patch_settings[os.getpid()] = PatchSettings()
+
+steps = 30
+positive_cond = pipeline.clip_encode(['a handsome man'])
+negative_cond = pipeline.clip_encode([''])
+
+
+def baseline_unet_forward(self, x, timesteps=None, *args, **kwargs):
+    # progress read back from the device in every UNet call as done before the host-side schedule
+    patch_settings[os.getpid()].global_diffusion_progress = float((1.0 - timesteps.to(x) / 999.0).detach().cpu().numpy().tolist()[0])
+    return modules.patch.patched_unet_forward(self, x, timesteps, *args, **kwargs)
+
+
+def baseline_diffusion_progress(model, sigma):
+    # the baseline used the progress left by the previous UNet call
+    return patch_settings[os.getpid()].global_diffusion_progress
+
+
+def benchmark(name):
+    for _ in range(2):
+        start = time.perf_counter()
+        pipeline.process_diffusion(positive_cond=positive_cond, negative_cond=negative_cond, steps=steps, switch=steps,
+                                   width=1024, height=1024, image_seed=12345, callback=None,
+                                   sampler_name='dpmpp_2m_sde_gpu', scheduler_name='karras', cfg_scale=7.0)
+        elapsed = time.perf_counter() - start
+    print(f'{name}: {steps / elapsed:.2f} steps/s')
+
+
+benchmark('Host-side progress schedule')
+
+get_evaluation_sigmas = modules.sample_hijack.get_evaluation_sigmas
+get_diffusion_progress = modules.patch.get_diffusion_progress
+modules.sample_hijack.get_evaluation_sigmas = lambda *args: None
+modules.patch.get_diffusion_progress = baseline_diffusion_progress
+openaimodel.UNetModel.forward = baseline_unet_forward
+benchmark('Progress read back from device')
+openaimodel.UNetModel.forward = modules.patch.patched_unet_forward
+modules.patch.get_diffusion_progress = get_diffusion_progress
+modules.sample_hijack.get_evaluation_sigmas = get_evaluation_sigmas
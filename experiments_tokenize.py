@@ -0,0 +1,41 @@
+import time
+
+import ldm_patched.modules.sd1_clip as sd1_clip
+from ldm_patched.modules.sdxl_clip import SDXLTokenizer
+from modules.sdxl_styles import styles
+
+tokenizer = SDXLTokenizer()
+texts = []
+for positive, negative in styles.values():
+    texts += [positive.replace('{prompt}', 'a handsome man'), negative]
+
+
+def tokenize_words_per_word(self, words):
+    # one tokenizer call per word as done before the batched word tokenization
+    return [self.tokenizer(word)["input_ids"][self.tokens_start:-1] for word in words]
+
+
+def clear_caches():
+    for t in [tokenizer.clip_l, tokenizer.clip_g]:
+        t.text_cache.clear()
+        t.word_cache = {}
+
+
+def benchmark(name, cached=False):
+    for _ in range(2):
+        start = time.perf_counter()
+        for text in texts:
+            if not cached:
+                clear_caches()
+            tokenizer.tokenize_with_weights(text)
+        elapsed = time.perf_counter() - start
+    print(f'{name}: {elapsed / len(texts) * 1000:.3f} ms per prompt ({len(texts)} prompts)')
+
+
+tokenize_words = sd1_clip.SDTokenizer.tokenize_words
+sd1_clip.SDTokenizer.tokenize_words = tokenize_words_per_word
+benchmark('Tokenizer call per word')
+sd1_clip.SDTokenizer.tokenize_words = tokenize_words
+
+benchmark('Batched tokenizer call')
+benchmark('Cached tokens', cached=True)
@@ -1,13 +1,17 @@
 import os
+import json
+import hashlib
 
 import numpy as np
 import torch
-from transformers import CLIPConfig, CLIPImageProcessor
+import torch.nn.functional as F
+from transformers import CLIPConfig
 
 import ldm_patched.modules.model_management as model_management
 import modules.config
 from extras.safety_checker.models.safety_checker import StableDiffusionSafetyChecker
 from ldm_patched.modules.model_patcher import ModelPatcher
+from modules.lru_cache import LRUCache
 
 safety_checker_repo_root = os.path.join(os.path.dirname(__file__), 'safety_checker')
 config_path = os.path.join(safety_checker_repo_root, "configs", "config.json")
@@ -15,16 +19,31 @@ preprocessor_config_path = os.path.join(safety_checker_repo_root, "configs", "pr
 
 
 class Censor:
+    """
+    Replaces NSFW images with black images.
+
+    Images are preprocessed on the device of the safety checker and checked in batches. Verdicts are cached by
+    image content, so images checked before, including the black images returned, are not checked again.
+    """
+
+    max_batch_size = 8
+
     def __init__(self):
         self.safety_checker_model: ModelPatcher | None = None
-        self.clip_image_processor: CLIPImageProcessor | None = None
         self.load_device = torch.device('cpu')
         self.offload_device = torch.device('cpu')
+        self.verdicts = LRUCache(max_size=1024)
+
+        with open(preprocessor_config_path, 'rt', encoding='utf-8') as fp:
+            preprocessor_config = json.load(fp)
+        self.size = preprocessor_config['size']
+        self.crop_size = preprocessor_config['crop_size']
+        self.image_mean = torch.tensor(preprocessor_config['image_mean']).view(1, 3, 1, 1)
+        self.image_std = torch.tensor(preprocessor_config['image_std']).view(1, 3, 1, 1)
 
     def init(self):
-        if self.safety_checker_model is None and self.clip_image_processor is None:
+        if self.safety_checker_model is None:
             safety_checker_model = modules.config.downloading_safety_checker_model()
-            self.clip_image_processor = CLIPImageProcessor.from_json_file(preprocessor_config_path)
             clip_config = CLIPConfig.from_json_file(config_path)
             model = StableDiffusionSafetyChecker.from_pretrained(safety_checker_model, config=clip_config)
             model.eval()
@@ -36,25 +55,73 @@ class Censor:
 
             self.safety_checker_model = ModelPatcher(model, load_device=self.load_device, offload_device=self.offload_device)
 
-    def censor(self, images: list | np.ndarray) -> list | np.ndarray:
+    @staticmethod
+    def image_key(image: np.ndarray):
+        return image.shape, image.dtype.str, hashlib.blake2b(np.ascontiguousarray(image).tobytes(), digest_size=16).digest()
+
+    def preprocess(self, images: list) -> torch.Tensor:
+        # same steps as CLIPImageProcessor: resize shortest edge (bicubic), center crop, rescale, normalize
+        pixel_values = []
+        for image in images:
+            x = torch.from_numpy(np.ascontiguousarray(image[..., :3])).to(self.load_device)
+            x = x.permute(2, 0, 1)[None].float()
+            height, width = x.shape[-2:]
+            if height <= width:
+                new_height, new_width = self.size, int(self.size * width / height)
+            else:
+                new_height, new_width = int(self.size * height / width), self.size
+            x = F.interpolate(x, size=(new_height, new_width), mode='bicubic', align_corners=False, antialias=True)
+            x = x.round().clamp(0, 255)
+            top, left = (new_height - self.crop_size) // 2, (new_width - self.crop_size) // 2
+            pixel_values.append(x[..., top:top + self.crop_size, left:left + self.crop_size])
+
+        x = torch.cat(pixel_values) / 255.0
+        x = (x - self.image_mean.to(x)) / self.image_std.to(x)
+        return x.to(self.safety_checker_model.model.dtype)
+
+    def check(self, images: list) -> list:
         self.init()
         model_management.load_model_gpu(self.safety_checker_model)
 
+        has_nsfw_concepts = []
+        for i in range(0, len(images), self.max_batch_size):
+            batch = images[i:i + self.max_batch_size]
+            _, has_nsfw_concept = self.safety_checker_model.model(images=list(batch), clip_input=self.preprocess(batch))
+            has_nsfw_concepts += [bool(x) for x in has_nsfw_concept]
+        return has_nsfw_concepts
+
+    def censor(self, images: list | np.ndarray) -> list | np.ndarray:
         single = False
-        if not isinstance(images, (list, np.ndarray)):
+        if not isinstance(images, (list, np.ndarray)) or isinstance(images, np.ndarray) and images.ndim == 3:
             images = [images]
             single = True
 
-        safety_checker_input = self.clip_image_processor(images, return_tensors="pt")
-        safety_checker_input.to(device=self.load_device)
-        checked_images, has_nsfw_concept = self.safety_checker_model.model(images=images,
-                                                                           clip_input=safety_checker_input.pixel_values)
-        checked_images = [image.astype(np.uint8) for image in checked_images]
+        results = list(images)
+        unchecked = []
+        for index, image in enumerate(results):
+            if not isinstance(image, np.ndarray):
+                continue
+            key = self.image_key(image)
+            has_nsfw_concept = self.verdicts.get(key)
+            if has_nsfw_concept is None:
+                unchecked.append((index, key))
+            elif has_nsfw_concept:
+                results[index] = np.zeros_like(image)
+
+        if len(unchecked) > 0:
+            has_nsfw_concepts = self.check([results[index] for index, _ in unchecked])
+            for (index, key), has_nsfw_concept in zip(unchecked, has_nsfw_concepts):
+                self.verdicts.put(key, has_nsfw_concept)
+                if has_nsfw_concept:
+                    results[index] = np.zeros_like(results[index])
+                    self.verdicts.put(self.image_key(results[index]), False)
+
+        results = [image.astype(np.uint8) if isinstance(image, np.ndarray) else image for image in results]
 
         if single:
-            checked_images = checked_images[0]
+            return results[0]
 
-        return checked_images
+        return results
 
 
 default_censor = Censor().censor
@@ -8,12 +8,14 @@
 import os
 import torch
 import math
+import args_manager
 import ldm_patched.modules.model_management as model_management
 
 from transformers.generation.logits_process import LogitsProcessorList
 from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
 from modules.config import path_fooocus_expansion
 from ldm_patched.modules.model_patcher import ModelPatcher
+from modules.lru_cache import LRUCache
 
 
 # limitation of np.random.seed(), called from transformers.set_seed()
@@ -76,54 +78,115 @@ class FooocusExpansion:
             self.model.half()
 
         self.patcher = ModelPatcher(self.model, load_device=load_device, offload_device=offload_device)
+        self.cache = LRUCache(max_size=args_manager.args.expansion_cache_size)
         print(f'Fooocus Expansion engine loaded for {load_device}, use_fp16 = {use_fp16}.')
 
     @torch.no_grad()
     @torch.inference_mode()
     def logits_processor(self, input_ids, scores):
-        assert scores.ndim == 2 and scores.shape[0] == 1
+        assert scores.ndim == 2
         self.logits_bias = self.logits_bias.to(scores)
 
-        bias = self.logits_bias.clone()
-        bias[0, input_ids[0].to(bias.device).long()] = neg_inf
-        bias[0, 11] = 0
+        bias = self.logits_bias.repeat(scores.shape[0], 1)
+        for i in range(scores.shape[0]):
+            bias[i, input_ids[i].to(bias.device).long()] = neg_inf
+        bias[:, 11] = 0
 
         return scores + bias
 
     @torch.no_grad()
     @torch.inference_mode()
     def __call__(self, prompt, seed):
-        if prompt == '':
-            return ''
+        return self.expand_batch([prompt], [seed])[0]
 
-        if self.patcher.current_device != self.patcher.load_device:
+    @torch.no_grad()
+    @torch.inference_mode()
+    def expand_batch(self, prompts, seeds):
+        results = [None] * len(prompts)
+        groups = {}
+
+        for i, (prompt, seed) in enumerate(zip(prompts, seeds)):
+            if prompt == '':
+                results[i] = ''
+                continue
+
+            seed = int(seed) % SEED_LIMIT_NUMPY
+            prompt = safe_str(prompt) + ','
+
+            cached = self.cache.get((prompt, seed))
+            if cached is not None:
+                results[i] = cached
+                continue
+
+            # prompts with the same token length are generated together without any padding
+            input_ids = self.tokenizer(prompt, return_tensors="pt").data['input_ids']
+            groups.setdefault(int(input_ids.shape[1]), []).append((i, prompt, seed, input_ids))
+
+        if len(groups) > 0 and self.patcher.current_device != self.patcher.load_device:
             print('Fooocus Expansion loaded by itself.')
             model_management.load_model_gpu(self.patcher)
 
-        seed = int(seed) % SEED_LIMIT_NUMPY
-        set_seed(seed)
-        prompt = safe_str(prompt) + ','
+        for current_token_length, group in groups.items():
+            max_token_length = 75 * int(math.ceil(float(current_token_length) / 75.0))
+            max_new_tokens = max_token_length - current_token_length
 
-        tokenized_kwargs = self.tokenizer(prompt, return_tensors="pt")
-        tokenized_kwargs.data['input_ids'] = tokenized_kwargs.data['input_ids'].to(self.patcher.load_device)
-        tokenized_kwargs.data['attention_mask'] = tokenized_kwargs.data['attention_mask'].to(self.patcher.load_device)
+            if max_new_tokens == 0:
+                responses = [prompt[:-1] for _, prompt, _, _ in group]
+            elif len(group) == 1:
+                _, prompt, seed, input_ids = group[0]
+                responses = [self.generate(input_ids, seed, max_new_tokens)]
+            else:
+                input_ids = torch.cat([x[3] for x in group], dim=0)
+                responses = self.generate_batch(input_ids, [x[2] for x in group], max_new_tokens)
 
-        current_token_length = int(tokenized_kwargs.data['input_ids'].shape[1])
-        max_token_length = 75 * int(math.ceil(float(current_token_length) / 75.0))
-        max_new_tokens = max_token_length - current_token_length
+            for (i, prompt, seed, _), response in zip(group, responses):
+                result = safe_str(response)
+                self.cache.put((prompt, seed), result)
+                results[i] = result
 
-        if max_new_tokens == 0:
-            return prompt[:-1]
+        return results
+
+    def generate(self, input_ids, seed, max_new_tokens):
+        set_seed(seed)
+
+        input_ids = input_ids.to(self.patcher.load_device)
 
         # https://huggingface.co/blog/introducing-csearch
         # https://huggingface.co/docs/transformers/generation_strategies
-        features = self.model.generate(**tokenized_kwargs,
+        features = self.model.generate(input_ids=input_ids,
+                                       attention_mask=torch.ones_like(input_ids),
                                        top_k=100,
                                        max_new_tokens=max_new_tokens,
                                        do_sample=True,
                                        logits_processor=LogitsProcessorList([self.logits_processor]))
 
-        response = self.tokenizer.batch_decode(features, skip_special_tokens=True)
-        result = safe_str(response[0])
+        return self.tokenizer.batch_decode(features, skip_special_tokens=True)[0]
+
+    def generate_batch(self, input_ids, seeds, max_new_tokens):
+        # same sampling as generate() with top_k=100, but every row draws from its own seeded generator
+        device = self.patcher.load_device
+        generators = [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+
+        input_ids = input_ids.to(device)
+        attention_mask = torch.ones_like(input_ids)
+        next_input_ids = input_ids
+        past_key_values = None
+
+        for _ in range(max_new_tokens):
+            outputs = self.model(input_ids=next_input_ids, attention_mask=attention_mask,
+                                 past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+
+            scores = self.logits_processor(input_ids, outputs.logits[:, -1, :].clone())
+            top_k_threshold = torch.topk(scores, 100)[0][..., -1, None]
+            scores = scores.masked_fill(scores < top_k_threshold, -float('inf'))
+            probs = torch.nn.functional.softmax(scores, dim=-1)
+
+            next_tokens = torch.cat([torch.multinomial(probs[i:i + 1], num_samples=1, generator=generator)
+                                     for i, generator in enumerate(generators)], dim=0)
+
+            input_ids = torch.cat([input_ids, next_tokens], dim=-1)
+            attention_mask = torch.cat([attention_mask, torch.ones_like(next_tokens)], dim=-1)
+            next_input_ids = next_tokens
 
-        return result
+        return self.tokenizer.batch_decode(input_ids, skip_special_tokens=True)
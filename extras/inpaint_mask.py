@@ -43,6 +43,25 @@ def optimize_masks(masks: torch.Tensor) -> torch.Tensor:
     return torch.from_numpy(masks)
 
 
+# models are kept loaded across calls, SAM models are offloaded by model_management like other models
+sam_predictors = {}
+rembg_sessions = {}
+
+
+def get_sam_predictor(model_type: str) -> SamPredictor:
+    if model_type not in sam_predictors:
+        sam_checkpoint = modules.config.download_sam_model(model_type)
+        sam_predictors[model_type] = SamPredictor(sam_model_registry[model_type](checkpoint=sam_checkpoint))
+    return sam_predictors[model_type]
+
+
+def get_rembg_session(mask_model: str, extras: dict):
+    key = (mask_model, tuple(sorted(extras.items())))
+    if key not in rembg_sessions:
+        rembg_sessions[key] = new_session(mask_model, **extras)
+    return rembg_sessions[key]
+
+
 def generate_mask_from_image(image: np.ndarray, mask_model: str = 'sam', extras=None,
                              sam_options: SAMOptions | None = SAMOptions) -> tuple[np.ndarray | None, int | None, int | None, int | None]:
     dino_detection_count = 0
@@ -61,7 +80,7 @@ def generate_mask_from_image(image: np.ndarray, mask_model: str = 'sam', extras=
     if mask_model != 'sam' or sam_options is None:
         result = remove(
             image,
-            session=new_session(mask_model, **extras),
+            session=get_rembg_session(mask_model, extras),
             only_mask=True,
             **extras
         )
@@ -80,10 +99,7 @@ def generate_mask_from_image(image: np.ndarray, mask_model: str = 'sam', extras=
     boxes[:, :2] = boxes[:, :2] - boxes[:, 2:] / 2
     boxes[:, 2:] = boxes[:, 2:] + boxes[:, :2]
 
-    sam_checkpoint = modules.config.download_sam_model(sam_options.model_type)
-    sam = sam_model_registry[sam_options.model_type](checkpoint=sam_checkpoint)
-
-    sam_predictor = SamPredictor(sam)
+    sam_predictor = get_sam_predictor(sam_options.model_type)
     final_mask_tensor = torch.zeros((image.shape[0], image.shape[1]))
     dino_detection_count = boxes.size(0)
 
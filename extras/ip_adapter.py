@@ -1,3 +1,4 @@
+import os
 import torch
 import ldm_patched.modules.clip_vision
 import safetensors.torch as sf
@@ -8,6 +9,7 @@ from extras.resampler import Resampler
 from ldm_patched.modules.model_patcher import ModelPatcher
 from modules.core import numpy_to_pytorch
 from modules.ops import use_patched_ops
+from modules.patch import patch_settings
 from ldm_patched.modules.ops import manual_cast
 
 
@@ -207,7 +209,7 @@ def patch_model(model, tasks):
     def make_attn_patcher(ip_index):
         def patcher(n, context_attn2, value_attn2, extra_options):
             org_dtype = n.dtype
-            current_step = float(model.model.diffusion_model.current_step.detach().cpu().numpy()[0])
+            current_step = patch_settings[os.getpid()].global_diffusion_progress
             cond_or_uncond = extra_options['cond_or_uncond']
 
             q = n
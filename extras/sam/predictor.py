@@ -60,6 +60,12 @@ class SamPredictor:
             "RGB",
             "BGR",
         ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        if self.is_image_set and self.image is not None and self.image_format == image_format \
+                and np.array_equal(self.image, image):
+            # embedding of the same image is still valid, e.g. for several enhance masks of one image
+            return
+        original_image = image.copy()
+
         if image_format != self.patcher.model.image_format:
             image = image[..., ::-1]
 
@@ -69,6 +75,8 @@ class SamPredictor:
         input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
 
         self.set_torch_image(input_image_torch, image.shape[:2])
+        self.image = original_image
+        self.image_format = image_format
 
     @torch.no_grad()
     def set_torch_image(
@@ -281,6 +289,8 @@ class SamPredictor:
     def reset_image(self) -> None:
         """Resets the currently set image."""
         self.is_image_set = False
+        self.image = None
+        self.image_format = None
         self.features = None
         self.orig_h = None
         self.orig_w = None
@@ -149,4 +149,8 @@ config.default_base_model_name, config.checkpoint_downloads = download_models(
 config.update_files()
 init_cache(config.model_filenames, config.paths_checkpoints, config.lora_filenames, config.paths_loras)
 
-from webui import *
+if args.batch_file is not None:
+    from batch import run_batch
+    run_batch(args.batch_file, args.batch_manifest)
+else:
+    from webui import *
@@ -681,6 +681,17 @@ def get_free_memory(dev=None, torch_free_too=False):
     else:
         return mem_free_total
 
+def get_process_memory():
+    # (current, peak) resident memory of this process in bytes
+    rss = psutil.Process().memory_info()
+    if hasattr(rss, 'peak_wset'):
+        return rss.rss, rss.peak_wset
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return rss.rss, peak
+
 def cpu_mode():
     global cpu_state
     return cpu_state == CPUState.CPU
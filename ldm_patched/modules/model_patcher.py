@@ -14,6 +14,7 @@ class ModelPatcher:
         self.object_patches = {}
         self.object_patches_backup = {}
         self.model_options = {"transformer_options":{}}
+        self.weights_cache_key = None
         self.model_size()
         self.load_device = load_device
         self.offload_device = offload_device
@@ -41,6 +42,7 @@ class ModelPatcher:
         n.object_patches = self.object_patches.copy()
         n.model_options = copy.deepcopy(self.model_options)
         n.model_keys = self.model_keys
+        n.weights_cache_key = self.weights_cache_key
         return n
 
     def is_clone(self, other):
@@ -149,6 +151,9 @@ class ModelPatcher:
                 current_patches.append((strength_patch, patches[k], strength_model))
                 self.patches[k] = current_patches
 
+        if len(p) > 0:
+            # cached patched weights do not include these patches
+            self.weights_cache_key = None
         return list(p)
 
     def get_key_patches(self, filter_prefix=None):
@@ -1,3 +1,4 @@
+import time
 import torch
 
 from ldm_patched.modules import model_management
@@ -202,17 +203,28 @@ class VAE:
 
     def decode_tiled_(self, samples, tile_x=64, tile_y=64, overlap = 16):
         steps = samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x, tile_y, overlap)
-        steps += samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x // 2, tile_y * 2, overlap)
-        steps += samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x * 2, tile_y // 2, overlap)
         pbar = ldm_patched.modules.utils.ProgressBar(steps)
 
+        memory_used = self.memory_used_decode((1, self.latent_channels, tile_y, tile_x), self.vae_dtype)
+        max_batch_size = max(1, int(model_management.get_free_memory(self.device) / memory_used))
+
         decode_fn = lambda a: (self.first_stage_model.decode(a.to(self.vae_dtype).to(self.device)) + 1.0).float()
-        output = torch.clamp((
-            (ldm_patched.modules.utils.tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar) +
-            ldm_patched.modules.utils.tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar) +
-             ldm_patched.modules.utils.tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar))
-            / 3.0) / 2.0, min=0.0, max=1.0)
-        return output
+        output = None
+        oom = False
+        if max_batch_size > 1:
+            try:
+                output = ldm_patched.modules.utils.tiled_scale_batched(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar, max_batch_size = max_batch_size)
+            except model_management.OOM_EXCEPTION as e:
+                print("Warning: Ran out of memory when decoding batched VAE tiles, retrying one tile at a time.")
+                oom = True
+
+        if oom:
+            # the memory of the failed batch is only released once the except block is left
+            model_management.soft_empty_cache(force=True)
+            pbar.update_absolute(0)
+        if output is None:
+            output = ldm_patched.modules.utils.tiled_scale_batched(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar, max_batch_size = 1)
+        return torch.clamp(output / 2.0, min=0.0, max=1.0)
 
     def encode_tiled_(self, pixel_samples, tile_x=512, tile_y=512, overlap = 64):
         steps = pixel_samples.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x, tile_y, overlap)
@@ -428,6 +440,8 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
     return (ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device), clip, vae)
 
 def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, vae_filename_param=None):
+    load_start_time = time.perf_counter()
+    load_start_rss, _ = model_management.get_process_memory()
     sd = ldm_patched.modules.utils.load_torch_file(ckpt_path)
     sd_keys = sd.keys()
     clip = None
@@ -484,6 +498,10 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     if len(left_over) > 0:
         print("left over keys:", left_over)
 
+    rss, peak_rss = model_management.get_process_memory()
+    print("Checkpoint loaded in {:.2f} seconds, RSS {:.0f} MB (+{:.0f} MB), peak RSS {:.0f} MB".format(
+        time.perf_counter() - load_start_time, rss / (1024 * 1024), (rss - load_start_rss) / (1024 * 1024), peak_rss / (1024 * 1024)))
+
     if output_model:
         model_patcher = ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=model_management.unet_offload_device(), current_device=inital_load_device)
         if inital_load_device != torch.device("cpu"):
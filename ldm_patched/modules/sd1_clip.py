@@ -1,4 +1,6 @@
 import os
+import threading
+from collections import OrderedDict
 
 from transformers import CLIPTokenizer
 import ldm_patched.modules.ops
@@ -311,8 +313,9 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
     if valid_file is None:
         return None
 
-    embed_path = valid_file
+    return read_embed(valid_file, embedding_name, embedding_size, embed_key)
 
+def read_embed(embed_path, embedding_name, embedding_size, embed_key=None):
     embed_out = None
 
     try:
@@ -353,6 +356,141 @@ def load_embed(embedding_name, embedding_directory, embedding_size, embed_key=No
             embed_out = next(iter(values))
     return embed_out
 
+class LRUDict:
+    '''
+    Thread-safe dict which keeps the max_items most recently used items.
+    '''
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+def get_file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class EmbeddingRegistry:
+    '''
+    Finds embeddings in an index of the embedding directories instead of searching the directories for every prompt.
+    The index is rebuilt when a directory was modified. Recently used embeddings are kept in memory until their
+    file changes.
+    '''
+    extensions = ['.safetensors', '.pt', '.bin']
+
+    def __init__(self, max_items=64):
+        self.lock = threading.Lock()
+        # tuple of embedding directories -> (directory mtimes, directories, normcased file path -> file path)
+        self.indexes = {}
+        # (embedding file, embedding size, embedding key) -> (file mtime and size, embedding)
+        self.embeds = LRUDict(max_items)
+
+    def get_index(self, embedding_directory):
+        key = tuple(embedding_directory)
+        index = self.indexes.get(key, None)
+        if index is not None and all(get_file_mtime(d) == mtime for d, mtime in index[0].items()):
+            return index
+
+        mtimes = {}
+        directories = {}
+        files = {}
+        for x in embedding_directory:
+            mtimes[x] = get_file_mtime(x)
+            directories[os.path.abspath(x)] = None
+            for root, subdir, file in os.walk(x, followlinks=True):
+                mtimes[root] = get_file_mtime(root)
+                directories[os.path.abspath(root)] = None
+                for f in file:
+                    path = os.path.abspath(os.path.join(root, f))
+                    # file names are case insensitive on Windows
+                    files[os.path.normcase(path)] = path
+
+        index = (mtimes, list(directories), files)
+        self.indexes[key] = index
+        return index
+
+    def find(self, embedding_name, embedding_directory):
+        _, directories, files = self.get_index(embedding_directory)
+        candidates = []
+        for embed_dir in directories:
+            embed_path = os.path.abspath(os.path.join(embed_dir, embedding_name))
+            try:
+                if os.path.commonpath((embed_dir, embed_path)) != embed_dir:
+                    continue
+            except ValueError:
+                continue
+            candidates += [embed_path + x for x in [''] + self.extensions]
+
+        for x in candidates:
+            path = files.get(os.path.normcase(x), None)
+            if path is not None:
+                return path
+
+        # names in another case on case insensitive file systems like macOS, where normcase does not change the case
+        for x in candidates:
+            if os.path.isfile(x):
+                return x
+        return None
+
+    def load(self, embedding_name, embedding_directory, embedding_size, embed_key=None):
+        if isinstance(embedding_directory, str):
+            embedding_directory = [embedding_directory]
+
+        with self.lock:
+            embed_path = self.find(embedding_name, embedding_directory)
+        if embed_path is None:
+            return None
+
+        try:
+            stat = os.stat(embed_path)
+            stat = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+        key = (embed_path, embedding_size, embed_key)
+        cached = self.embeds.get(key, None)
+        if cached is not None and cached[0] == stat:
+            return cached[1]
+
+        embed = read_embed(embed_path, embedding_name, embedding_size, embed_key)
+        # failed loads are kept too, so a broken file is not read again for every prompt
+        self.embeds.put(key, (stat, embed))
+        return embed
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
+            self.embeds.clear()
+
+embedding_registry = EmbeddingRegistry()
+
 class SDTokenizer:
     def __init__(self, tokenizer_path=None, max_length=77, pad_with_end=True, embedding_directory=None, embedding_size=768, embedding_key='clip_l', tokenizer_class=CLIPTokenizer, has_start_token=True, pad_to_max_length=True):
         if tokenizer_path is None:
@@ -380,16 +518,22 @@ class SDTokenizer:
         self.embedding_size = embedding_size
         self.embedding_key = embedding_key
 
+        # text -> batched tokens with word ids, for texts without embeddings
+        self.text_cache = LRUDict(max_items=256)
+        # word -> tokens without start and end token
+        self.word_cache = {}
+        self.max_cached_words = 65536
+
     def _try_get_embedding(self, embedding_name:str):
         '''
         Takes a potential embedding name and tries to retrieve it.
         Returns a Tuple consisting of the embedding and any leftover string, embedding can be None.
         '''
-        embed = load_embed(embedding_name, self.embedding_directory, self.embedding_size, self.embedding_key)
+        embed = embedding_registry.load(embedding_name, self.embedding_directory, self.embedding_size, self.embedding_key)
         if embed is None:
             stripped = embedding_name.strip(',')
             if len(stripped) < len(embedding_name):
-                embed = load_embed(stripped, self.embedding_directory, self.embedding_size, self.embedding_key)
+                embed = embedding_registry.load(stripped, self.embedding_directory, self.embedding_size, self.embedding_key)
                 return (embed, embedding_name[len(stripped):])
         return (embed, "")
 
@@ -401,16 +545,49 @@ class SDTokenizer:
         Word id values are unique per word and embedding, where the id 0 is reserved for non word tokens.
         Returned list has the dimensions NxM where M is the input size of CLIP
         '''
-        if self.pad_with_end:
-            pad_token = self.end_token
-        else:
-            pad_token = 0
+        # embeddings can change on disk, texts using them are tokenized again
+        cacheable = self.embedding_directory is None or self.embedding_identifier not in text
+        batched_tokens = self.text_cache.get(text, None) if cacheable else None
+        if batched_tokens is None:
+            batched_tokens = self.batch_tokens(self.tokenize_text(text))
+            if cacheable:
+                self.text_cache.put(text, batched_tokens)
+
+        if not return_word_ids:
+            return [[(t, w) for t, w,_ in x] for x in batched_tokens]
+        return [list(x) for x in batched_tokens]
 
+    def tokenize_words(self, words):
+        '''
+        Returns the tokens of every word without start and end token.
+        Words missing from the word cache are sent to the tokenizer in one call.
+        '''
+        found = {}
+        for word in words:
+            t = self.word_cache.get(word, None)
+            if t is not None:
+                found[word] = t
+
+        missing = [x for x in dict.fromkeys(words) if x not in found]
+        if len(missing) > 0:
+            new_tokens = {word: t[self.tokens_start:-1] for word, t in zip(missing, self.tokenizer(missing)["input_ids"])}
+            found.update(new_tokens)
+            if len(self.word_cache) + len(new_tokens) > self.max_cached_words:
+                self.word_cache = {}
+            self.word_cache.update(new_tokens)
+
+        return [found[x] for x in words]
+
+    def tokenize_text(self, text):
+        '''
+        Splits a prompt into groups of (token, weight) pairs, one group per word and embedding.
+        '''
         text = escape_important(text)
         parsed_weights = token_weights(text, 1.0)
 
         #tokenize words
         tokens = []
+        words = []
         for weighted_segment, weight in parsed_weights:
             to_tokenize = unescape_important(weighted_segment).replace("\n", " ").split(' ')
             to_tokenize = [x for x in to_tokenize if x != ""]
@@ -431,8 +608,23 @@ class SDTokenizer:
                         word = leftover
                     else:
                         continue
-                #parse word
-                tokens.append([(t, weight) for t in self.tokenizer(word)["input_ids"][self.tokens_start:-1]])
+                #parse word, all words are tokenized at once below
+                words.append((len(tokens), word, weight))
+                tokens.append(None)
+
+        word_tokens = self.tokenize_words([word for _, word, _ in words])
+        for (i, _, weight), t in zip(words, word_tokens):
+            tokens[i] = [(x, weight) for x in t]
+        return tokens
+
+    def batch_tokens(self, tokens):
+        '''
+        Reshapes groups of (token, weight) pairs to batches of (token, weight, word id) with the input size of CLIP.
+        '''
+        if self.pad_with_end:
+            pad_token = self.end_token
+        else:
+            pad_token = 0
 
         #reshape token array to CLIP input size
         batched_tokens = []
@@ -471,9 +663,6 @@ class SDTokenizer:
         if self.pad_to_max_length:
             batch.extend([(pad_token, 1.0, 0)] * (self.max_length - len(batch)))
 
-        if not return_word_ids:
-            batched_tokens = [[(t, w) for t, w,_ in x] for x in batched_tokens]
-
         return batched_tokens
 
 
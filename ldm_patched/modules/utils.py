@@ -1,25 +1,45 @@
 import torch
 import math
+import json
+import functools
 import struct
 import ldm_patched.modules.checkpoint_pickle
 import safetensors.torch
 import numpy as np
 from PIL import Image
+from ldm_patched.modules.args_parser import args
+
+def torch_load(ckpt, **kwargs):
+    # tensors of checkpoints in the zip format are memory mapped, the old format has to be read into RAM
+    if not args.disable_mmap and 'mmap' in torch.load.__code__.co_varnames:
+        try:
+            return torch.load(ckpt, mmap=True, **kwargs)
+        except RuntimeError as e:
+            if 'mmap' not in str(e):
+                raise
+    return torch.load(ckpt, **kwargs)
 
 def load_torch_file(ckpt, safe_load=False, device=None):
     if device is None:
         device = torch.device("cpu")
     if ckpt.lower().endswith(".safetensors"):
-        sd = safetensors.torch.load_file(ckpt, device=device.type)
+        if args.disable_mmap:
+            with open(ckpt, "rb") as f:
+                sd = safetensors.torch.load(f.read())
+            if device.type != "cpu":
+                sd = {k: v.to(device) for k, v in sd.items()}
+        else:
+            # safetensors maps the file, tensors are read when they are copied into a model
+            sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
             if not 'weights_only' in torch.load.__code__.co_varnames:
                 print("Warning torch.load doesn't support weights_only on this pytorch version, loading unsafely.")
                 safe_load = False
         if safe_load:
-            pl_sd = torch.load(ckpt, map_location=device, weights_only=True)
+            pl_sd = torch_load(ckpt, map_location=device, weights_only=True)
         else:
-            pl_sd = torch.load(ckpt, map_location=device, pickle_module=ldm_patched.modules.checkpoint_pickle)
+            pl_sd = torch_load(ckpt, map_location=device, pickle_module=ldm_patched.modules.checkpoint_pickle)
         if "global_step" in pl_sd:
             print(f"Global Step: {pl_sd['global_step']}")
         if "state_dict" in pl_sd:
@@ -34,6 +54,42 @@ def save_torch_file(sd, ckpt, metadata=None):
     else:
         safetensors.torch.save_file(sd, ckpt)
 
+safetensors_dtypes = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+if hasattr(torch, "float8_e4m3fn"):
+    safetensors_dtypes[torch.float8_e4m3fn] = "F8_E4M3"
+    safetensors_dtypes[torch.float8_e5m2] = "F8_E5M2"
+
+def save_safetensors_streaming(sd, ckpt, metadata=None):
+    #safetensors.torch.save_file converts the whole state dict to bytes first, this writes one tensor at a time
+    header = {}
+    offset = 0
+    for k, v in sd.items():
+        size = v.nelement() * v.element_size()
+        header[k] = {"dtype": safetensors_dtypes[v.dtype], "shape": list(v.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+    if metadata is not None:
+        header["__metadata__"] = metadata
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+
+    with open(ckpt, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for v in sd.values():
+            if v.nelement() > 0:
+                f.write(v.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy().data)
+
 def calculate_parameters(sd, prefix=""):
     params = 0
     for k in sd.keys():
@@ -404,6 +460,17 @@ def common_upscale(samples, width, height, upscale_method, crop):
 def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
     return math.ceil((height / (tile_y - overlap))) * math.ceil((width / (tile_x - overlap)))
 
+@functools.lru_cache(maxsize=32)
+def get_tile_blend_mask(height, width, feather, device="cpu"):
+    # same feathering as the former per-pixel loop, built on 1D ramps and cached per tile geometry
+    def ramp(size):
+        r = torch.ones(size)
+        for t in range(feather):
+            r[t:1+t] *= ((1.0/feather) * (t + 1))
+            r[size -1 -t: size-t] *= ((1.0/feather) * (t + 1))
+        return r
+    return (ramp(height)[:, None] * ramp(width)[None, :])[None, None].to(device)
+
 @torch.inference_mode()
 def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None):
     output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
@@ -416,13 +483,7 @@ def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_am
                 s_in = s[:,:,y:y+tile_y,x:x+tile_x]
 
                 ps = function(s_in).to(output_device)
-                mask = torch.ones_like(ps)
-                feather = round(overlap * upscale_amount)
-                for t in range(feather):
-                        mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
+                mask = get_tile_blend_mask(ps.shape[2], ps.shape[3], round(overlap * upscale_amount), ps.device)
                 out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
                 out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
                 if pbar is not None:
@@ -431,6 +492,44 @@ def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_am
         output[b:b+1] = out/out_div
     return output
 
+@torch.inference_mode()
+def tiled_scale_batched(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None, max_batch_size = 1):
+    """
+    Single pass version of tiled_scale. Tiles of the same shape are passed to function up to max_batch_size
+    at a time. They are blended in the same order as in tiled_scale, so the output does not depend on the batching.
+    """
+    out_h, out_w = round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)
+    feather = round(overlap * upscale_amount)
+
+    positions = [(y, x) for y in range(0, samples.shape[2], tile_y - overlap) for x in range(0, samples.shape[3], tile_x - overlap)]
+    shapes = {(y, x): (min(tile_y, samples.shape[2] - y), min(tile_x, samples.shape[3] - x)) for y, x in positions}
+
+    output = torch.empty((samples.shape[0], out_channels, out_h, out_w), device=output_device)
+    for b in range(samples.shape[0]):
+        out = output[b:b+1].zero_()
+        out_div = torch.zeros((1, 1, out_h, out_w), device=output_device)
+        decoded = {}
+        for i, (y, x) in enumerate(positions):
+            h, w = shapes[(y, x)]
+            if (y, x) not in decoded:
+                # the next tiles of the same shape are decoded along and wait for their turn to be blended
+                chunk = [p for p in positions[i:] if shapes[p] == (h, w) and p not in decoded][:max_batch_size]
+                ps = function(torch.cat([samples[b:b+1, :, py:py+h, px:px+w] for py, px in chunk])).to(output_device)
+                for j, p in enumerate(chunk):
+                    decoded[p] = ps[j:j+1]
+                if pbar is not None:
+                    pbar.update(len(chunk))
+
+            ps = decoded.pop((y, x))
+            mask = get_tile_blend_mask(ps.shape[2], ps.shape[3], feather, ps.device)
+            y0, y1 = round(y*upscale_amount), round((y+h)*upscale_amount)
+            x0, x1 = round(x*upscale_amount), round((x+w)*upscale_amount)
+            out[:,:,y0:y1,x0:x1] += ps * mask
+            out_div[:,:,y0:y1,x0:x1] += mask
+
+        out /= out_div
+    return output
+
 PROGRESS_BAR_ENABLED = True
 def set_progress_bar_enabled(enabled):
     global PROGRESS_BAR_ENABLED
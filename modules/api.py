@@ -0,0 +1,437 @@
+import io
+import os
+import json
+import uuid
+import base64
+import random
+import threading
+
+import numpy as np
+from PIL import Image
+from typing import List, Optional
+from pydantic import BaseModel, Field
+from fastapi import Depends, HTTPException
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+
+import args_manager
+import modules.config
+import modules.constants as constants
+import modules.flags as flags
+import modules.async_worker as worker
+from modules.auth import auth_enabled, check_auth
+from modules.lru_cache import LRUCache
+from modules.private_logger import wait_for_images
+
+# number of submitted tasks kept for status requests, finished or not
+max_tasks = 1024
+
+
+class LoraSettings(BaseModel):
+    enabled: bool = True
+    model_name: str = 'None'
+    weight: float = 1.0
+
+
+class ImagePromptSettings(BaseModel):
+    image: str
+    stop_at: float = flags.default_parameters[flags.default_ip][0]
+    weight: float = flags.default_parameters[flags.default_ip][1]
+    type: str = flags.default_ip
+
+
+class EnhanceSettings(BaseModel):
+    mask_dino_prompt_text: str = ''
+    prompt: str = ''
+    negative_prompt: str = ''
+    mask_model: str = modules.config.default_enhance_inpaint_mask_model
+    mask_cloth_category: str = modules.config.default_inpaint_mask_cloth_category
+    mask_sam_model: str = modules.config.default_inpaint_mask_sam_model
+    mask_text_threshold: float = 0.25
+    mask_box_threshold: float = 0.3
+    mask_sam_max_detections: int = modules.config.default_sam_max_detections
+    inpaint_disable_initial_latent: bool = False
+    inpaint_engine: str = modules.config.default_inpaint_engine_version
+    inpaint_strength: float = 1.0
+    inpaint_respective_field: float = 0.618
+    inpaint_erode_or_dilate: int = 0
+    mask_invert: bool = False
+
+
+class GenerationRequest(BaseModel):
+    """
+    Parameters of a generation task, defaults match the defaults of the UI.
+
+    Images are base64 encoded, optionally as data URLs. A seed of None picks a random seed. The tab of the UI
+    the task belongs to is derived from the given images unless current_tab is set.
+    """
+
+    prompt: str = modules.config.default_prompt
+    negative_prompt: str = modules.config.default_prompt_negative
+    style_selections: List[str] = Field(default_factory=lambda: list(modules.config.default_styles))
+    performance_selection: str = modules.config.default_performance
+    aspect_ratio: str = modules.config.default_aspect_ratio.split(' ')[0].replace('×', '*')
+    image_number: int = modules.config.default_image_number
+    output_format: str = modules.config.default_output_format
+    seed: Optional[int] = None
+    read_wildcards_in_order: bool = False
+    sharpness: float = modules.config.default_sample_sharpness
+    guidance_scale: float = modules.config.default_cfg_scale
+    base_model_name: str = modules.config.default_base_model_name
+    refiner_model_name: str = modules.config.default_refiner_model_name
+    refiner_switch: float = modules.config.default_refiner_switch
+    loras: List[LoraSettings] = Field(default_factory=lambda: [
+        LoraSettings(enabled=enabled, model_name=filename, weight=weight)
+        for enabled, filename, weight in modules.config.default_loras])
+    current_tab: Optional[str] = None
+
+    uov_method: str = flags.disabled
+    uov_input_image: Optional[str] = None
+    outpaint_selections: List[str] = Field(default_factory=list)
+    inpaint_input_image: Optional[str] = None
+    inpaint_mask: Optional[str] = None
+    inpaint_additional_prompt: str = ''
+    inpaint_mask_image_upload: Optional[str] = None
+    image_prompts: List[ImagePromptSettings] = Field(default_factory=list)
+    enhance_input_image: Optional[str] = None
+    enhance_checkbox: bool = False
+    enhance_uov_method: str = modules.config.default_enhance_uov_method
+    enhance_uov_processing_order: str = modules.config.default_enhance_uov_processing_order
+    enhance_uov_prompt_type: str = modules.config.default_enhance_uov_prompt_type
+    enhance_ctrls: List[EnhanceSettings] = Field(default_factory=list)
+
+    disable_preview: bool = modules.config.default_black_out_nsfw
+    disable_intermediate_results: bool = flags.Performance.has_restricted_features(modules.config.default_performance)
+    disable_seed_increment: bool = False
+    black_out_nsfw: bool = modules.config.default_black_out_nsfw
+    adm_scaler_positive: float = 1.5
+    adm_scaler_negative: float = 0.8
+    adm_scaler_end: float = 0.3
+    adaptive_cfg: float = modules.config.default_cfg_tsnr
+    clip_skip: int = modules.config.default_clip_skip
+    sampler_name: str = modules.config.default_sampler
+    scheduler_name: str = modules.config.default_scheduler
+    vae_name: str = modules.config.default_vae
+    overwrite_step: int = modules.config.default_overwrite_step
+    overwrite_switch: int = modules.config.default_overwrite_switch
+    overwrite_width: int = -1
+    overwrite_height: int = -1
+    overwrite_vary_strength: float = -1
+    overwrite_upscale_strength: float = modules.config.default_overwrite_upscale
+    mixing_image_prompt_and_vary_upscale: bool = False
+    mixing_image_prompt_and_inpaint: bool = False
+    debugging_cn_preprocessor: bool = False
+    skipping_cn_preprocessor: bool = False
+    canny_low_threshold: int = 64
+    canny_high_threshold: int = 128
+    refiner_swap_method: str = flags.refiner_swap_method
+    controlnet_softness: float = 0.25
+    freeu_enabled: bool = False
+    freeu_b1: float = 1.01
+    freeu_b2: float = 1.02
+    freeu_s1: float = 0.99
+    freeu_s2: float = 0.95
+    debugging_inpaint_preprocessor: bool = False
+    inpaint_disable_initial_latent: bool = False
+    inpaint_engine: str = modules.config.default_inpaint_engine_version
+    inpaint_strength: float = 1.0
+    inpaint_respective_field: float = 0.618
+    inpaint_advanced_masking_checkbox: bool = modules.config.default_inpaint_advanced_masking_checkbox
+    invert_mask_checkbox: bool = modules.config.default_invert_mask_checkbox
+    inpaint_erode_or_dilate: int = 0
+    save_final_enhanced_image_only: bool = modules.config.default_save_only_final_enhanced_image
+    save_metadata_to_images: bool = modules.config.default_save_metadata_to_images
+    metadata_scheme: str = modules.config.default_metadata_scheme
+    debugging_dino: bool = False
+    dino_erode_or_dilate: int = 0
+    debugging_enhance_masks_checkbox: bool = False
+    generate_image_grid: bool = False
+
+    priority: int = 0
+
+
+def decode_image(data):
+    if data is None:
+        return None
+    if data.startswith('data:'):
+        data = data.split(',', 1)[1]
+    try:
+        return np.array(Image.open(io.BytesIO(base64.b64decode(data))).convert('RGB'))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f'Invalid image: {e}')
+
+
+def encode_image(image, output_format='png'):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='JPEG' if output_format == 'jpeg' else 'PNG')
+    return buffer.getvalue()
+
+
+def get_current_tab(request):
+    if request.current_tab is not None:
+        return request.current_tab
+    if request.inpaint_input_image is not None:
+        return 'inpaint'
+    if request.uov_input_image is not None:
+        return 'uov'
+    if len(request.image_prompts) > 0:
+        return 'ip'
+    if request.enhance_input_image is not None:
+        return 'enhance'
+    return 'uov'
+
+
+def get_task_args(request):
+    """
+    Returns the positional arguments of AsyncTask for a request, in the order of the controls of the UI.
+    """
+
+    seed = request.seed if request.seed is not None else random.randint(constants.MIN_SEED, constants.MAX_SEED)
+    width, height = request.aspect_ratio.replace('×', '*').split('*')[:2]
+
+    inpaint_input_image = None
+    if request.inpaint_input_image is not None:
+        image = decode_image(request.inpaint_input_image)
+        mask = decode_image(request.inpaint_mask)
+        inpaint_input_image = {'image': image, 'mask': mask if mask is not None else np.zeros_like(image)}
+
+    args = [request.generate_image_grid, request.prompt, request.negative_prompt, request.style_selections,
+            request.performance_selection, f'{int(width)}×{int(height)}', request.image_number,
+            request.output_format, seed, request.read_wildcards_in_order, request.sharpness,
+            request.guidance_scale, request.base_model_name, request.refiner_model_name, request.refiner_switch]
+
+    loras = request.loras[:modules.config.default_max_lora_number]
+    loras += [LoraSettings(enabled=False)] * (modules.config.default_max_lora_number - len(loras))
+    for lora in loras:
+        args += [lora.enabled, lora.model_name, lora.weight]
+
+    args += [request.uov_input_image is not None or inpaint_input_image is not None or len(request.image_prompts) > 0
+             or request.enhance_input_image is not None, get_current_tab(request)]
+    args += [request.uov_method, decode_image(request.uov_input_image)]
+    args += [request.outpaint_selections, inpaint_input_image, request.inpaint_additional_prompt,
+             decode_image(request.inpaint_mask_image_upload)]
+    args += [request.disable_preview, request.disable_intermediate_results, request.disable_seed_increment,
+             request.black_out_nsfw]
+    args += [request.adm_scaler_positive, request.adm_scaler_negative, request.adm_scaler_end, request.adaptive_cfg,
+             request.clip_skip]
+    args += [request.sampler_name, request.scheduler_name, request.vae_name]
+    args += [request.overwrite_step, request.overwrite_switch, request.overwrite_width, request.overwrite_height,
+             request.overwrite_vary_strength]
+    args += [request.overwrite_upscale_strength, request.mixing_image_prompt_and_vary_upscale,
+             request.mixing_image_prompt_and_inpaint]
+    args += [request.debugging_cn_preprocessor, request.skipping_cn_preprocessor, request.canny_low_threshold,
+             request.canny_high_threshold]
+    args += [request.refiner_swap_method, request.controlnet_softness]
+    args += [request.freeu_enabled, request.freeu_b1, request.freeu_b2, request.freeu_s1, request.freeu_s2]
+    args += [request.debugging_inpaint_preprocessor, request.inpaint_disable_initial_latent, request.inpaint_engine,
+             request.inpaint_strength, request.inpaint_respective_field, request.inpaint_advanced_masking_checkbox,
+             request.invert_mask_checkbox, request.inpaint_erode_or_dilate]
+
+    if not args_manager.args.disable_image_log:
+        args += [request.save_final_enhanced_image_only]
+
+    if not args_manager.args.disable_metadata:
+        args += [request.save_metadata_to_images, request.metadata_scheme]
+
+    for index in range(modules.config.default_controlnet_image_count):
+        if index < len(request.image_prompts):
+            image_prompt = request.image_prompts[index]
+            args += [decode_image(image_prompt.image), image_prompt.stop_at, image_prompt.weight, image_prompt.type]
+        else:
+            args += [None, modules.config.default_ip_stop_ats[index], modules.config.default_ip_weights[index],
+                     modules.config.default_ip_types[index]]
+
+    args += [request.debugging_dino, request.dino_erode_or_dilate, request.debugging_enhance_masks_checkbox,
+             decode_image(request.enhance_input_image), request.enhance_checkbox, request.enhance_uov_method,
+             request.enhance_uov_processing_order, request.enhance_uov_prompt_type]
+
+    for index in range(modules.config.default_enhance_tabs):
+        enhance = request.enhance_ctrls[index] if index < len(request.enhance_ctrls) else None
+        settings = enhance if enhance is not None else EnhanceSettings()
+        args += [enhance is not None, settings.mask_dino_prompt_text, settings.prompt, settings.negative_prompt,
+                 settings.mask_model, settings.mask_cloth_category, settings.mask_sam_model,
+                 settings.mask_text_threshold, settings.mask_box_threshold, settings.mask_sam_max_detections,
+                 settings.inpaint_disable_initial_latent, settings.inpaint_engine, settings.inpaint_strength,
+                 settings.inpaint_respective_field, settings.inpaint_erode_or_dilate, settings.mask_invert]
+
+    return args
+
+
+class ApiTask:
+    """
+    Consumes the yields of a submitted task and keeps its state for status requests and event streams.
+    """
+
+    def __init__(self, task_id, task):
+        self.task_id = task_id
+        self.task = task
+        self.state = 'queued'
+        self.percentage = 0
+        self.title = ''
+        self.preview = None
+        self.results = []
+        self.events = []
+        self.condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.consume, daemon=True).start()
+
+    def add_event(self, flag, data):
+        with self.condition:
+            self.events.append((flag, data))
+            self.condition.notify_all()
+
+    def consume(self):
+        task = self.task
+        while True:
+            if not task.yields.wait(timeout=1.0):
+                if task not in worker.async_tasks and not task.processing:
+                    # the worker died without finishing the task
+                    self.state = 'failed'
+                    self.add_event('finish', self.describe())
+                    return
+                continue
+
+            flag, product = task.yields.pop(0)
+            if flag == 'preview':
+                self.state = 'processing'
+                self.percentage, self.title, image = product
+                if image is not None:
+                    self.preview = image
+                self.add_event('preview', {'percentage': self.percentage, 'title': self.title})
+            if flag == 'results':
+                wait_for_images(product)
+                self.results = list(product)
+                self.add_event('results', {'images': self.describe_images()})
+            if flag == 'finish':
+                wait_for_images(product)
+                self.results = list(product)
+                self.state = 'cancelled' if task.last_stop == 'stop' else 'finished'
+                self.add_event('finish', self.describe())
+                return
+
+    def describe_images(self, include_images=False):
+        images = []
+        for index, result in enumerate(self.results):
+            image = {'url': f'/api/v1/tasks/{self.task_id}/images/{index}',
+                     'path': result if isinstance(result, str) else None}
+            if include_images:
+                image['base64'] = base64.b64encode(get_image_bytes(result)[0]).decode('ascii')
+            images.append(image)
+        return images
+
+    def describe(self, include_images=False):
+        return {
+            'task_id': self.task_id,
+            'state': self.state,
+            'position': worker.async_tasks.position(self.task) if self.state == 'queued' else None,
+            'percentage': self.percentage,
+            'title': self.title,
+            'images': self.describe_images(include_images)
+        }
+
+
+def get_image_bytes(result):
+    if isinstance(result, str):
+        with open(result, 'rb') as fp:
+            return fp.read(), 'image/' + os.path.splitext(result)[1][1:].lower().replace('jpg', 'jpeg')
+    return encode_image(result), 'image/png'
+
+
+api_tasks = LRUCache(max_size=max_tasks)
+security = HTTPBasic(auto_error=False)
+
+
+def get_user(credentials: Optional[HTTPBasicCredentials] = Depends(security)):
+    if not (auth_enabled and (args_manager.args.share or args_manager.args.listen)):
+        return None
+    if credentials is None or not check_auth(credentials.username, credentials.password):
+        raise HTTPException(status_code=401, detail='Invalid credentials',
+                            headers={'WWW-Authenticate': 'Basic'})
+    return credentials.username
+
+
+def get_api_task(task_id):
+    api_task = api_tasks.get(task_id)
+    if api_task is None:
+        raise HTTPException(status_code=404, detail='Task not found')
+    return api_task
+
+
+def setup_api_routes(app):
+    @app.post('/api/v1/tasks')
+    def submit_task(request: GenerationRequest, user: Optional[str] = Depends(get_user)):
+        task = worker.AsyncTask(args=get_task_args(request))
+        task.priority = request.priority
+        task.user = user if user is not None else 'api'
+
+        api_task = ApiTask(uuid.uuid4().hex, task)
+        api_tasks.put(api_task.task_id, api_task)
+        worker.async_tasks.put(task)
+        api_task.start()
+        return api_task.describe()
+
+    @app.get('/api/v1/tasks/{task_id}')
+    def get_task_status(task_id: str, include_images: bool = False, user: Optional[str] = Depends(get_user)):
+        return get_api_task(task_id).describe(include_images)
+
+    @app.post('/api/v1/tasks/{task_id}/cancel')
+    def cancel_task(task_id: str, user: Optional[str] = Depends(get_user)):
+        import ldm_patched.modules.model_management as model_management
+
+        api_task = get_api_task(task_id)
+        task = api_task.task
+        task.last_stop = 'stop'
+        if worker.async_tasks.cancel(task):
+            task.yields.append(['finish', task.results])
+        elif task.processing:
+            model_management.interrupt_current_processing()
+        return api_task.describe()
+
+    @app.post('/api/v1/tasks/{task_id}/skip')
+    def skip_task(task_id: str, user: Optional[str] = Depends(get_user)):
+        import ldm_patched.modules.model_management as model_management
+
+        api_task = get_api_task(task_id)
+        api_task.task.last_stop = 'skip'
+        if api_task.task.processing:
+            model_management.interrupt_current_processing()
+        return api_task.describe()
+
+    @app.get('/api/v1/tasks/{task_id}/events')
+    def stream_task_events(task_id: str, previews: bool = False, user: Optional[str] = Depends(get_user)):
+        api_task = get_api_task(task_id)
+
+        def stream():
+            index = 0
+            while True:
+                with api_task.condition:
+                    api_task.condition.wait_for(lambda: len(api_task.events) > index, timeout=15.0)
+                    events = api_task.events[index:]
+                    preview = api_task.preview
+
+                if len(events) == 0:
+                    yield ': keep-alive\n\n'
+                    continue
+
+                index += len(events)
+                for i, (flag, data) in enumerate(events):
+                    if flag == 'preview' and i == len(events) - 1 and previews and preview is not None:
+                        data = dict(data, image=base64.b64encode(encode_image(preview, 'jpeg')).decode('ascii'))
+                    yield f'event: {flag}\ndata: {json.dumps(data)}\n\n'
+                    if flag == 'finish':
+                        return
+
+        return StreamingResponse(stream(), media_type='text/event-stream')
+
+    @app.get('/api/v1/tasks/{task_id}/images/{index}')
+    def get_task_image(task_id: str, index: int, user: Optional[str] = Depends(get_user)):
+        api_task = get_api_task(task_id)
+        if not 0 <= index < len(api_task.results):
+            raise HTTPException(status_code=404, detail='Image not found')
+
+        result = api_task.results[index]
+        if isinstance(result, str):
+            return FileResponse(result)
+        content, media_type = get_image_bytes(result)
+        return Response(content=content, media_type=media_type)
@@ -1,7 +1,9 @@
 import threading
 
+import args_manager
 from extras.inpaint_mask import generate_mask_from_image, SAMOptions
 from modules.patch import PatchSettings, patch_settings, patch_all
+from modules.task_queue import TaskQueue, TaskYields
 import modules.config
 
 patch_all()
@@ -15,10 +17,12 @@ class AsyncTask:
         import args_manager
 
         self.args = args.copy()
-        self.yields = []
+        self.yields = TaskYields()
         self.results = []
         self.last_stop = False
         self.processing = False
+        self.priority = 0
+        self.user = None
 
         self.performance_loras = []
 
@@ -158,7 +162,14 @@ class AsyncTask:
         self.images_to_enhance_count = 0
         self.enhance_stats = {}
 
-async_tasks = []
+
+def get_model_affinity_key(task):
+    return task.base_model_name, task.refiner_model_name, task.vae_name, str(task.loras), task.performance_selection
+
+
+async_tasks = TaskQueue(fair_share=args_manager.args.multi_user, persist_path=args_manager.args.task_queue_path,
+                        affinity_key=get_model_affinity_key if args_manager.args.enable_model_affinity else None,
+                        affinity_max_wait=args_manager.args.model_affinity_max_wait)
 
 
 class EarlyReturnException(BaseException):
@@ -192,7 +203,7 @@ def worker():
 
     from extras.censor import default_censor
     from modules.sdxl_styles import apply_style, get_random_style, fooocus_expansion, apply_arrays, random_style_name
-    from modules.private_logger import log
+    from modules.private_logger import log, wait_for_images
     from extras.expansion import safe_str
     from modules.util import (remove_empty_str, HWC3, resize_image, get_image_shape_ceil, set_image_shape_ceil,
                               get_shape_ceil, resample_image, erode_or_dilate, parse_lora_references_from_prompt,
@@ -239,6 +250,8 @@ def worker():
         if len(async_task.results) < 2:
             return
 
+        wait_for_images(async_task.results)
+
         for img in async_task.results:
             if isinstance(img, str) and os.path.exists(img):
                 img = cv2.imread(img)
@@ -324,6 +337,66 @@ def worker():
 
         return imgs, img_paths, current_progress
 
+    def process_task_batch(all_steps, async_task, callback, current_task_id, denoising_strength, final_scheduler_name,
+                           initial_latent, steps, switch, batch_tasks, loras, tiled, use_expansion, width, height,
+                           base_progress, preparation_steps, total_count, show_intermediate_results, persist_image=True):
+        if async_task.last_stop is not False:
+            ldm_patched.modules.model_management.interrupt_current_processing()
+        positive_cond = pipeline.stack_conds([task['c'] for task in batch_tasks])
+        negative_cond = pipeline.stack_conds([task['uc'] for task in batch_tasks])
+        imgs = pipeline.process_diffusion(
+            positive_cond=positive_cond,
+            negative_cond=negative_cond,
+            steps=steps,
+            switch=switch,
+            width=width,
+            height=height,
+            image_seed=[task['task_seed'] for task in batch_tasks],
+            callback=callback,
+            sampler_name=async_task.sampler_name,
+            scheduler_name=final_scheduler_name,
+            latent=initial_latent,
+            denoise=denoising_strength,
+            tiled=tiled,
+            cfg_scale=async_task.cfg_scale,
+            refiner_swap_method=async_task.refiner_swap_method,
+            disable_preview=async_task.disable_preview
+        )
+        del positive_cond, negative_cond  # Save memory
+        current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * steps * len(batch_tasks))
+        if modules.config.default_black_out_nsfw or async_task.black_out_nsfw:
+            progressbar(async_task, current_progress, 'Checking for NSFW content ...')
+            imgs = default_censor(imgs)
+        img_paths = []
+        for i, (task, img) in enumerate(zip(batch_tasks, imgs)):
+            progressbar(async_task, current_progress, f'Saving image {current_task_id + i + 1}/{total_count} to system ...')
+            img_paths += save_and_log(async_task, height, [img], task, use_expansion, width, loras, persist_image)
+        yield_result(async_task, img_paths, current_progress, async_task.black_out_nsfw, False,
+                     do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
+
+        return imgs, img_paths, current_progress
+
+    def get_sampling_batches(async_task, goals, tasks, width, height):
+        # inpaint and control models carry per-image state that is not batched yet
+        if not args_manager.args.enable_batched_sampling or len(tasks) < 2 \
+                or 'inpaint' in goals or 'cn' in goals \
+                or async_task.sampler_name not in flags.batched_sampling_samplers:
+            return [[task] for task in tasks]
+
+        max_batch_size = pipeline.get_sampling_batch_size(width, height, args_manager.args.max_sampling_batch_size)
+        print(f'[Sampler] Batched sampling with up to {max_batch_size} images per batch.')
+
+        batches = []
+        for task in tasks:
+            if len(batches) > 0 and len(batches[-1]) < max_batch_size:
+                candidate = batches[-1] + [task]
+                if pipeline.stack_conds([t['c'] for t in candidate]) is not None \
+                        and pipeline.stack_conds([t['uc'] for t in candidate]) is not None:
+                    batches[-1] = candidate
+                    continue
+            batches.append([task])
+        return batches
+
     def apply_patch_settings(async_task):
         patch_settings[pid] = PatchSettings(
             async_task.sharpness,
@@ -389,7 +462,7 @@ def worker():
             d.append(('Metadata Scheme', 'metadata_scheme',
                       async_task.metadata_scheme.value if async_task.save_metadata_to_images else async_task.save_metadata_to_images))
             d.append(('Version', 'version', 'Fooocus v' + fooocus_version.version))
-            img_paths.append(log(x, d, metadata_parser, async_task.output_format, task, persist_image))
+            img_paths.append(log(x, d, metadata_parser, async_task.output_format, task, persist_image, blocking=False))
 
         return img_paths
 
@@ -732,28 +805,32 @@ def worker():
         if use_expansion:
             if advance_progress:
                 current_progress += 1
-            for i, t in enumerate(tasks):
-
-                progressbar(async_task, current_progress, f'Preparing Fooocus text #{i + 1} ...')
-                
-                expansion = pipeline.final_expansion(t['task_prompt'], t['task_seed'])
-                
+            progressbar(async_task, current_progress, 'Preparing Fooocus text ...')
+            expansions = pipeline.final_expansion.expand_batch([t['task_prompt'] for t in tasks],
+                                                               [t['task_seed'] for t in tasks])
+            for t, expansion in zip(tasks, expansions):
                 print(f'[Prompt Expansion] {expansion}')
                 t['expansion'] = expansion
                 t['positive'] = copy.deepcopy(t['positive']) + [expansion]  # Deep copy.
         if advance_progress:
             current_progress += 1
+        progressbar(async_task, current_progress, 'Encoding positive and negative prompts ...')
+        encode_negative = abs(float(async_task.cfg_scale) - 1.0) >= 1e-4
+        texts_list = [t['positive'] for t in tasks]
+        pool_top_k_list = [t['positive_top_k'] for t in tasks]
+        if encode_negative:
+            texts_list += [t['negative'] for t in tasks]
+            pool_top_k_list += [t['negative_top_k'] for t in tasks]
+        conds = pipeline.clip_encode_multiple(texts_list, pool_top_k_list)
         for i, t in enumerate(tasks):
-            progressbar(async_task, current_progress, f'Encoding positive #{i + 1} ...')
-            t['c'] = pipeline.clip_encode(texts=t['positive'], pool_top_k=t['positive_top_k'])
+            t['c'] = conds[i]
         if advance_progress:
             current_progress += 1
         for i, t in enumerate(tasks):
-            if abs(float(async_task.cfg_scale) - 1.0) < 1e-4:
-                t['uc'] = pipeline.clone_cond(t['c'])
+            if encode_negative:
+                t['uc'] = conds[len(tasks) + i]
             else:
-                progressbar(async_task, current_progress, f'Encoding negative #{i + 1} ...')
-                t['uc'] = pipeline.clip_encode(texts=t['negative'], pool_top_k=t['negative_top_k'])
+                t['uc'] = pipeline.clone_cond(t['c'])
         return tasks, use_expansion, loras, current_progress
 
     def apply_freeu(async_task):
@@ -1269,44 +1346,66 @@ def worker():
         preparation_steps = current_progress
         total_count = async_task.image_number
 
+        current_batch_size = 1
+
         def callback(step, x0, x, total_steps, y):
             if step == 0:
                 async_task.callback_steps = 0
-            async_task.callback_steps += (100 - preparation_steps) / float(all_steps)
+            async_task.callback_steps += (100 - preparation_steps) / float(all_steps) * current_batch_size
+            if current_batch_size > 1:
+                image_text = f'images {current_task_id + 1}-{current_task_id + current_batch_size}/{total_count}'
+            else:
+                image_text = f'image {current_task_id + 1}/{total_count}'
             async_task.yields.append(['preview', (
                 int(current_progress + async_task.callback_steps),
-                f'Sampling step {step + 1}/{total_steps}, image {current_task_id + 1}/{total_count} ...', y)])
+                f'Sampling step {step + 1}/{total_steps}, {image_text} ...', y)])
 
         show_intermediate_results = len(tasks) > 1 or async_task.should_enhance
         persist_image = not async_task.should_enhance or not async_task.save_final_enhanced_image_only
 
-        for current_task_id, task in enumerate(tasks):
+        current_task_id = 0
+        for batch_tasks in get_sampling_batches(async_task, goals, tasks, width, height):
+            current_batch_size = len(batch_tasks)
             progressbar(async_task, current_progress, f'Preparing task {current_task_id + 1}/{async_task.image_number} ...')
             execution_start_time = time.perf_counter()
 
             try:
-                imgs, img_paths, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
-                                                                 controlnet_cpds_path, current_task_id,
-                                                                 denoising_strength, final_scheduler_name, goals,
-                                                                 initial_latent, async_task.steps, switch, task['c'],
-                                                                 task['uc'], task, loras, tiled, use_expansion, width,
-                                                                 height, current_progress, preparation_steps,
-                                                                 async_task.image_number, show_intermediate_results,
-                                                                 persist_image)
-
-                current_progress = int(preparation_steps + (100 - preparation_steps) / float(all_steps) * async_task.steps * (current_task_id + 1))
+                if current_batch_size > 1:
+                    imgs, img_paths, current_progress = process_task_batch(all_steps, async_task, callback,
+                                                                           current_task_id, denoising_strength,
+                                                                           final_scheduler_name, initial_latent,
+                                                                           async_task.steps, switch, batch_tasks,
+                                                                           loras, tiled, use_expansion, width, height,
+                                                                           current_progress, preparation_steps,
+                                                                           async_task.image_number,
+                                                                           show_intermediate_results, persist_image)
+                else:
+                    task = batch_tasks[0]
+                    imgs, img_paths, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
+                                                                     controlnet_cpds_path, current_task_id,
+                                                                     denoising_strength, final_scheduler_name, goals,
+                                                                     initial_latent, async_task.steps, switch, task['c'],
+                                                                     task['uc'], task, loras, tiled, use_expansion, width,
+                                                                     height, current_progress, preparation_steps,
+                                                                     async_task.image_number, show_intermediate_results,
+                                                                     persist_image)
+
+                current_progress = int(preparation_steps + (100 - preparation_steps) / float(all_steps) * async_task.steps * (current_task_id + current_batch_size))
                 images_to_enhance += imgs
 
             except ldm_patched.modules.model_management.InterruptProcessingException:
                 if async_task.last_stop == 'skip':
                     print('User skipped')
                     async_task.last_stop = False
+                    current_task_id += current_batch_size
                     continue
                 else:
                     print('User stopped')
                     break
 
-            del task['c'], task['uc']  # Save memory
+            for task in batch_tasks:
+                del task['c'], task['uc']  # Save memory
+            current_task_id += current_batch_size
             execution_time = time.perf_counter() - execution_start_time
             print(f'Generating and saving time: {execution_time:.2f} seconds')
 
@@ -1464,24 +1563,36 @@ def worker():
         stop_processing(async_task, processing_start_time)
         return
 
-    while True:
-        time.sleep(0.01)
-        if len(async_tasks) > 0:
-            task = async_tasks.pop(0)
+    async_tasks.restore(AsyncTask)
 
-            try:
-                handler(task)
-                if task.generate_image_grid:
-                    build_image_wall(task)
-                task.yields.append(['finish', task.results])
-                pipeline.prepare_text_encoder(async_call=True)
-            except:
-                traceback.print_exc()
-                task.yields.append(['finish', task.results])
-            finally:
-                if pid in modules.patch.patch_settings:
-                    del modules.patch.patch_settings[pid]
+    while True:
+        task = async_tasks.get()
+
+        try:
+            handler(task)
+            if task.generate_image_grid:
+                build_image_wall(task)
+            task.yields.append(['finish', task.results])
+            pipeline.prepare_text_encoder(async_call=True)
+        except:
+            traceback.print_exc()
+            task.yields.append(['finish', task.results])
+        finally:
+            task.processing = False
+            if async_tasks.affinity_key is not None:
+                stats = async_tasks.stats(pipeline.get_average_model_swap_time())
+                print(f'[Queue] Model swaps: {stats["model_swaps"]}, avoided: {stats["model_swaps_avoided"]}, '
+                      f'estimated time saved: {stats["time_saved"]:.2f} seconds')
+            if pid in modules.patch.patch_settings:
+                del modules.patch.patch_settings[pid]
     pass
 
 
-threading.Thread(target=worker, daemon=True).start()
+if args_manager.args.worker_pool_devices is None:
+    threading.Thread(target=worker, daemon=True).start()
+else:
+    from modules.worker_pool import WorkerPool
+
+    async_tasks.restore(AsyncTask)
+    worker_pool = WorkerPool(args_manager.args.worker_pool_devices, async_tasks)
+    worker_pool.start()
@@ -0,0 +1,175 @@
+import os
+import json
+import threading
+
+import torch
+import safetensors.torch
+
+import args_manager
+import ldm_patched.modules.model_management as model_management
+import ldm_patched.modules.model_patcher
+import ldm_patched.modules.supported_models
+import ldm_patched.modules.utils
+from ldm_patched.modules.model_base import ModelType
+from ldm_patched.modules.sd import CLIP, VAE, load_checkpoint_guess_config
+from modules.hash_cache import get_cached_hash, sha256_from_cache_async
+
+
+class CheckpointCache:
+    """
+    On-disk cache of checkpoints split into UNet, CLIP and VAE weights in the layout and dtype used at runtime,
+    next to the detected model config, so loading skips detection, key conversion and dtype casting.
+
+    Entries are folders named by the checkpoint hash with one file per component and dtype. They are written in the
+    background after a checkpoint was loaded from its file.
+    """
+
+    # models which need weights other than the UNet to be built
+    uncacheable_model_configs = ['Stable_Zero123']
+
+    def __init__(self, path=None):
+        self.path = path
+        self.writing = set()
+        self.lock = threading.Lock()
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def weights_filename(self, checkpoint_hash, component, dtype):
+        return os.path.join(self.path, checkpoint_hash, f'{component}.{str(dtype).replace("torch.", "")}.safetensors')
+
+    @staticmethod
+    def clip_dtype():
+        return model_management.text_encoder_dtype(model_management.text_encoder_device())
+
+    def load(self, ckpt_path, embedding_directory=None, vae_filename_param=None):
+        checkpoint_hash = get_cached_hash(ckpt_path)
+        if checkpoint_hash is None:
+            # hashing takes about as long as loading, the hash is calculated in the background for the next load
+            sha256_from_cache_async(ckpt_path)
+        else:
+            try:
+                result = self.load_from_cache(checkpoint_hash, embedding_directory, vae_filename_param)
+                if result is not None:
+                    print(f'[Checkpoint Cache] Loaded {ckpt_path} from cache.')
+                    return result
+            except Exception as e:
+                print(f'[Checkpoint Cache] Reading {ckpt_path} from cache failed: {e}')
+
+        result = load_checkpoint_guess_config(ckpt_path, embedding_directory=embedding_directory,
+                                              vae_filename_param=vae_filename_param)
+        if checkpoint_hash is not None:
+            self.save(checkpoint_hash, *result[:3], save_vae=vae_filename_param is None)
+        return result
+
+    def load_from_cache(self, checkpoint_hash, embedding_directory=None, vae_filename_param=None):
+        config_filename = os.path.join(self.path, checkpoint_hash, 'config.json')
+        if not os.path.exists(config_filename):
+            return None
+
+        with open(config_filename, 'rt', encoding='utf-8') as fp:
+            config = json.load(fp)
+
+        parameters = config['parameters']
+        unet_dtype = model_management.unet_dtype(model_params=parameters)
+        filenames = {'unet': self.weights_filename(checkpoint_hash, 'unet', unet_dtype)}
+        if config['clip']:
+            filenames['clip'] = self.weights_filename(checkpoint_hash, 'clip', self.clip_dtype())
+        if vae_filename_param is None:
+            filenames['vae'] = self.weights_filename(checkpoint_hash, 'vae', model_management.vae_dtype())
+        if not all(os.path.exists(filename) for filename in filenames.values()):
+            return None
+
+        load_device = model_management.get_torch_device()
+        model_configs = {model_config.__name__: model_config for model_config in ldm_patched.modules.supported_models.models}
+        model_config = model_configs[config['model_config']](dict(config['unet_config'], dtype=unet_dtype))
+        model_config.set_manual_cast(model_management.unet_manual_cast(unet_dtype, load_device))
+        # detected from the checkpoint weights when the cache entry was written
+        model_type = ModelType[config['model_type']]
+        model_config.model_type = lambda state_dict, prefix='': model_type
+
+        inital_load_device = model_management.unet_inital_load_device(parameters, unet_dtype)
+        model = model_config.get_model({}, 'model.diffusion_model.', device=inital_load_device)
+        model.diffusion_model.load_state_dict(safetensors.torch.load_file(filenames['unet']))
+
+        clip = None
+        if config['clip']:
+            clip = CLIP(model_config.clip_target(), embedding_directory=embedding_directory)
+            clip.cond_stage_model.load_state_dict(safetensors.torch.load_file(filenames['clip']))
+
+        vae_filename = None
+        if vae_filename_param is None:
+            vae_sd = safetensors.torch.load_file(filenames['vae'])
+        else:
+            vae_sd = ldm_patched.modules.utils.load_torch_file(vae_filename_param)
+            vae_filename = vae_filename_param
+        vae = VAE(sd=vae_sd)
+
+        model_patcher = ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=model_management.unet_offload_device(), current_device=inital_load_device)
+        if inital_load_device != torch.device('cpu'):
+            print('loaded straight to GPU')
+            model_management.load_model_gpu(model_patcher)
+
+        return model_patcher, clip, vae, vae_filename, None
+
+    def save(self, checkpoint_hash, model_patcher, clip, vae, save_vae=True):
+        if model_patcher is None:
+            return
+
+        model = model_patcher.model
+        model_config = model.model_config
+        if type(model_config).__name__ in self.uncacheable_model_configs:
+            return
+
+        # weights are replaced, not modified, when models are moved or patched, so these stay as loaded
+        unet_sd = model.diffusion_model.state_dict()
+        config = {
+            'model_config': type(model_config).__name__,
+            'unet_config': {k: v for k, v in model_config.unet_config.items() if k != 'dtype'},
+            'model_type': model.model_type.name,
+            'parameters': sum(w.nelement() for w in unet_sd.values()),
+            'clip': clip is not None,
+        }
+
+        weights = {self.weights_filename(checkpoint_hash, 'unet', model_config.unet_config['dtype']): unet_sd}
+        if clip is not None:
+            weights[self.weights_filename(checkpoint_hash, 'clip', self.clip_dtype())] = clip.cond_stage_model.state_dict()
+        if save_vae and vae is not None:
+            weights[self.weights_filename(checkpoint_hash, 'vae', vae.vae_dtype)] = vae.first_stage_model.state_dict()
+
+        weights = {filename: sd for filename, sd in weights.items() if not os.path.exists(filename)}
+        if len(weights) == 0 and os.path.exists(os.path.join(self.path, checkpoint_hash, 'config.json')):
+            return
+
+        with self.lock:
+            if checkpoint_hash in self.writing:
+                return
+            self.writing.add(checkpoint_hash)
+
+        threading.Thread(target=self.write, args=(checkpoint_hash, config, weights), name='checkpoint_cache',
+                         daemon=True).start()
+
+    def write(self, checkpoint_hash, config, weights):
+        try:
+            os.makedirs(os.path.join(self.path, checkpoint_hash), exist_ok=True)
+            for filename, sd in weights.items():
+                ldm_patched.modules.utils.save_safetensors_streaming(sd, filename + '.tmp')
+                os.replace(filename + '.tmp', filename)
+
+            config_filename = os.path.join(self.path, checkpoint_hash, 'config.json')
+            with open(config_filename + '.tmp', 'wt', encoding='utf-8') as fp:
+                json.dump(config, fp)
+            os.replace(config_filename + '.tmp', config_filename)
+            print(f'[Checkpoint Cache] Cached {checkpoint_hash}.')
+        except Exception as e:
+            print(f'[Checkpoint Cache] Writing {checkpoint_hash} failed: {e}')
+        finally:
+            with self.lock:
+                self.writing.discard(checkpoint_hash)
+
+
+checkpoint_cache = CheckpointCache(path=args_manager.args.checkpoint_cache_path)
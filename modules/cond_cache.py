@@ -0,0 +1,80 @@
+import os
+import hashlib
+
+import safetensors.torch
+
+import args_manager
+from modules.lru_cache import LRUCache
+
+
+class ConditioningCache:
+    """
+    Cache of CLIP conditionings keyed by (CLIP identity, CLIP layer, text).
+
+    The CLIP identity covers the checkpoint and its LoRAs, so entries stay valid across model refreshes.
+    Conditionings are kept in RAM for the max_items most recently used texts and optionally stored as
+    safetensors files in path, which are memory-mapped when read back.
+    """
+
+    def __init__(self, max_items, path=None):
+        self.path = path
+        self.ram = LRUCache(max_size=max_items)
+        self.disk_hits = 0
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.path, hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + '.safetensors')
+
+    def get(self, key):
+        result = self.ram.get(key)
+        if result is not None or self.path is None:
+            return result
+
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            tensors = safetensors.torch.load_file(filename)
+        except Exception as e:
+            print(f'[CLIP Cache] Reading {filename} failed: {e}')
+            return None
+
+        result = tensors['cond'], tensors.get('pooled', None)
+        self.disk_hits += 1
+        self.ram.put(key, result)
+        return result
+
+    def put(self, key, result):
+        self.ram.put(key, result)
+
+        if self.path is None:
+            return
+
+        filename = self.filename(key)
+        if os.path.exists(filename):
+            return
+
+        cond, pooled = result
+        tensors = {'cond': cond.contiguous()}
+        if pooled is not None:
+            tensors['pooled'] = pooled.contiguous()
+
+        try:
+            safetensors.torch.save_file(tensors, filename + '.tmp')
+            os.replace(filename + '.tmp', filename)
+        except Exception as e:
+            print(f'[CLIP Cache] Writing {filename} failed: {e}')
+
+    def clear(self):
+        self.ram.clear()
+
+    def stats(self):
+        stats = self.ram.stats()
+        stats['disk_hits'] = self.disk_hits
+        return stats
+
+
+cond_cache = ConditioningCache(max_items=args_manager.args.clip_cache_size, path=args_manager.args.clip_cache_path)
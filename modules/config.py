@@ -445,6 +445,24 @@ default_output_format = get_config_item_or_set_default(
     validator=lambda x: x in OutputFormat.list(),
     expected_type=str
 )
+default_png_compress_level = get_config_item_or_set_default(
+    key='default_png_compress_level',
+    default_value=6,
+    validator=lambda x: isinstance(x, int) and 0 <= x <= 9,
+    expected_type=int
+)
+default_jpeg_quality = get_config_item_or_set_default(
+    key='default_jpeg_quality',
+    default_value=95,
+    validator=lambda x: isinstance(x, int) and 1 <= x <= 100,
+    expected_type=int
+)
+default_webp_quality = get_config_item_or_set_default(
+    key='default_webp_quality',
+    default_value=95,
+    validator=lambda x: isinstance(x, int) and 1 <= x <= 100,
+    expected_type=int
+)
 default_image_number = get_config_item_or_set_default(
     key='default_image_number',
     default_value=2,
@@ -21,6 +21,9 @@ from modules.lora import match_lora
 from modules.util import get_file_from_folder_list
 from ldm_patched.modules.lora import model_lora_keys_unet, model_lora_keys_clip
 from modules.config import path_embeddings
+from modules.hash_cache import get_cached_hash, get_file_stat, sha256_from_cache_async
+from modules.lora_cache import patched_weights_cache
+from modules.checkpoint_cache import checkpoint_cache
 from ldm_patched.contrib.external_model_advanced import ModelSamplingDiscrete, ModelSamplingContinuousEDM
 
 opEmptyLatentImage = EmptyLatentImage()
@@ -45,6 +48,8 @@ class StableDiffusionModel:
         self.unet_with_lora = unet
         self.clip_with_lora = clip
         self.visited_loras = ''
+        # (file, weight, size, mtime and inode) of the LoRAs applied by the last refresh
+        self.lora_file_stats = ()
 
         self.lora_key_map_unet = {}
         self.lora_key_map_clip = {}
@@ -89,6 +94,7 @@ class StableDiffusionModel:
 
             loras_to_load.append((lora_filename, weight))
 
+        self.lora_file_stats = tuple((f, w, get_file_stat(f)) for f, w in loras_to_load)
         self.unet_with_lora = self.unet.clone() if self.unet is not None else None
         self.clip_with_lora = self.clip.clone() if self.clip is not None else None
 
@@ -121,6 +127,24 @@ class StableDiffusionModel:
                     if item not in loaded_keys:
                         print("CLIP LoRA key skipped: ", item)
 
+        if patched_weights_cache.enabled and len(loras_to_load) > 0:
+            filenames = [self.filename] + [f for f, w in loras_to_load]
+            hashes = [get_cached_hash(f) for f in filenames]
+            if None in hashes:
+                # hashing takes about as long as loading, missing hashes are calculated in the background and the
+                # cache is used by later refreshes
+                for filename, hash_value in zip(filenames, hashes):
+                    if hash_value is None:
+                        sha256_from_cache_async(filename)
+                return
+
+            checkpoint_hash = hashes[0]
+            lora_hashes = tuple((h, w) for h, (f, w) in zip(hashes[1:], loras_to_load))
+            if self.unet_with_lora is not None:
+                self.unet_with_lora.weights_cache_key = (checkpoint_hash, 'unet', lora_hashes)
+            if self.clip_with_lora is not None:
+                self.clip_with_lora.patcher.weights_cache_key = (checkpoint_hash, 'clip', lora_hashes)
+
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -144,8 +168,12 @@ def apply_controlnet(positive, negative, control_net, image, strength, start_per
 @torch.no_grad()
 @torch.inference_mode()
 def load_model(ckpt_filename, vae_filename=None):
-    unet, clip, vae, vae_filename, clip_vision = load_checkpoint_guess_config(ckpt_filename, embedding_directory=path_embeddings,
-                                                                vae_filename_param=vae_filename)
+    if checkpoint_cache.enabled:
+        unet, clip, vae, vae_filename, clip_vision = checkpoint_cache.load(ckpt_filename, embedding_directory=path_embeddings,
+                                                                           vae_filename_param=vae_filename)
+    else:
+        unet, clip, vae, vae_filename, clip_vision = load_checkpoint_guess_config(ckpt_filename, embedding_directory=path_embeddings,
+                                                                                  vae_filename_param=vae_filename)
     return StableDiffusionModel(unet=unet, clip=clip, vae=vae, clip_vision=clip_vision, filename=ckpt_filename, vae_filename=vae_filename)
 
 
@@ -274,10 +302,18 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
 
     if disable_noise:
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
+    elif isinstance(seed, list):
+        # one seed per batch item, each item gets exactly the noise it would get when sampled alone
+        assert len(seed) == latent_image.shape[0]
+        noise = torch.cat([ldm_patched.modules.sample.prepare_noise(latent_image[i:i + 1], s)
+                           for i, s in enumerate(seed)])
     else:
         batch_inds = latent["batch_index"] if "batch_index" in latent else None
         noise = ldm_patched.modules.sample.prepare_noise(latent_image, seed, batch_inds)
 
+    if isinstance(seed, list):
+        seed = seed[0]
+
     if isinstance(noise_mean, torch.Tensor):
         noise = noise + noise_mean - torch.mean(noise, dim=1, keepdim=True)
 
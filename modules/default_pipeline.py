@@ -1,17 +1,22 @@
 import modules.core as core
 import os
+import math
+import time
 import torch
 import modules.patch
 import modules.config
 import modules.flags
 import ldm_patched.modules.model_management
 import ldm_patched.modules.latent_formats
+import args_manager
 import modules.inpaint_worker
 import extras.vae_interpose as vae_interpose
 from extras.expansion import FooocusExpansion
 from ldm_patched.modules.model_base import SDXL, SDXLRefiner
 from modules.util import get_enabled_loras, get_file_from_folder_list, is_json
 from modules.sample_hijack import clip_separate
+from modules.lru_cache import LRUCache
+from modules.cond_cache import cond_cache
 
 
 model_base = core.StableDiffusionModel()
@@ -26,6 +31,33 @@ final_refiner_vae = None
 
 loaded_ControlNets = {}
 
+model_swap_count = 0
+model_swap_time = 0.0
+
+
+def get_model_ram_size(model):
+    patchers = [model.unet]
+    for component in [model.clip, model.vae, model.clip_vision]:
+        if component is not None:
+            patchers.append(component.patcher)
+    return sum(patcher.model_size() for patcher in patchers if patcher is not None)
+
+
+# recently used checkpoints are kept in RAM so switching back to them does not reload from disk
+model_cache = LRUCache(max_size=int(args_manager.args.model_cache_size * 1024 ** 3), size_fn=get_model_ram_size)
+
+
+def load_cached_model(key, loader):
+    model = model_cache.get(key)
+    if model is None:
+        model = loader()
+        model_cache.put(key, model)
+    stats = model_cache.stats()
+    if model_cache.max_size > 0:
+        print(f'[Model Cache] Hits: {stats["hits"]}, misses: {stats["misses"]}, evictions: {stats["evictions"]}, '
+              f'cached: {stats["items"]} models, {stats["size"] / 1024 ** 3:.2f} GB')
+    return model
+
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -70,12 +102,29 @@ def refresh_base_model(name, vae_name=None):
     if model_base.filename == filename and model_base.vae_filename == vae_filename:
         return
 
-    model_base = core.load_model(filename, vae_filename)
+    model_base = load_cached_model(('base', filename, vae_filename), lambda: core.load_model(filename, vae_filename))
     print(f'Base model loaded: {model_base.filename}')
     print(f'VAE loaded: {model_base.vae_filename}')
     return
 
 
+@torch.no_grad()
+@torch.inference_mode()
+def load_refiner_model(filename):
+    model = core.load_model(filename)
+
+    if isinstance(model.unet.model, SDXL):
+        model.clip = None
+        model.vae = None
+    elif isinstance(model.unet.model, SDXLRefiner):
+        model.clip = None
+        model.vae = None
+    else:
+        model.clip = None
+
+    return model
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def refresh_refiner_model(name):
@@ -92,18 +141,8 @@ def refresh_refiner_model(name):
         print(f'Refiner unloaded.')
         return
 
-    model_refiner = core.load_model(filename)
+    model_refiner = load_cached_model(('refiner', filename), lambda: load_refiner_model(filename))
     print(f'Refiner model loaded: {model_refiner.filename}')
-
-    if isinstance(model_refiner.unet.model, SDXL):
-        model_refiner.clip = None
-        model_refiner.vae = None
-    elif isinstance(model_refiner.unet.model, SDXLRefiner):
-        model_refiner.clip = None
-        model_refiner.vae = None
-    else:
-        model_refiner.clip = None
-
     return
 
 
@@ -141,20 +180,42 @@ def refresh_loras(loras, base_model_additional_loras=None):
     return
 
 
+def get_cond_cache_key(clip, text):
+    # embedding files can change without the text changing, so texts using them are not cached
+    if 'embedding:' in text:
+        return None
+    return getattr(clip, 'fcs_cond_identity', id(clip)), clip.layer_idx, text
+
+
 @torch.no_grad()
 @torch.inference_mode()
-def clip_encode_single(clip, text, verbose=False):
-    cached = clip.fcs_cond_cache.get(text, None)
-    if cached is not None:
-        if verbose:
-            print(f'[CLIP Cached] {text}')
-        return cached
-    tokens = clip.tokenize(text)
-    result = clip.encode_from_tokens(tokens, return_pooled=True)
-    clip.fcs_cond_cache[text] = result
-    if verbose:
-        print(f'[CLIP Encoded] {text}')
-    return result
+def clip_encode_batch(clip, texts, max_batch_size=16, verbose=False):
+    # encodes all texts that are not cached yet in batched text encoder passes
+    keys = {text: get_cond_cache_key(clip, text) for text in texts}
+    results = {}
+    uncached = []
+    for text in texts:
+        if text in results or text in uncached:
+            continue
+        cached = cond_cache.get(keys[text]) if keys[text] is not None else None
+        if cached is not None:
+            if verbose:
+                print(f'[CLIP Cached] {text}')
+            results[text] = cached
+        else:
+            uncached.append(text)
+
+    for i in range(0, len(uncached), max_batch_size):
+        batch = uncached[i:i + max_batch_size]
+        encoded = clip.encode_from_tokens_batch([clip.tokenize(text) for text in batch])
+        for text, result in zip(batch, encoded):
+            if keys[text] is not None:
+                cond_cache.put(keys[text], result)
+            results[text] = result
+            if verbose:
+                print(f'[CLIP Encoded] {text}')
+
+    return [results[text] for text in texts]
 
 
 @torch.no_grad()
@@ -179,25 +240,77 @@ def clone_cond(conds):
 @torch.no_grad()
 @torch.inference_mode()
 def clip_encode(texts, pool_top_k=1):
+    return clip_encode_multiple([texts], [pool_top_k])[0]
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def clip_encode_multiple(texts_list, pool_top_k_list):
     global final_clip
 
-    if final_clip is None:
-        return None
-    if not isinstance(texts, list):
+    valid = [final_clip is not None and isinstance(texts, list) and len(texts) > 0 for texts in texts_list]
+    all_texts = [text for texts, is_valid in zip(texts_list, valid) if is_valid for text in texts]
+    encoded = dict(zip(all_texts, clip_encode_batch(final_clip, all_texts))) if len(all_texts) > 0 else {}
+
+    results = []
+    for texts, pool_top_k, is_valid in zip(texts_list, pool_top_k_list, valid):
+        if not is_valid:
+            results.append(None)
+            continue
+
+        cond_list = []
+        pooled_acc = 0
+
+        for i, text in enumerate(texts):
+            cond, pooled = encoded[text]
+            cond_list.append(cond)
+            if i < pool_top_k:
+                pooled_acc += pooled
+
+        results.append([[torch.cat(cond_list, dim=1), {"pooled_output": pooled_acc}]])
+
+    return results
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def stack_conds(conds_list, max_repeat=4):
+    # Merges the single-item conds of several tasks into one cond with a batch dimension.
+    # Cross attention tokens are padded by repeating, which does not change the result,
+    # but too much repeating makes the batch slower than sampling one by one.
+    if any(len(conds) != 1 for conds in conds_list):
         return None
-    if len(texts) == 0:
+
+    lengths = [conds[0][0].shape[1] for conds in conds_list]
+    max_len = math.lcm(*lengths)
+    if max_len // min(lengths) > max_repeat:
         return None
 
     cond_list = []
-    pooled_acc = 0
+    pooled_list = []
 
-    for i, text in enumerate(texts):
-        cond, pooled = clip_encode_single(final_clip, text)
-        cond_list.append(cond)
-        if i < pool_top_k:
-            pooled_acc += pooled
+    for conds in conds_list:
+        c, p = conds[0]
+        cond_list.append(c.repeat(1, max_len // c.shape[1], 1))
+        pooled_list.append(p['pooled_output'])
 
-    return [[torch.cat(cond_list, dim=1), {"pooled_output": pooled_acc}]]
+    return [[torch.cat(cond_list, dim=0), {"pooled_output": torch.cat(pooled_list, dim=0)}]]
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def get_sampling_batch_size(width, height, max_batch_size):
+    device = ldm_patched.modules.model_management.get_torch_device()
+    free_memory = ldm_patched.modules.model_management.get_free_memory(device)
+
+    loaded_models = [x.model for x in ldm_patched.modules.model_management.current_loaded_models]
+    if final_unet not in loaded_models:
+        free_memory -= final_unet.model_size()
+
+    # cond and uncond are evaluated together, so every image counts twice
+    memory_per_image = final_unet.memory_required([2, 4, height // 8, width // 8])
+    batch_size = int(free_memory // memory_per_image)
+    return max(1, min(max_batch_size, batch_size))
 
 
 @torch.no_grad()
@@ -214,7 +327,7 @@ def set_clip_skip(clip_skip: int):
 @torch.no_grad()
 @torch.inference_mode()
 def clear_all_caches():
-    final_clip.fcs_cond_cache = {}
+    cond_cache.clear()
 
 
 @torch.no_grad()
@@ -228,11 +341,33 @@ def prepare_text_encoder(async_call=True):
     return
 
 
+def get_loaded_model_names():
+    return (model_base.filename, model_base.vae_filename, model_base.visited_loras,
+            model_refiner.filename, model_refiner.visited_loras)
+
+
+def get_clip_identity():
+    # conditionings only depend on the checkpoint file and the LoRA files applied to it
+    filename = model_base.filename
+    mtime = os.path.getmtime(filename) if filename is not None and os.path.exists(filename) else None
+    return filename, mtime, model_base.visited_loras, model_base.lora_file_stats
+
+
+def get_average_model_swap_time():
+    if model_swap_count == 0:
+        return 0.0
+    return model_swap_time / model_swap_count
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def refresh_everything(refiner_model_name, base_model_name, loras,
                        base_model_additional_loras=None, use_synthetic_refiner=False, vae_name=None):
     global final_unet, final_clip, final_vae, final_refiner_unet, final_refiner_vae, final_expansion
+    global model_swap_count, model_swap_time
+
+    swap_start_time = time.perf_counter()
+    previous_models = get_loaded_model_names()
 
     final_unet = None
     final_clip = None
@@ -251,8 +386,13 @@ def refresh_everything(refiner_model_name, base_model_name, loras,
     refresh_loras(loras, base_model_additional_loras=base_model_additional_loras)
     assert_model_integrity()
 
+    if previous_models != get_loaded_model_names():
+        model_swap_count += 1
+        model_swap_time += time.perf_counter() - swap_start_time
+
     final_unet = model_base.unet_with_lora
     final_clip = model_base.clip_with_lora
+    final_clip.fcs_cond_identity = get_clip_identity()
     final_vae = model_base.vae
 
     final_refiner_unet = model_refiner.unet_with_lora
@@ -262,7 +402,6 @@ def refresh_everything(refiner_model_name, base_model_name, loras,
         final_expansion = FooocusExpansion()
 
     prepare_text_encoder(async_call=True)
-    clear_all_caches()
     return
 
 
@@ -357,8 +496,13 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
 
     print(f'[Sampler] refiner_swap_method = {refiner_swap_method}')
 
+    batch_size = len(image_seed) if isinstance(image_seed, list) else 1
+
     if latent is None:
-        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=1)
+        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=batch_size)
+    elif latent['samples'].shape[0] != batch_size:
+        initial_latent = latent.copy()
+        initial_latent['samples'] = latent['samples'].repeat(batch_size, 1, 1, 1)
     else:
         initial_latent = latent
 
@@ -491,7 +635,7 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
             negative=clip_separate(negative_cond, target_model=target_model.model, target_clip=target_clip),
             latent=sampled_latent,
             steps=len_sigmas, start_step=0, last_step=len_sigmas, disable_noise=False, force_full_denoise=True,
-            seed=image_seed+1,
+            seed=[x + 1 for x in image_seed] if isinstance(image_seed, list) else image_seed + 1,
             denoise=denoise,
             callback_function=callback,
             cfg=cfg_scale,
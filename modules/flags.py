@@ -61,6 +61,12 @@ SAMPLER_NAMES = KSAMPLER_NAMES + list(SAMPLER_EXTRA.keys())
 sampler_list = SAMPLER_NAMES
 scheduler_list = SCHEDULER_NAMES
 
+# samplers that are either deterministic or draw their noise from the (per-seed) patched brownian tree,
+# so sampling several seeds in one batch yields the same images as sampling them one by one
+batched_sampling_samplers = ["euler", "heun", "heunpp2", "dpm_2", "lms", "dpmpp_sde", "dpmpp_sde_gpu", "dpmpp_2m",
+                             "dpmpp_2m_sde", "dpmpp_2m_sde_gpu", "dpmpp_3m_sde", "dpmpp_3m_sde_gpu", "ddim", "uni_pc",
+                             "uni_pc_bh2"]
+
 clip_skip_max = 12
 
 default_vae = 'Default (model)'
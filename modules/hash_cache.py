@@ -1,61 +1,223 @@
 import json
 import os
-from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from multiprocessing import cpu_count
 
 import args_manager
 from modules.util import sha256, HASH_SHA256_LENGTH, get_file_from_folder_list
 
 hash_cache_filename = 'hash_cache.txt'
+# filepath -> sha256
 hash_cache = {}
+# filepath -> (size, mtime_ns, inode) of the file when it was hashed, None for entries of older cache files
+file_stats = {}
+# (size, mtime_ns, inode) -> sha256, finds renamed files without hashing them again
+stat_hashes = {}
+hash_cache_lock = threading.RLock()
 
+# filepath -> future of a hash which is queued or being calculated
+pending_hashes = {}
+hash_queue = queue.Queue()
+hash_thread = None
 
-def sha256_from_cache(filepath):
-    global hash_cache
-    if filepath not in hash_cache:
+
+def get_file_stat(filepath):
+    try:
+        stat = os.stat(filepath)
+    except (OSError, TypeError, ValueError):
+        return None
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def set_cached_hash(filepath, hash_value, stat):
+    with hash_cache_lock:
+        hash_cache[filepath] = hash_value
+        file_stats[filepath] = stat
+        if stat is not None:
+            stat_hashes[stat] = hash_value
+
+
+def remove_cached_hash(filepath):
+    with hash_cache_lock:
+        hash_cache.pop(filepath, None)
+        file_stats.pop(filepath, None)
+
+
+def get_cached_hash(filepath):
+    """
+    Returns the cached hash of a file or None, one stat call tells whether the file was replaced or renamed.
+    """
+    stat = get_file_stat(filepath)
+
+    with hash_cache_lock:
+        hash_value = hash_cache.get(filepath, None)
+        if stat is None:
+            if hash_value is not None:
+                remove_cached_hash(filepath)
+            return None
+
+        if hash_value is not None:
+            cached_stat = file_stats.get(filepath, None)
+            if cached_stat is None:
+                # entry of an older cache file, trusted as before and validated from now on
+                set_cached_hash(filepath, hash_value, stat)
+                return hash_value
+            if cached_stat == stat:
+                return hash_value
+            print(f'[Cache] {filepath} has changed')
+            remove_cached_hash(filepath)
+
+        hash_value = stat_hashes.get(stat, None)
+        if hash_value is not None:
+            # same file under a new name
+            set_cached_hash(filepath, hash_value, stat)
+            save_cache_to_file(filepath, hash_value)
+        return hash_value
+
+
+def claim(future):
+    # the hash thread and callers waiting for a hash race for queued futures, the winner calculates the hash
+    with hash_cache_lock:
+        if future.running() or future.done():
+            return False
+        return future.set_running_or_notify_cancel()
+
+
+def calculate_hash(filepath, future):
+    try:
+        stat = get_file_stat(filepath)
         print(f"[Cache] Calculating sha256 for {filepath}")
         hash_value = sha256(filepath)
         print(f"[Cache] sha256 for {filepath}: {hash_value}")
-        hash_cache[filepath] = hash_value
+        set_cached_hash(filepath, hash_value, stat)
         save_cache_to_file(filepath, hash_value)
+        future.set_result(hash_value)
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with hash_cache_lock:
+            pending_hashes.pop(filepath, None)
+
+
+def hash_worker():
+    while True:
+        filepath = hash_queue.get()
+        with hash_cache_lock:
+            future = pending_hashes.get(filepath, None)
+        if future is not None and claim(future):
+            calculate_hash(filepath, future)
+        hash_queue.task_done()
+
+
+def sha256_from_cache_async(filepath):
+    """
+    Returns a future of the hash of a file. Files missing from the cache are hashed in a background thread, so
+    callers only wait for the hash when they need it.
+    """
+    global hash_thread
+
+    with hash_cache_lock:
+        hash_value = get_cached_hash(filepath)
+        if hash_value is not None:
+            future = Future()
+            future.set_result(hash_value)
+            return future
+
+        future = pending_hashes.get(filepath, None)
+        if future is None:
+            future = Future()
+            pending_hashes[filepath] = future
+            hash_queue.put(filepath)
+
+        if hash_thread is None:
+            hash_thread = threading.Thread(target=hash_worker, name='hash_cache', daemon=True)
+            hash_thread.start()
+
+    return future
+
+
+def sha256_result(future):
+    # calculate a queued hash in the calling thread instead of waiting for the files queued before it
+    with hash_cache_lock:
+        filepath = next((path for path, pending in pending_hashes.items() if pending is future), None)
+    if filepath is not None and claim(future):
+        calculate_hash(filepath, future)
+    return future.result()
 
-    return hash_cache[filepath]
 
+def sha256_from_cache(filepath):
+    return sha256_result(sha256_from_cache_async(filepath))
 
-def load_cache_from_file():
-    global hash_cache
 
+def load_cache_from_file():
     try:
-        if os.path.exists(hash_cache_filename):
-            with open(hash_cache_filename, 'rt', encoding='utf-8') as fp:
-                for line in fp:
+        if not os.path.exists(hash_cache_filename):
+            return
+
+        with open(hash_cache_filename, 'rt', encoding='utf-8') as fp:
+            for line in fp:
+                try:
                     entry = json.loads(line)
-                    for filepath, hash_value in entry.items():
-                        if not os.path.exists(filepath) or not isinstance(hash_value, str) and len(hash_value) != HASH_SHA256_LENGTH:
-                            print(f'[Cache] Skipping invalid cache entry: {filepath}')
-                            continue
-                        hash_cache[filepath] = hash_value
+                except json.JSONDecodeError:
+                    print(f'[Cache] Skipping invalid cache line: {line.strip()}')
+                    continue
+
+                if 'path' in entry and 'sha256' in entry:
+                    items = [(entry['path'], entry['sha256'],
+                              (entry.get('size'), entry.get('mtime_ns'), entry.get('inode')))]
+                else:
+                    # {filepath: hash} lines written by older versions
+                    items = [(filepath, hash_value, None) for filepath, hash_value in entry.items()]
+
+                for filepath, hash_value, stat in items:
+                    if not isinstance(hash_value, str) or len(hash_value) != HASH_SHA256_LENGTH:
+                        print(f'[Cache] Skipping invalid cache entry: {filepath}')
+                        continue
+                    # files are checked when their hash is requested, not while starting
+                    set_cached_hash(filepath, hash_value, stat)
     except Exception as e:
         print(f'[Cache] Loading failed: {e}')
 
 
 def save_cache_to_file(filename=None, hash_value=None):
-    global hash_cache
+    with hash_cache_lock:
+        if filename is not None and hash_value is not None:
+            items = [(filename, hash_value)]
+            mode = 'at'
+        else:
+            items = sorted(hash_cache.items())
+            mode = 'wt'
+
+        try:
+            with open(hash_cache_filename, mode, encoding='utf-8') as fp:
+                for filepath, hash_value in items:
+                    stat = file_stats.get(filepath, None)
+                    if stat is None:
+                        json.dump({filepath: hash_value}, fp)
+                    else:
+                        size, mtime_ns, inode = stat
+                        json.dump({'path': filepath, 'sha256': hash_value, 'size': size, 'mtime_ns': mtime_ns,
+                                   'inode': inode}, fp)
+                    fp.write('\n')
+        except Exception as e:
+            print(f'[Cache] Saving failed: {e}')
+
+
+def get_filepaths(model_filenames, paths_checkpoints, lora_filenames, paths_loras):
+    return [get_file_from_folder_list(filename, paths_checkpoints) for filename in model_filenames] + \
+        [get_file_from_folder_list(filename, paths_loras) for filename in lora_filenames]
+
+
+def update_cache(filepaths):
+    # drop entries of missing or replaced files, then write the cache again for sorting and cleanup
+    for filepath in list(hash_cache.keys()):
+        get_cached_hash(filepath)
+    save_cache_to_file()
 
-    if filename is not None and hash_value is not None:
-        items = [(filename, hash_value)]
-        mode = 'at'
-    else:
-        items = sorted(hash_cache.items())
-        mode = 'wt'
-
-    try:
-        with open(hash_cache_filename, mode, encoding='utf-8') as fp:
-            for filepath, hash_value in items:
-                json.dump({filepath: hash_value}, fp)
-                fp.write('\n')
-    except Exception as e:
-        print(f'[Cache] Saving failed: {e}')
+    for filepath in filepaths:
+        sha256_from_cache_async(filepath)
 
 
 def init_cache(model_filenames, paths_checkpoints, lora_filenames, paths_loras):
@@ -64,20 +226,18 @@ def init_cache(model_filenames, paths_checkpoints, lora_filenames, paths_loras):
     if args_manager.args.rebuild_hash_cache:
         max_workers = args_manager.args.rebuild_hash_cache if args_manager.args.rebuild_hash_cache > 0 else cpu_count()
         rebuild_cache(lora_filenames, model_filenames, paths_checkpoints, paths_loras, max_workers)
+        save_cache_to_file()
+        return
 
-    # write cache to file again for sorting and cleanup of invalid cache entries
-    save_cache_to_file()
+    # missing hashes are calculated in the background while the UI starts
+    filepaths = get_filepaths(model_filenames, paths_checkpoints, lora_filenames, paths_loras)
+    threading.Thread(target=update_cache, args=(filepaths,), name='hash_cache_update', daemon=True).start()
 
 
 def rebuild_cache(lora_filenames, model_filenames, paths_checkpoints, paths_loras, max_workers=cpu_count()):
-    def thread(filename, paths):
-        filepath = get_file_from_folder_list(filename, paths)
-        sha256_from_cache(filepath)
-
     print('[Cache] Rebuilding hash cache')
+    filepaths = get_filepaths(model_filenames, paths_checkpoints, lora_filenames, paths_loras)
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        for model_filename in model_filenames:
-            executor.submit(thread, model_filename, paths_checkpoints)
-        for lora_filename in lora_filenames:
-            executor.submit(thread, lora_filename, paths_loras)
+        for filepath in filepaths:
+            executor.submit(sha256_from_cache, filepath)
     print('[Cache] Done')
@@ -1,9 +1,8 @@
 import torch
 import numpy as np
 
-from PIL import Image, ImageFilter
+from PIL import Image
 from modules.util import resample_image, set_image_shape_ceil, get_image_shape_ceil
-from modules.upscaler import perform_upscale
 import cv2
 
 
@@ -24,30 +23,24 @@ current_task = None
 
 
 def box_blur(x, k):
-    x = Image.fromarray(x)
-    x = x.filter(ImageFilter.BoxBlur(k))
-    return np.array(x)
+    # same result as PIL ImageFilter.BoxBlur(k): a rounded horizontal and vertical pass with replicated edges
+    x = cv2.blur(x, (2 * k + 1, 1), borderType=cv2.BORDER_REPLICATE)
+    return cv2.blur(x, (1, 2 * k + 1), borderType=cv2.BORDER_REPLICATE)
 
 
-def max_filter_opencv(x, ksize=3):
-    # Use OpenCV maximum filter
-    # Make sure the input type is int16
-    return cv2.dilate(x, np.ones((ksize, ksize), dtype=np.int16))
+def box_blur_pytorch(x, k, dim):
+    # running sums over replicated edges, rounded after each pass like box_blur
+    n = x.shape[dim]
+    index = torch.arange(-k - 1, n + k, device=x.device).clamp_(0, n - 1)
+    x = x.index_select(dim, index).cumsum(dim)
+    return ((x.narrow(dim, 2 * k + 1, n) - x.narrow(dim, 0, n)) / (2 * k + 1)).round_()
 
 
 def morphological_open(x):
-    # Convert array to int16 type via threshold operation
-    x_int16 = np.zeros_like(x, dtype=np.int16)
-    x_int16[x > 127] = 256
-
-    for i in range(32):
-        # Use int16 type to avoid overflow
-        maxed = max_filter_opencv(x_int16, ksize=3) - 8
-        x_int16 = np.maximum(maxed, x_int16)
-
-    # Clip negative values to 0 and convert back to uint8 type
-    x_uint8 = np.clip(x_int16, 0, 255).astype(np.uint8)
-    return x_uint8
+    # 32 iterations of a 3x3 max filter losing 8 per step leave 256 - 8 * (chessboard distance to the mask)
+    distance = cv2.distanceTransform(cv2.threshold(x, 127, 1, cv2.THRESH_BINARY_INV)[1], cv2.DIST_C, 3)
+    np.minimum(distance, 32, out=distance)
+    return cv2.convertScaleAbs(distance, alpha=-8, beta=256)
 
 
 def up255(x, t=0):
@@ -101,6 +94,17 @@ def compute_initial_abcd(x):
     return a, b, c, d
 
 
+def get_grow_steps(lo, hi, n, size):
+    # steps growing [lo, hi) by one pixel on both sides, clamped to [0, n), until it is at least size long
+    length = hi - lo
+    steps_both, steps_all = min(lo, n - hi), max(lo, n - hi)
+    if size <= length:
+        return 0
+    if size <= length + 2 * steps_both:
+        return (size - length + 1) // 2
+    return min(size - length - steps_both, steps_all)
+
+
 def solve_abcd(x, a, b, c, d, k):
     k = float(k)
     assert 0.0 <= k <= 1.0
@@ -108,43 +112,87 @@ def solve_abcd(x, a, b, c, d, k):
     H, W = x.shape[:2]
     if k == 1.0:
         return 0, H, 0, W
-    while True:
-        if b - a >= H * k and d - c >= W * k:
-            break
-
-        add_h = (b - a) < (d - c)
-        add_w = not add_h
-
-        if b - a == H:
-            add_w = True
 
-        if d - c == W:
-            add_h = True
-
-        if add_h:
-            a -= 1
-            b += 1
-
-        if add_w:
-            c -= 1
-            d += 1
+    # the box grows its shorter side (the width on ties) one step at a time until it covers k of the image,
+    # so the steps are ordered by the length they start from and all steps starting below a length can be
+    # taken at once
+    def grow(height_steps, width_steps):
+        return max(a - height_steps, 0), min(b + height_steps, H), max(c - width_steps, 0), min(d + width_steps, W)
+
+    def is_large_enough(box):
+        return box[1] - box[0] >= H * k and box[3] - box[2] >= W * k
+
+    low, high = 0, max(H, W) + 1
+    while low < high:
+        middle = (low + high) // 2
+        if is_large_enough(grow(get_grow_steps(a, b, H, middle), get_grow_steps(c, d, W, middle))):
+            high = middle
+        else:
+            low = middle + 1
+
+    if low == 0:
+        return a, b, c, d
+
+    # at the length found, the width step comes before the height step
+    box = grow(get_grow_steps(a, b, H, low - 1), get_grow_steps(c, d, W, low))
+    if not is_large_enough(box):
+        box = grow(get_grow_steps(a, b, H, low), get_grow_steps(c, d, W, low))
+    return tuple(int(v) for v in box)
+
+
+fill_passes = [(512, 2), (256, 2), (128, 4), (64, 4), (33, 8), (15, 8), (5, 16), (3, 16)]
+
+
+def fooocus_fill(image, mask, device=None):
+    """
+    Fills the masked area by blurring the image again and again while keeping the unmasked pixels. Only the
+    masked area and the pixels within the blur radius around it are processed, with pytorch when a device is
+    given and with OpenCV otherwise.
+    """
+    known = mask < 127
+    rows, columns = np.flatnonzero(~known.all(axis=1)), np.flatnonzero(~known.all(axis=0))
+    if len(rows) == 0:
+        return image.copy()
+
+    H, W = known.shape
+    a, b, c, d = rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+
+    if device is not None:
+        current_image = torch.from_numpy(image).to(device=device, dtype=torch.float32)
+        raw_image = current_image.clone()
+        known = torch.from_numpy(known).to(device)[:, :, None]
+    else:
+        current_image = image.copy()
+        raw_image = image
+        known = np.repeat(known[:, :, None], image.shape[2], axis=2)
+
+    for k, repeats in fill_passes:
+        # blurred pixels further away from the masked area are replaced by the image again
+        area = slice(max(a - k, 0), min(b + k, H)), slice(max(c - k, 0), min(d + k, W))
+        current_area, raw_area, known_area = current_image[area], raw_image[area], known[area]
+        for _ in range(repeats):
+            if device is not None:
+                current_area = box_blur_pytorch(box_blur_pytorch(current_area, k, 1), k, 0)
+                current_area = torch.where(known_area, raw_area, current_area)
+            else:
+                current_area = box_blur(current_area, k)
+                np.copyto(current_area, raw_area, where=known_area)
+        current_image[area] = current_area
 
-        a, b, c, d = regulate_abcd(x, a, b, c, d)
-    return a, b, c, d
+    if device is not None:
+        return current_image.to(torch.uint8).cpu().numpy()
 
+    return current_image
 
-def fooocus_fill(image, mask):
-    current_image = image.copy()
-    raw_image = image.copy()
-    area = np.where(mask < 127)
-    store = raw_image[area]
 
-    for k, repeats in [(512, 2), (256, 2), (128, 4), (64, 4), (33, 8), (15, 8), (5, 16), (3, 16)]:
-        for _ in range(repeats):
-            current_image = box_blur(current_image, k)
-            current_image[area] = store
+def get_fill_device():
+    # pytorch only pays off on gpus, OpenCV is faster on the cpu
+    import ldm_patched.modules.model_management as model_management
 
-    return current_image
+    device = model_management.get_torch_device()
+    if device.type == 'cpu' or model_management.directml_enabled:
+        return None
+    return device
 
 
 class InpaintWorker:
@@ -159,6 +207,7 @@ class InpaintWorker:
 
         # super resolution
         if get_image_shape_ceil(self.interested_image) < 1024:
+            from modules.upscaler import perform_upscale
             self.interested_image = perform_upscale(self.interested_image)
 
         # resize to make images ready for diffusion
@@ -171,7 +220,7 @@ class InpaintWorker:
 
         # compute filling
         if use_fill:
-            self.interested_fill = fooocus_fill(self.interested_image, self.interested_mask)
+            self.interested_fill = fooocus_fill(self.interested_image, self.interested_mask, device=get_fill_device())
 
         # soft pixels
         self.mask = morphological_open(mask)
@@ -0,0 +1,80 @@
+import os
+import hashlib
+
+import safetensors.torch
+
+import args_manager
+from modules.lru_cache import LRUCache
+
+
+class PatchedWeightsCache:
+    """
+    Cache of model weights with LoRAs already merged, so repeated LoRA combinations skip the patch math.
+
+    Weight sets are kept in RAM up to max_size bytes. Evicted sets are written as safetensors files to path
+    and loaded from there on the next request.
+    """
+
+    def __init__(self, max_size, path=None):
+        self.path = path
+        self.ram = LRUCache(max_size=max_size, size_fn=self.weights_size, on_evict=self.spill)
+        self.disk_hits = 0
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.ram.max_size > 0
+
+    @staticmethod
+    def weights_size(weights):
+        return sum(w.nelement() * w.element_size() for w in weights.values())
+
+    def filename(self, key):
+        return os.path.join(self.path, hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + '.safetensors')
+
+    def spill(self, key, weights):
+        if self.path is None:
+            return
+
+        filename = self.filename(key)
+        if os.path.exists(filename):
+            return
+
+        try:
+            safetensors.torch.save_file({k: w.contiguous() for k, w in weights.items()}, filename + '.tmp')
+            os.replace(filename + '.tmp', filename)
+        except Exception as e:
+            print(f'[LoRA Cache] Writing {filename} failed: {e}')
+
+    def get(self, key):
+        weights = self.ram.get(key)
+        if weights is not None or self.path is None:
+            return weights
+
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            weights = safetensors.torch.load_file(filename)
+        except Exception as e:
+            print(f'[LoRA Cache] Reading {filename} failed: {e}')
+            return None
+
+        self.disk_hits += 1
+        self.ram.put(key, weights)
+        return weights
+
+    def put(self, key, weights):
+        self.ram.put(key, weights)
+
+    def stats(self):
+        stats = self.ram.stats()
+        stats['disk_hits'] = self.disk_hits
+        return stats
+
+
+patched_weights_cache = PatchedWeightsCache(max_size=int(args_manager.args.lora_cache_size * 1024 ** 3),
+                                            path=args_manager.args.lora_cache_path)
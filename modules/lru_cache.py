@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache.
+
+    The cache holds at most max_size units, where the size of an item is given by size_fn (1 per item by default).
+    Items larger than max_size are not kept. A max_size of 0 or less disables the cache.
+    """
+
+    def __init__(self, max_size, size_fn=None, on_evict=None):
+        self.max_size = max_size
+        self.size_fn = size_fn
+        self.on_evict = on_evict
+        self.lock = threading.RLock()
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.total_size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        size = self.size_fn(value) if self.size_fn is not None else 1
+        if size > self.max_size:
+            # never kept, so it must not evict the items which fit
+            return
+
+        evicted = []
+        with self.lock:
+            if key in self.items:
+                self.total_size -= self.sizes.pop(key)
+                del self.items[key]
+
+            self.items[key] = value
+            self.sizes[key] = size
+            self.total_size += size
+
+            while self.total_size > self.max_size and len(self.items) > 0:
+                evicted_key, evicted_value = self.items.popitem(last=False)
+                self.total_size -= self.sizes.pop(evicted_key)
+                self.evictions += 1
+                evicted.append((evicted_key, evicted_value))
+
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.total_size -= self.sizes.pop(key)
+            return self.items.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.total_size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self.items),
+                'size': self.total_size
+            }
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
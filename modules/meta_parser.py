@@ -1,6 +1,7 @@
 import json
 import re
 from abc import ABC, abstractmethod
+from concurrent.futures import Future
 from pathlib import Path
 
 import gradio as gr
@@ -11,7 +12,7 @@ import modules.config
 import modules.sdxl_styles
 from modules.flags import MetadataScheme, Performance, Steps
 from modules.flags import SAMPLERS, CIVITAI_NO_KARRAS
-from modules.hash_cache import sha256_from_cache
+from modules.hash_cache import sha256_from_cache_async, sha256_result
 from modules.util import quote, unquote, extract_styles_from_prompt, is_json, get_file_from_folder_list
 
 re_param_code = r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)'
@@ -302,6 +303,15 @@ class MetadataParser(ABC):
     def to_string(self, metadata: dict) -> str:
         raise NotImplementedError
 
+    def resolve_hashes(self):
+        # set_data only queues hashes of files missing from the hash cache, they are awaited when writing metadata
+        if isinstance(self.base_model_hash, Future):
+            self.base_model_hash = sha256_result(self.base_model_hash)
+        if isinstance(self.refiner_model_hash, Future):
+            self.refiner_model_hash = sha256_result(self.refiner_model_hash)
+        self.loras = [(lora_name, lora_weight, sha256_result(lora_hash) if isinstance(lora_hash, Future) else lora_hash)
+                      for lora_name, lora_weight, lora_hash in self.loras]
+
     def set_data(self, raw_prompt, full_prompt, raw_negative_prompt, full_negative_prompt, steps, base_model_name,
                  refiner_model_name, loras, vae_name):
         self.raw_prompt = raw_prompt
@@ -312,18 +322,18 @@ class MetadataParser(ABC):
         self.base_model_name = Path(base_model_name).stem
 
         base_model_path = get_file_from_folder_list(base_model_name, modules.config.paths_checkpoints)
-        self.base_model_hash = sha256_from_cache(base_model_path)
+        self.base_model_hash = sha256_from_cache_async(base_model_path)
 
         if refiner_model_name not in ['', 'None']:
             self.refiner_model_name = Path(refiner_model_name).stem
             refiner_model_path = get_file_from_folder_list(refiner_model_name, modules.config.paths_checkpoints)
-            self.refiner_model_hash = sha256_from_cache(refiner_model_path)
+            self.refiner_model_hash = sha256_from_cache_async(refiner_model_path)
 
         self.loras = []
         for (lora_name, lora_weight) in loras:
             if lora_name != 'None':
                 lora_path = get_file_from_folder_list(lora_name, modules.config.paths_loras)
-                lora_hash = sha256_from_cache(lora_path)
+                lora_hash = sha256_from_cache_async(lora_path)
                 self.loras.append((Path(lora_name).stem, lora_weight, lora_hash))
         self.vae_name = Path(vae_name).stem
 
@@ -457,6 +467,7 @@ class A1111MetadataParser(MetadataParser):
         return data
 
     def to_string(self, metadata: dict) -> str:
+        self.resolve_hashes()
         data = {k: v for _, k, v in metadata}
 
         width, height = eval(data['resolution'])
@@ -552,6 +563,7 @@ class FooocusMetadataParser(MetadataParser):
         return metadata
 
     def to_string(self, metadata: list) -> str:
+        self.resolve_hashes()
         for li, (label, key, value) in enumerate(metadata):
             # remove model folder paths from metadata
             if key.startswith('lora_combined_'):
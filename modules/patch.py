@@ -15,12 +15,15 @@ import ldm_patched.ldm.modules.diffusionmodules.model
 import ldm_patched.modules.sd
 import ldm_patched.controlnet.cldm
 import ldm_patched.modules.model_patcher
+import ldm_patched.modules.utils
 import ldm_patched.modules.samplers
 import ldm_patched.modules.args_parser
 import warnings
 import safetensors.torch
 import modules.constants as constants
 
+from modules.lora_cache import patched_weights_cache
+
 from ldm_patched.modules.samplers import calc_cond_uncond_batch
 from ldm_patched.k_diffusion.sampling import BatchedBrownianTree
 from ldm_patched.ldm.modules.diffusionmodules.openaimodel import forward_timestep_embed, apply_control
@@ -45,6 +48,12 @@ class PatchSettings:
         self.global_diffusion_progress = 0
         self.eps_record = None
 
+        # host-side progress of every planned model evaluation, avoids reading the timestep back from the device
+        self.progress_sigmas = None
+        self.progress_callback_evaluations = None
+        self.progress_schedule = None
+        self.progress_evaluation = 0
+
 
 patch_settings = {}
 
@@ -223,8 +232,65 @@ def compute_cfg(uncond, cond, cfg_scale, t):
         return real_eps
 
 
+def diffusion_progress(model, sigma):
+    # same value as current_step computed in the UNet from the timestep of sigma, in the dtype the UNet runs in
+    dtype = getattr(model, 'manual_cast_dtype', None) or model.get_dtype()
+    timesteps = model.model_sampling.timestep(sigma).float()
+    return 1.0 - timesteps.to(dtype) / 999.0
+
+
+def set_progress_schedule(model, evaluation_sigmas, callback_evaluations):
+    """
+    Takes the sigma of every model evaluation of a sampling run and the number of evaluations before every sampler
+    callback, both planned on the host. Model evaluations then look their progress up by a host-side index.
+    """
+    settings = patch_settings[os.getpid()]
+    settings.progress_sigmas = evaluation_sigmas
+    settings.progress_callback_evaluations = callback_evaluations
+    settings.progress_evaluation = 0
+    set_progress_model(model)
+
+
+def set_progress_model(model):
+    # one readback per sampling run and refiner swap
+    settings = patch_settings[os.getpid()]
+    if settings.progress_sigmas is None or len(settings.progress_sigmas) == 0:
+        settings.progress_schedule = None
+        return
+    sigmas = torch.tensor(settings.progress_sigmas, dtype=torch.float32, device=model.model_sampling.sigmas.device)
+    settings.progress_schedule = diffusion_progress(model, sigmas).float().cpu().tolist()
+
+
+def advance_progress_schedule(step):
+    # the sampler loop tells how many evaluations were done so far, which keeps the index in line with the plan
+    settings = patch_settings[os.getpid()]
+    if settings.progress_callback_evaluations is not None and step in settings.progress_callback_evaluations:
+        settings.progress_evaluation = settings.progress_callback_evaluations[step]
+
+
+def clear_progress_schedule():
+    settings = patch_settings[os.getpid()]
+    settings.progress_sigmas = None
+    settings.progress_callback_evaluations = None
+    settings.progress_schedule = None
+
+
+def get_diffusion_progress(model, sigma):
+    settings = patch_settings[os.getpid()]
+    schedule = settings.progress_schedule
+    evaluation = settings.progress_evaluation
+    settings.progress_evaluation += 1
+
+    if schedule is not None and evaluation < len(schedule):
+        return schedule[evaluation]
+
+    # samplers whose evaluations cannot be planned, like dpm_adaptive
+    return float(diffusion_progress(model, sigma).float().cpu().numpy().tolist()[0])
+
+
 def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, model_options=None, seed=None):
     pid = os.getpid()
+    patch_settings[pid].global_diffusion_progress = get_diffusion_progress(model, timestep)
 
     if math.isclose(cond_scale, 1.0) and not model_options.get("disable_cfg1_optimization", False):
         final_x0 = calc_cond_uncond_batch(model, cond, None, x, timestep, model_options)[0]
@@ -375,7 +441,6 @@ def patched_cldm_forward(self, x, hint, timesteps, context, y=None, **kwargs):
 
 def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=None, transformer_options={}, **kwargs):
     self.current_step = 1.0 - timesteps.to(x) / 999.0
-    patch_settings[os.getpid()].global_diffusion_progress = float(self.current_step.detach().cpu().numpy().tolist()[0])
 
     y = timed_adm(y, timesteps)
 
@@ -485,6 +550,45 @@ def build_loaded(module, loader_name):
     return
 
 
+def patch_model_patched(self, device_to=None, patch_weights=True):
+    cache_key = self.weights_cache_key
+    if not patch_weights or cache_key is None or not patched_weights_cache.enabled:
+        return ldm_patched.modules.model_patcher.ModelPatcher.patch_model_origin(self, device_to, patch_weights)
+
+    weights = patched_weights_cache.get(cache_key)
+
+    if weights is None:
+        model = ldm_patched.modules.model_patcher.ModelPatcher.patch_model_origin(self, device_to, patch_weights)
+        model_sd = self.model_state_dict()
+        patched_weights_cache.put(cache_key, {k: model_sd[k].to('cpu', copy=True) for k in self.patches if k in model_sd})
+        return model
+
+    # object patches only, the merged weights are taken from the cache
+    ldm_patched.modules.model_patcher.ModelPatcher.patch_model_origin(self, device_to, patch_weights=False)
+
+    model_sd = self.model_state_dict()
+    for key, cached_weight in weights.items():
+        if key not in model_sd:
+            continue
+
+        weight = model_sd[key]
+
+        if key not in self.backup:
+            self.backup[key] = weight.to(device=self.offload_device, copy=self.weight_inplace_update)
+
+        out_weight = cached_weight.to(device=weight.device if device_to is None else device_to, dtype=weight.dtype)
+        if self.weight_inplace_update:
+            ldm_patched.modules.utils.copy_to_param(self.model, key, out_weight)
+        else:
+            ldm_patched.modules.utils.set_attr(self.model, key, out_weight)
+
+    if device_to is not None:
+        self.model.to(device_to)
+        self.current_device = device_to
+
+    return self.model
+
+
 def patch_all():
     if ldm_patched.modules.model_management.directml_enabled:
         ldm_patched.modules.model_management.lowvram_available = True
@@ -496,7 +600,11 @@ def patch_all():
     if not hasattr(ldm_patched.modules.model_management, 'load_models_gpu_origin'):
         ldm_patched.modules.model_management.load_models_gpu_origin = ldm_patched.modules.model_management.load_models_gpu
 
+    if not hasattr(ldm_patched.modules.model_patcher.ModelPatcher, 'patch_model_origin'):
+        ldm_patched.modules.model_patcher.ModelPatcher.patch_model_origin = ldm_patched.modules.model_patcher.ModelPatcher.patch_model
+
     ldm_patched.modules.model_management.load_models_gpu = patched_load_models_gpu
+    ldm_patched.modules.model_patcher.ModelPatcher.patch_model = patch_model_patched
     ldm_patched.modules.model_patcher.ModelPatcher.calculate_weight = calculate_weight_patched
     ldm_patched.controlnet.cldm.ControlNet.forward = patched_cldm_forward
     ldm_patched.ldm.modules.diffusionmodules.openaimodel.UNetModel.forward = patched_unet_forward
@@ -15,6 +15,7 @@ import ldm_patched.modules.model_patcher
 import ldm_patched.modules.samplers
 import ldm_patched.modules.sd
 import ldm_patched.modules.sd1_clip
+import ldm_patched.modules.sdxl_clip
 import ldm_patched.modules.clip_vision
 import ldm_patched.modules.ops as ops
 
@@ -23,43 +24,81 @@ from transformers import CLIPTextModel, CLIPTextConfig, modeling_utils, CLIPVisi
 
 
 def patched_encode_token_weights(self, token_weight_pairs):
+    return patched_encode_token_weights_batch(self, [token_weight_pairs])[0]
+
+
+def patched_encode_token_weights_batch(self, token_weight_pairs_list):
+    # all sections of all prompts go through the text encoder as one batch
     to_encode = list()
+    sections = list()
     max_token_len = 0
     has_weights = False
-    for x in token_weight_pairs:
-        tokens = list(map(lambda a: a[0], x))
-        max_token_len = max(len(tokens), max_token_len)
-        has_weights = has_weights or not all(map(lambda a: a[1] == 1.0, x))
-        to_encode.append(tokens)
-
-    sections = len(to_encode)
-    if has_weights or sections == 0:
+    for token_weight_pairs in token_weight_pairs_list:
+        sections.append(len(token_weight_pairs))
+        for x in token_weight_pairs:
+            tokens = list(map(lambda a: a[0], x))
+            max_token_len = max(len(tokens), max_token_len)
+            has_weights = has_weights or not all(map(lambda a: a[1] == 1.0, x))
+            to_encode.append(tokens)
+
+    if has_weights or 0 in sections:
         to_encode.append(ldm_patched.modules.sd1_clip.gen_empty_tokens(self.special_tokens, max_token_len))
 
     out, pooled = self.encode(to_encode)
-    if pooled is not None:
-        first_pooled = pooled[0:1].to(ldm_patched.modules.model_management.intermediate_device())
+
+    results = []
+    offset = 0
+    for token_weight_pairs, section_count in zip(token_weight_pairs_list, sections):
+        if pooled is not None:
+            first_pooled = pooled[offset:offset + 1].to(ldm_patched.modules.model_management.intermediate_device())
+        else:
+            first_pooled = pooled
+
+        prompt_has_weights = any(not all(map(lambda a: a[1] == 1.0, x)) for x in token_weight_pairs)
+
+        output = []
+        for k in range(0, section_count):
+            z = out[offset + k:offset + k + 1]
+            if prompt_has_weights:
+                original_mean = z.mean()
+                z_empty = out[-1]
+                for i in range(len(z)):
+                    for j in range(len(z[i])):
+                        weight = token_weight_pairs[k][j][1]
+                        if weight != 1.0:
+                            z[i][j] = (z[i][j] - z_empty[j]) * weight + z_empty[j]
+                new_mean = z.mean()
+                z = z * (original_mean / new_mean)
+            output.append(z)
+        offset += section_count
+
+        if len(output) == 0:
+            results.append((out[-1:].to(ldm_patched.modules.model_management.intermediate_device()), first_pooled))
+        else:
+            results.append((torch.cat(output, dim=-2).to(ldm_patched.modules.model_management.intermediate_device()), first_pooled))
+
+    return results
+
+
+def patched_SD1ClipModel_encode_token_weights_batch(self, token_weight_pairs_list):
+    return getattr(self, self.clip).encode_token_weights_batch([x[self.clip_name] for x in token_weight_pairs_list])
+
+
+def patched_SDXLClipModel_encode_token_weights_batch(self, token_weight_pairs_list):
+    g_results = self.clip_g.encode_token_weights_batch([x["g"] for x in token_weight_pairs_list])
+    l_results = self.clip_l.encode_token_weights_batch([x["l"] for x in token_weight_pairs_list])
+    return [(torch.cat([l_out, g_out], dim=-1), g_pooled) for (g_out, g_pooled), (l_out, l_pooled) in zip(g_results, l_results)]
+
+
+def patched_CLIP_encode_from_tokens_batch(self, tokens_list):
+    # same as encode_from_tokens(tokens, return_pooled=True) for each item, in a single text encoder pass
+    if self.layer_idx is not None:
+        self.cond_stage_model.clip_layer(self.layer_idx)
     else:
-        first_pooled = pooled
-
-    output = []
-    for k in range(0, sections):
-        z = out[k:k + 1]
-        if has_weights:
-            original_mean = z.mean()
-            z_empty = out[-1]
-            for i in range(len(z)):
-                for j in range(len(z[i])):
-                    weight = token_weight_pairs[k][j][1]
-                    if weight != 1.0:
-                        z[i][j] = (z[i][j] - z_empty[j]) * weight + z_empty[j]
-            new_mean = z.mean()
-            z = z * (original_mean / new_mean)
-        output.append(z)
-
-    if len(output) == 0:
-        return out[-1:].to(ldm_patched.modules.model_management.intermediate_device()), first_pooled
-    return torch.cat(output, dim=-2).to(ldm_patched.modules.model_management.intermediate_device()), first_pooled
+        self.cond_stage_model.reset_clip_layer()
+
+    self.load_model()
+    return self.cond_stage_model.encode_token_weights_batch(tokens_list)
 
 
 def patched_SDClipModel__init__(self, max_length=77, freeze=True, layer="last", layer_idx=None,
@@ -188,6 +227,10 @@ def patched_ClipVisionModel_encode_image(self, image):
 
 def patch_all_clip():
     ldm_patched.modules.sd1_clip.ClipTokenWeightEncoder.encode_token_weights = patched_encode_token_weights
+    ldm_patched.modules.sd1_clip.ClipTokenWeightEncoder.encode_token_weights_batch = patched_encode_token_weights_batch
+    ldm_patched.modules.sd1_clip.SD1ClipModel.encode_token_weights_batch = patched_SD1ClipModel_encode_token_weights_batch
+    ldm_patched.modules.sdxl_clip.SDXLClipModel.encode_token_weights_batch = patched_SDXLClipModel_encode_token_weights_batch
+    ldm_patched.modules.sd.CLIP.encode_from_tokens_batch = patched_CLIP_encode_from_tokens_batch
     ldm_patched.modules.sd1_clip.SDClipModel.__init__ = patched_SDClipModel__init__
     ldm_patched.modules.sd1_clip.SDClipModel.forward = patched_SDClipModel_forward
     ldm_patched.modules.clip_vision.ClipVisionModel.__init__ = patched_ClipVisionModel__init__
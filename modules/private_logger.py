@@ -1,16 +1,31 @@
 import os
+import queue
+import atexit
+import threading
 import args_manager
 import modules.config
 import json
 import urllib.parse
 
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 from modules.flags import OutputFormat
 from modules.meta_parser import MetadataParser, get_exif
 from modules.util import generate_temp_filename
 
-log_cache = {}
+log_files = set()
+log_queue = queue.Queue()
+
+# entries are appended after this marker, older logs were rewritten between two split markers
+append_marker = '<!--fooocus-log-append-->'
+split_marker = '<!--fooocus-log-split-->'
+
+image_writer = ThreadPoolExecutor(max_workers=args_manager.args.image_writer_threads, thread_name_prefix='image_writer')
+# blocks the worker when encoding falls behind so frames do not pile up in RAM
+image_writer_slots = threading.BoundedSemaphore(args_manager.args.max_pending_images)
+pending_images = {}
+pending_images_lock = threading.Lock()
 
 
 def get_current_html_path(output_format=None):
@@ -21,29 +36,87 @@ def get_current_html_path(output_format=None):
     return html_name
 
 
-def log(img, metadata, metadata_parser: MetadataParser | None = None, output_format=None, task=None, persist_image=True) -> str:
-    path_outputs = modules.config.temp_path if args_manager.args.disable_image_log or not persist_image else modules.config.path_outputs
-    output_format = output_format if output_format else modules.config.default_output_format
-    date_string, local_temp_filename, only_name = generate_temp_filename(folder=path_outputs, extension=output_format)
-    os.makedirs(os.path.dirname(local_temp_filename), exist_ok=True)
-
-    parsed_parameters = metadata_parser.to_string(metadata.copy()) if metadata_parser is not None else ''
+def save_image(img, filename, output_format, parsed_parameters='', metadata_scheme=None):
     image = Image.fromarray(img)
+    if callable(parsed_parameters):
+        try:
+            parsed_parameters = parsed_parameters()
+        except Exception as e:
+            print(f'[Private Log] Creating metadata for {filename} failed: {e}')
+            parsed_parameters = ''
 
     if output_format == OutputFormat.PNG.value:
         if parsed_parameters != '':
             pnginfo = PngInfo()
             pnginfo.add_text('parameters', parsed_parameters)
-            pnginfo.add_text('fooocus_scheme', metadata_parser.get_scheme().value)
+            pnginfo.add_text('fooocus_scheme', metadata_scheme)
         else:
             pnginfo = None
-        image.save(local_temp_filename, pnginfo=pnginfo)
+        image.save(filename, pnginfo=pnginfo, compress_level=modules.config.default_png_compress_level)
     elif output_format == OutputFormat.JPEG.value:
-        image.save(local_temp_filename, quality=95, optimize=True, progressive=True, exif=get_exif(parsed_parameters, metadata_parser.get_scheme().value) if metadata_parser else Image.Exif())
+        image.save(filename, quality=modules.config.default_jpeg_quality, optimize=True, progressive=True, exif=get_exif(parsed_parameters, metadata_scheme) if metadata_scheme else Image.Exif())
     elif output_format == OutputFormat.WEBP.value:
-        image.save(local_temp_filename, quality=95, lossless=False, exif=get_exif(parsed_parameters, metadata_parser.get_scheme().value) if metadata_parser else Image.Exif())
+        image.save(filename, quality=modules.config.default_webp_quality, lossless=False, exif=get_exif(parsed_parameters, metadata_scheme) if metadata_scheme else Image.Exif())
     else:
-        image.save(local_temp_filename)
+        image.save(filename)
+
+    return filename
+
+
+def save_image_async(img, filename, output_format, parsed_parameters='', metadata_scheme=None):
+    image_writer_slots.acquire()
+    try:
+        future = image_writer.submit(save_image, img, filename, output_format, parsed_parameters, metadata_scheme)
+    except:
+        image_writer_slots.release()
+        raise
+
+    with pending_images_lock:
+        pending_images[filename] = future
+
+    def done(_):
+        with pending_images_lock:
+            pending_images.pop(filename, None)
+        image_writer_slots.release()
+
+    future.add_done_callback(done)
+    return future
+
+
+def wait_for_images(paths):
+    """
+    Blocks until images written by log(..., blocking=False) are on disk, paths may also contain other results.
+    """
+    for path in paths:
+        if not isinstance(path, str):
+            continue
+        with pending_images_lock:
+            future = pending_images.get(path, None)
+        if future is None:
+            continue
+        try:
+            future.result()
+        except Exception as e:
+            print(f'[Private Log] Saving {path} failed: {e}')
+
+
+def log(img, metadata, metadata_parser: MetadataParser | None = None, output_format=None, task=None, persist_image=True, blocking=True) -> str:
+    path_outputs = modules.config.temp_path if args_manager.args.disable_image_log or not persist_image else modules.config.path_outputs
+    output_format = output_format if output_format else modules.config.default_output_format
+    date_string, local_temp_filename, only_name = generate_temp_filename(folder=path_outputs, extension=output_format)
+    os.makedirs(os.path.dirname(local_temp_filename), exist_ok=True)
+
+    parsed_parameters = ''
+    if metadata_parser is not None:
+        # the image writer waits for model hashes still being calculated instead of the worker
+        metadata_copy = metadata.copy()
+        parsed_parameters = lambda: metadata_parser.to_string(metadata_copy)
+    metadata_scheme = metadata_parser.get_scheme().value if metadata_parser is not None else None
+
+    # the frame is encoded in the background, blocking only waits for it
+    future = save_image_async(img.copy(), local_temp_filename, output_format, parsed_parameters, metadata_scheme)
+    if blocking:
+        future.result()
 
     if args_manager.args.disable_image_log:
         return local_temp_filename
@@ -61,6 +134,7 @@ def log(img, metadata, metadata_parser: MetadataParser | None = None, output_for
         ".image-container img { height: auto; max-width: 512px; display: block; padding-right:10px; } "
         ".image-container div { text-align: center; padding: 4px; } "
         "hr { border-color: gray; } "
+        ".log-entries { display: flex; flex-direction: column-reverse; } "
         "button { background-color: black; color: white; border: 1px solid grey; border-radius: 5px; padding: 5px 10px; text-align: center; display: inline-block; font-size: 16px; cursor: pointer; }"
         "button:hover {background-color: grey; color: black;}"
         "</style>"
@@ -91,18 +165,8 @@ def log(img, metadata, metadata_parser: MetadataParser | None = None, output_for
         </script>"""
     )
 
-    begin_part = f"<!DOCTYPE html><html><head><title>Fooocus Log {date_string}</title>{css_styles}</head><body>{js}<p>Fooocus Log {date_string} (private)</p>\n<p>Metadata is embedded if enabled in the config or developer debug mode. You can find the information for each image in line Metadata Scheme.</p><!--fooocus-log-split-->\n\n"
-    end_part = f'\n<!--fooocus-log-split--></body></html>'
-
-    middle_part = log_cache.get(html_name, "")
-
-    if middle_part == "":
-        if os.path.exists(html_name):
-            existing_split = open(html_name, 'r', encoding='utf-8').read().split('<!--fooocus-log-split-->')
-            if len(existing_split) == 3:
-                middle_part = existing_split[1]
-            else:
-                middle_part = existing_split[0]
+    # the entries container is left open, new entries are appended to the file and shown on top
+    begin_part = f"<!DOCTYPE html><html><head><title>Fooocus Log {date_string}</title>{css_styles}</head><body>{js}<p>Fooocus Log {date_string} (private)</p>\n<p>Metadata is embedded if enabled in the config or developer debug mode. You can find the information for each image in line Metadata Scheme.</p>{append_marker}\n<div class=\"log-entries\">\n\n"
 
     div_name = only_name.replace('.', '_')
     full_image_path = os.path.abspath(local_temp_filename).replace('\\', '/')
@@ -128,13 +192,43 @@ def log(img, metadata, metadata_parser: MetadataParser | None = None, output_for
     item += "</td>"
     item += "</tr></table></div>\n\n"
 
-    middle_part = item + middle_part
-
-    with open(html_name, 'w', encoding='utf-8') as f:
-        f.write(begin_part + middle_part + end_part)
+    log_queue.put((html_name, begin_part, item))
 
     print(f'Image generated with private log at: {html_name}')
 
-    log_cache[html_name] = middle_part
-
     return local_temp_filename
+
+
+def append_to_html(html_name, begin_part, item):
+    if html_name not in log_files:
+        if not os.path.exists(html_name):
+            with open(html_name, 'w', encoding='utf-8') as f:
+                f.write(begin_part)
+        else:
+            with open(html_name, 'r', encoding='utf-8') as f:
+                content = f.read()
+            if append_marker not in content:
+                # convert a log written by older versions once, its entries stay below the new ones
+                existing_split = content.split(split_marker)
+                middle_part = existing_split[1] if len(existing_split) == 3 else existing_split[0]
+                with open(html_name, 'w', encoding='utf-8') as f:
+                    f.write(begin_part + f'<div>{middle_part}</div>\n\n')
+        log_files.add(html_name)
+
+    with open(html_name, 'a', encoding='utf-8') as f:
+        f.write(item)
+
+
+def log_writer():
+    while True:
+        html_name, begin_part, item = log_queue.get()
+        try:
+            append_to_html(html_name, begin_part, item)
+        except Exception as e:
+            print(f'[Private Log] Writing {html_name} failed: {e}')
+        finally:
+            log_queue.task_done()
+
+
+threading.Thread(target=log_writer, daemon=True).start()
+atexit.register(log_queue.join)
@@ -1,8 +1,11 @@
+import copy
 import torch
 import ldm_patched.modules.samplers
 import ldm_patched.modules.model_management
+import modules.patch
 
 from collections import namedtuple
+from types import SimpleNamespace
 from ldm_patched.contrib.external_align_your_steps import AlignYourStepsScheduler
 from ldm_patched.contrib.external_custom_sampler import SDTurboScheduler
 from ldm_patched.k_diffusion import sampling as k_diffusion_sampling
@@ -84,6 +87,61 @@ def clip_separate_after_preparation(cond, target_model=None, target_clip=None):
     return results
 
 
+class ProgressProbe:
+    # stands in for the model in a dry run of a sampler and records the sigma of every model evaluation
+    def __init__(self, model_sampling):
+        self.inner_model = SimpleNamespace(model_sampling=model_sampling)
+        self.sigmas = []
+
+    def __call__(self, x, sigma, **kwargs):
+        self.sigmas.append(float(sigma[0]))
+        return torch.zeros_like(x)
+
+
+class ZeroNoiseSampler:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, sigma, sigma_next):
+        return torch.zeros(())
+
+
+# samplers which choose their steps from the model outputs
+unplannable_sampler_functions = ['dpm_adaptive_function']
+
+
+def get_evaluation_sigmas(model, sampler, sigmas, seed=None):
+    """
+    Runs the sampler on a single latent value on the CPU with a stand-in model. Returns the sigma of every model
+    evaluation, including midpoints and sigmas raised by churn, and the number of evaluations before every callback,
+    or None when the evaluations depend on the model outputs.
+    """
+    sampler_function = getattr(sampler, 'sampler_function', None)
+    if sampler_function is not None and sampler_function.__name__ in unplannable_sampler_functions:
+        return None
+
+    probe = ProgressProbe(copy.deepcopy(model.model_sampling).cpu())
+    callback_evaluations = {}
+
+    def callback(step, x0, x, total_steps):
+        callback_evaluations[step] = len(probe.sigmas)
+
+    extra_args = {'cond': None, 'uncond': None, 'cond_scale': 1.0, 'model_options': {}, 'seed': seed}
+    brownian_tree_noise_sampler = k_diffusion_sampling.BrownianTreeNoiseSampler
+    try:
+        # the noise does not change the sigmas, and the random state of the real run must not be used up
+        k_diffusion_sampling.BrownianTreeNoiseSampler = ZeroNoiseSampler
+        with torch.random.fork_rng(devices=[]):
+            sampler.sample(probe, sigmas.float().cpu().clone(), extra_args, callback, torch.zeros((1, 1, 1, 1)), disable_pbar=True)
+    except Exception as e:
+        print(f'[Sampler] Cannot plan the diffusion progress: {e}')
+        return None
+    finally:
+        k_diffusion_sampling.BrownianTreeNoiseSampler = brownian_tree_noise_sampler
+
+    return probe.sigmas, callback_evaluations
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas, model_options={}, latent_image=None, denoise_mask=None, callback=None, disable_pbar=False, seed=None):
@@ -143,10 +201,12 @@ def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas
             model.memory_required([noise.shape[0] * 2] + list(noise.shape[1:])) + inference_memory)
 
         model_wrap.inner_model = current_refiner.model
+        modules.patch.set_progress_model(current_refiner.model)
         print('Refiner Swapped')
         return
 
     def callback_wrap(step, x0, x, total_steps):
+        modules.patch.advance_progress_schedule(step)
         if step == refiner_switch_step and current_refiner is not None:
             refiner_switch()
         if callback is not None:
@@ -155,7 +215,16 @@ def sample_hacked(model, noise, positive, negative, cfg, device, sampler, sigmas
             # residual_noise_preview *= x0.std()
             callback(step, x0, x, total_steps)
 
-    samples = sampler.sample(model_wrap, sigmas, extra_args, callback_wrap, noise, latent_image, denoise_mask, disable_pbar)
+    evaluations = get_evaluation_sigmas(model, sampler, sigmas, seed)
+    if evaluations is None:
+        modules.patch.clear_progress_schedule()
+    else:
+        modules.patch.set_progress_schedule(model, *evaluations)
+
+    try:
+        samples = sampler.sample(model_wrap, sigmas, extra_args, callback_wrap, noise, latent_image, denoise_mask, disable_pbar)
+    finally:
+        modules.patch.clear_progress_schedule()
     return model.process_latent_out(samples.to(torch.float32))
 
 
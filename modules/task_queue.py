@@ -0,0 +1,230 @@
+import os
+import time
+import pickle
+import itertools
+import threading
+
+
+class TaskYields(list):
+    """
+    List of [flag, product] updates of a task, wakes up waiting consumers on append.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.condition = threading.Condition()
+
+    def __reduce__(self):
+        # the condition can neither be copied nor pickled, gr.State deep copies its initial value
+        return self.__class__, (list(self),)
+
+    def append(self, item):
+        with self.condition:
+            super().append(item)
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        with self.condition:
+            if len(self) == 0:
+                self.condition.wait(timeout)
+            return len(self) > 0
+
+
+class QueueEntry:
+    def __init__(self, task, priority, user, sequence, key=None, filename=None):
+        self.task = task
+        self.priority = priority
+        self.user = user
+        self.sequence = sequence
+        self.key = key
+        self.filename = filename
+        self.created = time.monotonic()
+
+
+class TaskQueue:
+    """
+    Thread-safe priority queue for generation tasks.
+
+    Tasks with a higher priority are processed first. With fair share enabled, tasks of the same priority are
+    taken from the user who got the least images so far, so one user with large jobs can not starve the others.
+    With an affinity_key, tasks using the same models as the previous task are preferred to avoid model swaps,
+    unless another task has been waiting longer than affinity_max_wait seconds.
+    Queued tasks are optionally written to persist_path and restored after a restart.
+    """
+
+    def __init__(self, fair_share=False, persist_path=None, affinity_key=None, affinity_max_wait=60.0):
+        self.fair_share = fair_share
+        self.persist_path = persist_path
+        self.affinity_key = affinity_key
+        self.affinity_max_wait = affinity_max_wait
+        self.condition = threading.Condition()
+        self.entries = []
+        self.served = {}
+        self.counter = itertools.count()
+
+        self.last_key = None
+        self.swaps = 0
+        self.swaps_avoided = 0
+
+        if self.persist_path is not None:
+            os.makedirs(self.persist_path, exist_ok=True)
+
+    @staticmethod
+    def task_weight(task):
+        return max(1, int(getattr(task, 'image_number', 1) or 1))
+
+    def next_index(self, entries, served, last_key=None, now=None):
+        priority = max(entry.priority for entry in entries)
+        candidates = [entry for entry in entries if entry.priority == priority]
+        if self.affinity_key is not None and last_key is not None:
+            now = time.monotonic() if now is None else now
+            overdue = [entry for entry in candidates if now - entry.created > self.affinity_max_wait]
+            matching = [entry for entry in candidates if entry.key == last_key]
+            if len(overdue) > 0:
+                candidates = overdue
+            elif len(matching) > 0:
+                candidates = matching
+        if self.fair_share:
+            key = lambda entry: (served.get(entry.user, 0), entry.sequence)
+        else:
+            key = lambda entry: entry.sequence
+        return entries.index(min(candidates, key=key))
+
+    def ordered_entries(self):
+        with self.condition:
+            entries = self.entries.copy()
+            served = self.served.copy()
+            last_key = self.last_key
+
+        now = time.monotonic()
+        ordered = []
+        while len(entries) > 0:
+            entry = entries.pop(self.next_index(entries, served, last_key, now))
+            served[entry.user] = served.get(entry.user, 0) + self.task_weight(entry.task)
+            last_key = entry.key
+            ordered.append(entry)
+        return ordered
+
+    def put(self, task, filename=None):
+        priority = getattr(task, 'priority', 0)
+        user = getattr(task, 'user', None)
+
+        with self.condition:
+            active_users = set(entry.user for entry in self.entries)
+            if len(active_users) == 0:
+                self.served = {}
+            elif user not in active_users:
+                # users joining the queue start at the level of the least served waiting user
+                self.served[user] = max(self.served.get(user, 0), min(self.served.get(u, 0) for u in active_users))
+
+            key = self.affinity_key(task) if self.affinity_key is not None else None
+            entry = QueueEntry(task, priority, user, next(self.counter), key, filename)
+            if entry.filename is None:
+                entry.filename = self.persist(entry)
+            self.entries.append(entry)
+            self.condition.notify_all()
+
+    def append(self, task):
+        self.put(task)
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.entries) > 0, timeout):
+                return None
+            entry = self.entries[self.next_index(self.entries, self.served, self.last_key)]
+            if self.affinity_key is not None and self.last_key is not None:
+                # compare with the task that would have been taken without affinity
+                baseline = self.entries[self.next_index(self.entries, self.served)]
+                if entry.key != self.last_key:
+                    self.swaps += 1
+                elif baseline.key != self.last_key:
+                    self.swaps_avoided += 1
+            self.last_key = entry.key
+            self.entries.remove(entry)
+            self.served[entry.user] = self.served.get(entry.user, 0) + self.task_weight(entry.task)
+            entry.task.processing = True
+        self.remove_persisted(entry)
+        return entry.task
+
+    def cancel(self, task):
+        with self.condition:
+            for i, entry in enumerate(self.entries):
+                if entry.task is task:
+                    del self.entries[i]
+                    break
+            else:
+                return False
+        self.remove_persisted(entry)
+        print(f'[Queue] Cancelled queued task of user {entry.user}.')
+        return True
+
+    def position(self, task):
+        for i, entry in enumerate(self.ordered_entries()):
+            if entry.task is task:
+                return i + 1
+        return None
+
+    def stats(self, average_swap_time=0.0):
+        with self.condition:
+            return {
+                'model_swaps': self.swaps,
+                'model_swaps_avoided': self.swaps_avoided,
+                'time_saved': self.swaps_avoided * average_swap_time
+            }
+
+    def __len__(self):
+        with self.condition:
+            return len(self.entries)
+
+    def __iter__(self):
+        return iter([entry.task for entry in self.ordered_entries()])
+
+    def __contains__(self, task):
+        with self.condition:
+            return any(entry.task is task for entry in self.entries)
+
+    def persist(self, entry):
+        if self.persist_path is None:
+            return None
+
+        filename = os.path.join(self.persist_path, f'{time.time_ns()}_{entry.sequence}.task')
+        try:
+            with open(filename + '.tmp', 'wb') as fp:
+                pickle.dump({'args': entry.task.args, 'priority': entry.priority, 'user': entry.user}, fp)
+            os.replace(filename + '.tmp', filename)
+            return filename
+        except Exception as e:
+            print(f'[Queue] Persisting task failed: {e}')
+            return None
+
+    @staticmethod
+    def remove_persisted(entry):
+        if entry.filename is not None and os.path.exists(entry.filename):
+            os.remove(entry.filename)
+
+    def restore(self, task_factory):
+        if self.persist_path is None:
+            return 0
+
+        restored = 0
+        for name in sorted(f for f in os.listdir(self.persist_path) if f.endswith('.task')):
+            filename = os.path.join(self.persist_path, name)
+            try:
+                # only files written by this queue are expected in the folder
+                with open(filename, 'rb') as fp:
+                    data = pickle.load(fp)
+                task = task_factory(list(data['args']))
+                task.priority = data['priority']
+                task.user = data['user']
+                # nobody is watching the previews of a restored task
+                task.disable_preview = True
+            except Exception as e:
+                print(f'[Queue] Skipping persisted task {filename}: {e}')
+                os.remove(filename)
+                continue
+            self.put(task, filename=filename)
+            restored += 1
+
+        if restored > 0:
+            print(f'[Queue] Restored {restored} queued task{"s" if restored > 1 else ""}.')
+        return restored
@@ -2,32 +2,91 @@ from collections import OrderedDict
 
 import modules.core as core
 import torch
-from ldm_patched.contrib.external_upscale_model import ImageUpscaleWithModel
+import ldm_patched.modules.model_management as model_management
+import ldm_patched.modules.utils
+from ldm_patched.modules.model_patcher import ModelPatcher
 from ldm_patched.pfn.architecture.RRDB import RRDBNet as ESRGAN
 from modules.config import downloading_upscale_model
+from modules.lru_cache import LRUCache
 
-opImageUpscaleWithModel = ImageUpscaleWithModel()
 model = None
+tile_overlap = 32
 
+# peak activation bytes per byte of input pixel channel and unit of scale, measured by ComfyUI on its upscale models
+activation_memory_factor = 384.0
 
-def perform_upscale(img):
+# (height, width) of input images -> (tile size, tiles per forward) that did not run out of memory
+tile_settings = LRUCache(max_size=64)
+
+
+def load_upscale_model():
     global model
 
+    if model is not None:
+        return model
+
+    model_filename = downloading_upscale_model()
+    sd = torch.load(model_filename, weights_only=True)
+    sdo = OrderedDict()
+    for k, v in sd.items():
+        sdo[k.replace('residual_block_', 'RDB')] = v
+    del sd
+    upscale_model = ESRGAN(sdo)
+    upscale_model.eval()
+
+    load_device = model_management.get_torch_device()
+    offload_device = model_management.unet_offload_device()
+    if model_management.should_use_fp16(device=load_device):
+        upscale_model.half()
+
+    model = ModelPatcher(upscale_model, load_device=load_device, offload_device=offload_device)
+    return model
+
+
+def get_max_batch_size(tile, dtype, scale):
+    memory_per_tile = tile * tile * 3 * model_management.dtype_size(dtype) * max(scale, 1.0) * activation_memory_factor
+    free_memory = model_management.get_free_memory(model.load_device)
+    return max(1, int(free_memory / memory_per_tile))
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def perform_upscale(img):
     print(f'Upscaling image with shape {str(img.shape)} ...')
 
-    if model is None:
-        model_filename = downloading_upscale_model()
-        sd = torch.load(model_filename, weights_only=True)
-        sdo = OrderedDict()
-        for k, v in sd.items():
-            sdo[k.replace('residual_block_', 'RDB')] = v
-        del sd
-        model = ESRGAN(sdo)
-        model.cpu()
-        model.eval()
-
-    img = core.numpy_to_pytorch(img)
-    img = opImageUpscaleWithModel.upscale(model, img)[0]
-    img = core.pytorch_to_numpy(img)[0]
+    load_upscale_model()
+    model_management.load_model_gpu(model)
+
+    upscale_model = model.model
+    dtype = next(upscale_model.parameters()).dtype
+    in_img = core.numpy_to_pytorch(img).movedim(-1, -3).to(model.load_device, dtype=dtype)
+
+    key = tuple(img.shape[:2])
+    tile, batch_size = tile_settings.get(key, (512, None))
+    if batch_size is None:
+        batch_size = get_max_batch_size(tile, dtype, upscale_model.scale)
+
+    while True:
+        try:
+            steps = in_img.shape[0] * ldm_patched.modules.utils.get_tiled_scale_steps(
+                in_img.shape[3], in_img.shape[2], tile_x=tile, tile_y=tile, overlap=tile_overlap)
+            pbar = ldm_patched.modules.utils.ProgressBar(steps)
+            s = ldm_patched.modules.utils.tiled_scale_batched(
+                in_img, lambda a: upscale_model(a).float(), tile_x=tile, tile_y=tile, overlap=tile_overlap,
+                upscale_amount=upscale_model.scale, pbar=pbar, max_batch_size=batch_size)
+            break
+        except model_management.OOM_EXCEPTION as e:
+            model_management.soft_empty_cache(True)
+            if batch_size > 1:
+                batch_size //= 2
+                continue
+            tile //= 2
+            if tile < 128:
+                raise e
+
+    tile_settings.put(key, (tile, batch_size))
+
+    s = torch.clamp(s.movedim(-3, -1), min=0, max=1.0)
+    img = core.pytorch_to_numpy(s)[0]
 
     return img
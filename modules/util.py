@@ -7,6 +7,7 @@ import math
 import os
 import cv2
 import re
+import threading
 from typing import List, Tuple, AnyStr, NamedTuple
 
 import json
@@ -204,11 +205,13 @@ def addnet_hash_safetensors(b):
 
 def calculate_sha256(filename) -> str:
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
+    # large reads into one reused buffer, hashlib releases the GIL while hashing it
+    buffer = bytearray(16 * 1024 * 1024)
+    view = memoryview(buffer)
 
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+    with open(filename, "rb", buffering=0) as f:
+        while size := f.readinto(buffer):
+            hash_sha256.update(view[:size])
 
     return hash_sha256.hexdigest()
 
@@ -465,18 +468,49 @@ def cleanup_prompt(prompt):
     return cleaned_prompt[:-2]
 
 
+wildcard_placeholder_pattern = re.compile(r'__([\w-]+)__')
+wildcard_lock = threading.Lock()
+wildcard_index = {}
+wildcard_index_filenames = None
+wildcard_words = {}
+
+
+def get_wildcard_words(placeholder) -> list:
+    """
+    Returns the non-empty lines of the wildcard file of a placeholder.
+
+    The index of wildcard names is rebuilt when modules.config.wildcard_filenames is refreshed, file contents are
+    cached and read again when their modification time or size changes.
+    """
+    global wildcard_index, wildcard_index_filenames
+
+    with wildcard_lock:
+        filenames = modules.config.wildcard_filenames
+        if wildcard_index_filenames is not filenames:
+            index = {}
+            for filename in filenames:
+                index.setdefault(os.path.splitext(os.path.basename(filename))[0], filename)
+            wildcard_index, wildcard_index_filenames = index, filenames
+
+        path = os.path.join(modules.config.path_wildcards, wildcard_index[placeholder])
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if path not in wildcard_words or wildcard_words[path][0] != version:
+            with open(path, encoding='utf-8') as fp:
+                wildcard_words[path] = version, [x for x in fp.read().splitlines() if x != '']
+        return wildcard_words[path][1]
+
+
 def apply_wildcards(wildcard_text, rng, i, read_wildcards_in_order) -> str:
     for _ in range(modules.config.wildcards_max_bfs_depth):
-        placeholders = re.findall(r'__([\w-]+)__', wildcard_text)
+        placeholders = wildcard_placeholder_pattern.findall(wildcard_text)
         if len(placeholders) == 0:
             return wildcard_text
 
         print(f'[Wildcards] processing: {wildcard_text}')
         for placeholder in placeholders:
             try:
-                matches = [x for x in modules.config.wildcard_filenames if os.path.splitext(os.path.basename(x))[0] == placeholder]
-                words = open(os.path.join(modules.config.path_wildcards, matches[0]), encoding='utf-8').read().splitlines()
-                words = [x for x in words if x != '']
+                words = get_wildcard_words(placeholder)
                 assert len(words) > 0
                 if read_wildcards_in_order:
                     wildcard_text = wildcard_text.replace(f'__{placeholder}__', words[i % len(words)], 1)
@@ -0,0 +1,202 @@
+import os
+import sys
+import atexit
+import secrets
+import threading
+import traceback
+import subprocess
+from multiprocessing.connection import Listener, Client
+
+import args_manager
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+authkey_environ = 'FOOOCUS_WORKER_POOL_AUTHKEY'
+
+# flags only meaningful for the front-end process, together with their values
+front_end_flags = ['--worker-pool-devices', '--gpu-device-id', '--always-cpu', '--rebuild-hash-cache',
+                   '--task-queue-path']
+
+# task attributes computed by the worker and used by the front-end after the task finished
+finish_attributes = ['images_to_enhance_count', 'enhance_stats']
+
+
+def filter_argv(argv, flags):
+    result = []
+    skipping = False
+    for arg in argv:
+        if arg.startswith('-'):
+            skipping = arg.split('=', 1)[0] in flags
+        if not skipping:
+            result.append(arg)
+    return result
+
+
+class WorkerPool:
+    """
+    Runs generation tasks in one worker process per device instead of the worker thread of the front-end.
+
+    A device is a GPU id or 'cpu'. All workers take tasks from the shared task queue of the front-end. Task
+    arguments are sent to the worker over a local connection and its yields are relayed back into the task,
+    so Gradio consumes them exactly like the yields of the local worker thread. Stop and skip requests are
+    forwarded to the worker running the task. Workers use --worker-cpu-threads CPU threads each.
+    """
+
+    def __init__(self, devices, task_queue):
+        self.devices = devices
+        self.task_queue = task_queue
+        self.processes = []
+        self.listener = None
+
+    def start(self):
+        authkey = secrets.token_bytes(32)
+        self.listener = Listener(('127.0.0.1', 0), authkey=authkey)
+        address = '%s:%d' % self.listener.address
+
+        argv = filter_argv(sys.argv[1:], front_end_flags)
+        for device in self.devices:
+            env = os.environ.copy()
+            env[authkey_environ] = authkey.hex()
+            command = [sys.executable, '-m', 'modules.worker_pool'] + argv + ['--worker-pool-connect', address]
+            if device == 'cpu':
+                command += ['--always-cpu']
+            else:
+                env['CUDA_VISIBLE_DEVICES'] = str(device)
+            print(f'[Worker Pool] Starting worker on device {device}.')
+            self.processes.append(subprocess.Popen(command, cwd=root, env=env))
+
+        atexit.register(self.stop)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+
+    def accept(self):
+        for _ in self.devices:
+            conn = self.listener.accept()
+            threading.Thread(target=self.dispatch, args=(conn,), daemon=True).start()
+
+    def dispatch(self, conn):
+        try:
+            _, device = conn.recv()
+        except (EOFError, OSError):
+            return
+        print(f'[Worker Pool] Worker on device {device} is ready.')
+
+        while True:
+            task = self.task_queue.get()
+            try:
+                self.run(conn, task)
+            except (EOFError, OSError):
+                traceback.print_exc()
+                print(f'[Worker Pool] Lost connection to worker on device {device}.')
+                task.yields.append(['finish', task.results])
+                task.processing = False
+                return
+
+    @staticmethod
+    def run(conn, task):
+        conn.send(('task', task.args, {'disable_preview': task.disable_preview}))
+
+        last_stop = task.last_stop
+        while True:
+            if task.last_stop != last_stop:
+                last_stop = task.last_stop
+                conn.send(('stop', last_stop))
+
+            if not conn.poll(0.1):
+                continue
+
+            message = conn.recv()
+            flag, product = message[0], message[1]
+            if flag == 'last_stop':
+                # the worker resets skip requests once handled
+                task.last_stop = last_stop = product
+                continue
+            if flag in ['results', 'finish']:
+                task.results = product
+            if flag == 'finish':
+                for key, value in message[2].items():
+                    setattr(task, key, value)
+                task.processing = False
+            task.yields.append([flag, product])
+            if flag == 'finish':
+                return
+
+
+def relay(conn, task, worker, interrupt):
+    from modules.private_logger import wait_for_images
+
+    last_stop = task.last_stop
+    while True:
+        while conn.poll():
+            flag, value = conn.recv()
+            if flag != 'stop':
+                continue
+            task.last_stop = last_stop = value
+            if value == 'stop' and worker.async_tasks.cancel(task):
+                task.yields.append(['finish', task.results])
+            elif task.processing:
+                interrupt()
+
+        if task.last_stop != last_stop:
+            last_stop = task.last_stop
+            conn.send(('last_stop', last_stop))
+
+        if not task.yields.wait(timeout=0.1):
+            continue
+
+        flag, product = task.yields.pop(0)
+        if flag == 'preview' and len(task.yields) > 0 and task.yields[0][0] == 'preview':
+            # only send the latest preview
+            continue
+        if flag in ['results', 'finish']:
+            # images are saved in the background, the front-end reads them right away
+            wait_for_images(product)
+        if flag == 'finish':
+            conn.send((flag, product, {key: getattr(task, key) for key in finish_attributes}))
+            return
+        conn.send((flag, product))
+
+
+def serve(address, device):
+    host, port = address.rsplit(':', 1)
+    conn = Client((host, int(port)), authkey=bytes.fromhex(os.environ[authkey_environ]))
+
+    import modules.config
+    import modules.hash_cache
+
+    modules.config.update_files()
+    modules.hash_cache.load_cache_from_file()
+
+    if args_manager.args.worker_cpu_threads:
+        import torch
+        torch.set_num_threads(args_manager.args.worker_cpu_threads)
+
+    import modules.async_worker as worker
+    import ldm_patched.modules.model_management as model_management
+
+    conn.send(('ready', device))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+
+        if message[0] != 'task':
+            # stop requests arriving after the task finished
+            continue
+
+        _, args, attributes = message
+        task = worker.AsyncTask(args=list(args))
+        for key, value in attributes.items():
+            setattr(task, key, value)
+        worker.async_tasks.put(task)
+        relay(conn, task, worker, model_management.interrupt_current_processing)
+
+
+if __name__ == '__main__':
+    serve(args_manager.args.worker_pool_connect,
+          'cpu' if args_manager.args.always_cpu else os.environ.get('CUDA_VISIBLE_DEVICES', '0'))
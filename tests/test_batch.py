@@ -0,0 +1,42 @@
+import os
+import json
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import batch
+
+
+def make_request(model, lora=None):
+    loras = [SimpleNamespace(enabled=True, model_name=lora, weight=1.0)] if lora is not None else []
+    return SimpleNamespace(base_model_name=model, refiner_model_name='None', vae_name='Default (model)',
+                           loras=loras, performance_selection='Speed')
+
+
+class TestBatch(unittest.TestCase):
+    def test_order_jobs_groups_models(self):
+        requests = [('1', make_request('a')), ('2', make_request('b')), ('3', make_request('a', 'x')),
+                    ('4', make_request('a')), ('5', make_request('b'))]
+        ordered = [job_id for job_id, _ in batch.order_jobs(requests)]
+        self.assertEqual(ordered, ['1', '4', '2', '5', '3'])
+
+    def test_job_status(self):
+        task = SimpleNamespace(image_number=2)
+        self.assertEqual(batch.get_job_status(task, []), 'failed')
+        self.assertEqual(batch.get_job_status(task, ['a.png']), 'partial')
+        self.assertEqual(batch.get_job_status(task, ['a.png', 'b.png']), 'finished')
+
+    def test_resume_skips_finished_jobs(self):
+        with tempfile.TemporaryDirectory() as path:
+            jobs_filename = os.path.join(path, 'jobs.jsonl')
+            manifest_filename = os.path.join(path, 'jobs.manifest.jsonl')
+            with open(jobs_filename, 'wt', encoding='utf-8') as fp:
+                fp.write(json.dumps({'id': 'first', 'prompt': 'a'}) + '\n\n')
+                fp.write(json.dumps({'prompt': 'b'}) + '\n')
+            with open(manifest_filename, 'wt', encoding='utf-8') as fp:
+                fp.write(json.dumps({'id': 'first', 'status': 'finished'}) + '\n')
+                fp.write(json.dumps({'id': 'line-3', 'status': 'failed'}) + '\n')
+                fp.write('{"id": "line-')
+
+            self.assertEqual(batch.read_jobs(jobs_filename), [('first', {'prompt': 'a'}), ('line-3', {'prompt': 'b'})])
+            self.assertEqual(batch.read_finished_jobs(manifest_filename), {'first'})
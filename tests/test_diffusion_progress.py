@@ -0,0 +1,115 @@
+import os
+import unittest
+
+import torch
+
+import ldm_patched.k_diffusion.sampling as k_diffusion_sampling
+import ldm_patched.modules.samplers as samplers_module
+import modules.patch as patch
+import modules.sample_hijack as sample_hijack
+from ldm_patched.modules.model_sampling import ModelSamplingDiscrete
+from modules.patch_precision import patched_register_schedule
+
+
+class ModelSampling(ModelSamplingDiscrete):
+    # schedule as registered by patch_all_precision
+    _register_schedule = patched_register_schedule
+
+
+class Model:
+    def __init__(self, dtype, manual_cast_dtype=None):
+        self.model_sampling = ModelSampling()
+        self.dtype = dtype
+        self.manual_cast_dtype = manual_cast_dtype
+
+    def get_dtype(self):
+        return self.dtype
+
+
+class ModelWrap:
+    # model wrapper recording the progress of every model evaluation next to the uncached value
+    def __init__(self, model):
+        self.inner_model = model
+        self.progress = []
+
+    def __call__(self, x, sigma, **kwargs):
+        self.progress.append((patch.get_diffusion_progress(self.inner_model, sigma),
+                              float(patch.diffusion_progress(self.inner_model, sigma).float().cpu().numpy().tolist()[0])))
+        return x * 0.5
+
+
+class TestDiffusionProgress(unittest.TestCase):
+    def setUp(self):
+        self.settings = patch.patch_settings.get(os.getpid(), None)
+        patch.patch_settings[os.getpid()] = patch.PatchSettings()
+
+    def tearDown(self):
+        if self.settings is None:
+            del patch.patch_settings[os.getpid()]
+        else:
+            patch.patch_settings[os.getpid()] = self.settings
+
+    def sample(self, sampler, model, plan=True):
+        # sampling run as done by sample_hacked
+        sigmas = k_diffusion_sampling.get_sigmas_karras(n=8, sigma_min=float(model.model_sampling.sigma_min),
+                                                        sigma_max=float(model.model_sampling.sigma_max))
+        evaluations = sample_hijack.get_evaluation_sigmas(model, sampler, sigmas, 0) if plan else None
+        if evaluations is None:
+            patch.clear_progress_schedule()
+        else:
+            patch.set_progress_schedule(model, *evaluations)
+
+        model_wrap = ModelWrap(model)
+        noise = torch.randn((1, 4, 8, 8), generator=torch.Generator().manual_seed(0))
+        extra_args = {'cond': None, 'uncond': None, 'cond_scale': 1.0, 'model_options': {}, 'seed': 0}
+        callback = lambda step, x0, x, total_steps: patch.advance_progress_schedule(step)
+        try:
+            sampler.sample(model_wrap, sigmas, extra_args, callback, noise, disable_pbar=True)
+        finally:
+            patch.clear_progress_schedule()
+        return evaluations, model_wrap.progress
+
+    def test_progress_matches_uncached_values(self):
+        samplers = [samplers_module.ksampler('euler'),
+                    samplers_module.ksampler('euler', {'s_churn': 1.0}),
+                    samplers_module.ksampler('euler_ancestral'),
+                    samplers_module.ksampler('heun'),
+                    samplers_module.ksampler('dpm_2'),
+                    samplers_module.ksampler('dpmpp_2s_ancestral'),
+                    samplers_module.ksampler('dpmpp_sde'),
+                    samplers_module.ksampler('dpmpp_2m'),
+                    samplers_module.ksampler('dpmpp_2m_sde'),
+                    samplers_module.UNIPC()]
+
+        for model in [Model(torch.float32), Model(torch.float16), Model(torch.float16, torch.float32)]:
+            for sampler in samplers:
+                evaluations, progress = self.sample(sampler, model)
+                self.assertIsNotNone(evaluations)
+                self.assertEqual(len(evaluations[0]), len(progress))
+                for value, uncached in progress:
+                    self.assertEqual(value, uncached)
+
+    def test_planning_does_not_use_the_random_state(self):
+        model = Model(torch.float32)
+        state = torch.random.get_rng_state()
+        evaluations, planned = self.sample(samplers_module.ksampler('euler_ancestral'), model)
+        torch.random.set_rng_state(state)
+        _, unplanned = self.sample(samplers_module.ksampler('euler_ancestral'), model, plan=False)
+        self.assertIsNotNone(evaluations)
+        self.assertEqual(planned, unplanned)
+
+    def test_unplannable_samplers_compute_the_progress(self):
+        model = Model(torch.float32)
+        evaluations, progress = self.sample(samplers_module.ksampler('dpm_adaptive'), model)
+        self.assertIsNone(evaluations)
+        self.assertGreater(len(progress), 0)
+        for value, uncached in progress:
+            self.assertEqual(value, uncached)
+
+    def test_manual_cast_dtype(self):
+        # the UNet computes the progress in the dtype it runs in
+        sigma = torch.tensor([0.0291675])
+        model = Model(torch.float16, torch.float32)
+        self.assertEqual(patch.diffusion_progress(model, sigma).dtype, torch.float32)
+        model = Model(torch.float16)
+        self.assertEqual(patch.diffusion_progress(model, sigma).dtype, torch.float16)
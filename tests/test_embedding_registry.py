@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+import safetensors.torch
+import torch
+
+import ldm_patched.modules.sd1_clip as sd1_clip
+
+
+class TestEmbeddingRegistry(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry = sd1_clip.EmbeddingRegistry(max_items=2)
+        os.makedirs(os.path.join(self.directory.name, 'negative'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_embedding(self, name, value, size=768):
+        filename = os.path.join(self.directory.name, name)
+        safetensors.torch.save_file({'clip_l': torch.full((2, size), value)}, filename)
+        return filename
+
+    def load(self, name):
+        return self.registry.load(name, self.directory.name, 768, 'clip_l')
+
+    def test_parity_with_load_embed(self):
+        self.write_embedding('style.safetensors', 1.0)
+        self.write_embedding(os.path.join('negative', 'bad_hands.safetensors'), 2.0)
+        for name in ['style', 'style.safetensors', 'bad_hands', 'negative/bad_hands', 'missing', '../style']:
+            expected = sd1_clip.load_embed(name, self.directory.name, 768, 'clip_l')
+            embed = self.load(name)
+            if expected is None:
+                self.assertIsNone(embed)
+            else:
+                self.assertTrue(torch.equal(embed, expected))
+
+    def test_embeddings_are_cached(self):
+        self.write_embedding('style.safetensors', 1.0)
+        self.assertIs(self.load('style'), self.load('style'))
+
+        # a different size or key is another embedding of the same file
+        self.assertIsNot(self.registry.load('style', self.directory.name, 1280, 'clip_g'), self.load('style'))
+
+    def test_changed_files_are_reloaded(self):
+        self.assertIsNone(self.load('style'))
+        filename = self.write_embedding('style.safetensors', 1.0)
+        self.assertEqual(self.load('style')[0, 0].item(), 1.0)
+
+        self.write_embedding('style.safetensors', 3.0, size=1024)
+        os.utime(filename, ns=(0, 0))
+        self.assertEqual(self.load('style').shape, (2, 1024))
+
+        os.remove(filename)
+        self.assertIsNone(self.load('style'))
+
+    def test_least_recently_used_embeddings_are_evicted(self):
+        for i, name in enumerate(['a', 'b', 'c']):
+            self.write_embedding(f'{name}.safetensors', float(i))
+        a = self.load('a')
+        self.load('b')
+        self.assertIs(self.load('a'), a)
+        self.load('c')
+        self.assertEqual(len(self.registry.embeds), 2)
+        self.assertIs(self.load('a'), a)
+        self.assertNotIn((os.path.join(self.directory.name, 'b.safetensors'), 768, 'clip_l'), self.registry.embeds)
+
+    def test_case_insensitive_file_systems(self):
+        filename = self.write_embedding('easynegative.safetensors', 1.0)
+        if not os.path.isfile(os.path.join(self.directory.name, 'EASYNEGATIVE.safetensors')):
+            self.assertIsNone(self.registry.find('EasyNegative', [self.directory.name]))
+            self.skipTest('file system is case sensitive')
+        self.assertTrue(os.path.samefile(self.registry.find('EasyNegative', [self.directory.name]), filename))
+        self.assertTrue(torch.equal(self.load('EasyNegative'), sd1_clip.load_embed('EasyNegative', self.directory.name, 768, 'clip_l')))
+
+    def test_files_missing_from_the_index(self):
+        self.assertIsNone(self.registry.find('style', [self.directory.name]))
+        mtime = os.stat(self.directory.name).st_mtime_ns
+        filename = self.write_embedding('style.safetensors', 1.0)
+        # keep the index of the directory as it was
+        os.utime(self.directory.name, ns=(mtime, mtime))
+        self.assertNotIn(os.path.normcase(filename), self.registry.get_index([self.directory.name])[2])
+        self.assertEqual(self.registry.find('style', [self.directory.name]), filename)
@@ -0,0 +1,67 @@
+import os
+import json
+import tempfile
+import unittest
+
+import modules.hash_cache as hash_cache
+from modules.util import sha256
+
+
+class TestHashCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.hash_cache_filename = hash_cache.hash_cache_filename
+        hash_cache.hash_cache_filename = os.path.join(self.directory.name, 'hash_cache.txt')
+        for cache in [hash_cache.hash_cache, hash_cache.file_stats, hash_cache.stat_hashes]:
+            cache.clear()
+
+    def tearDown(self):
+        hash_cache.hash_cache_filename = self.hash_cache_filename
+        self.directory.cleanup()
+
+    def write_file(self, name, content):
+        filepath = os.path.join(self.directory.name, name)
+        with open(filepath, 'wb') as fp:
+            fp.write(content)
+        return filepath
+
+    def test_hash_is_cached_with_file_stat(self):
+        filepath = self.write_file('model.safetensors', b'model')
+        hash_value = hash_cache.sha256_from_cache(filepath)
+        self.assertEqual(hash_value, sha256(filepath))
+
+        hash_cache.hash_cache.clear()
+        hash_cache.file_stats.clear()
+        hash_cache.load_cache_from_file()
+        self.assertEqual(hash_cache.file_stats[filepath], hash_cache.get_file_stat(filepath))
+        self.assertEqual(hash_cache.get_cached_hash(filepath), hash_value)
+
+    def test_replaced_and_renamed_files(self):
+        filepath = self.write_file('model.safetensors', b'model')
+        hash_value = hash_cache.sha256_from_cache(filepath)
+
+        renamed_filepath = os.path.join(self.directory.name, 'renamed.safetensors')
+        os.rename(filepath, renamed_filepath)
+        self.assertIsNone(hash_cache.get_cached_hash(filepath))
+        self.assertEqual(hash_cache.get_cached_hash(renamed_filepath), hash_value)
+
+        self.write_file('renamed.safetensors', b'another model')
+        self.assertIsNone(hash_cache.get_cached_hash(renamed_filepath))
+        self.assertEqual(hash_cache.sha256_from_cache(renamed_filepath), sha256(renamed_filepath))
+
+    def test_old_cache_entries_are_loaded(self):
+        filepath = self.write_file('lora.safetensors', b'lora')
+        with open(hash_cache.hash_cache_filename, 'wt', encoding='utf-8') as fp:
+            fp.write(json.dumps({filepath: sha256(filepath)}) + '\n')
+            fp.write('{"broken')
+
+        hash_cache.load_cache_from_file()
+        self.assertIsNone(hash_cache.file_stats[filepath])
+        self.assertEqual(hash_cache.get_cached_hash(filepath), sha256(filepath))
+        self.assertEqual(hash_cache.file_stats[filepath], hash_cache.get_file_stat(filepath))
+
+    def test_async_hash(self):
+        filepath = self.write_file('model.safetensors', b'model' * 1024)
+        future = hash_cache.sha256_from_cache_async(filepath)
+        self.assertEqual(hash_cache.sha256_result(future), sha256(filepath))
+        self.assertTrue(hash_cache.sha256_from_cache_async(filepath).done())
@@ -0,0 +1,100 @@
+import unittest
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image, ImageFilter
+
+import modules.inpaint_worker as inpaint_worker
+
+
+def fooocus_fill_reference(image, mask):
+    # fill as done before the vectorized engine
+    current_image = image.copy()
+    area = np.where(mask < 127)
+    store = image[area]
+
+    for k, repeats in inpaint_worker.fill_passes:
+        for _ in range(repeats):
+            current_image = np.array(Image.fromarray(current_image).filter(ImageFilter.BoxBlur(k)))
+            current_image[area] = store
+
+    return current_image
+
+
+def morphological_open_reference(x):
+    x_int16 = np.zeros_like(x, dtype=np.int16)
+    x_int16[x > 127] = 256
+
+    for i in range(32):
+        maxed = cv2.dilate(x_int16, np.ones((3, 3), dtype=np.int16)) - 8
+        x_int16 = np.maximum(maxed, x_int16)
+
+    return np.clip(x_int16, 0, 255).astype(np.uint8)
+
+
+def solve_abcd_reference(x, a, b, c, d, k):
+    H, W = x.shape[:2]
+    if k == 1.0:
+        return 0, H, 0, W
+    while True:
+        if b - a >= H * k and d - c >= W * k:
+            break
+
+        add_h = (b - a) < (d - c)
+        add_w = not add_h
+
+        if b - a == H:
+            add_w = True
+
+        if d - c == W:
+            add_h = True
+
+        if add_h:
+            a -= 1
+            b += 1
+
+        if add_w:
+            c -= 1
+            d += 1
+
+        a, b, c, d = inpaint_worker.regulate_abcd(x, a, b, c, d)
+    return a, b, c, d
+
+
+class TestInpaintWorker(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.image = cv2.resize(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8), (320, 240),
+                                interpolation=cv2.INTER_CUBIC)
+        self.masks = [np.zeros((240, 320), dtype=np.uint8) for _ in range(3)]
+        cv2.circle(self.masks[0], (150, 110), 60, 255, -1)
+        # masked area touching the borders of the image
+        self.masks[1][:20] = 255
+        self.masks[1][180:, 260:] = 255
+
+    def assert_close(self, output, reference, tolerance=1):
+        self.assertEqual(output.shape, reference.shape)
+        self.assertEqual(output.dtype, reference.dtype)
+        self.assertLessEqual(np.abs(output.astype(np.int32) - reference.astype(np.int32)).max(), tolerance)
+
+    def test_fill_parity(self):
+        for mask in self.masks:
+            reference = fooocus_fill_reference(self.image, mask)
+            self.assert_close(inpaint_worker.fooocus_fill(self.image, mask), reference)
+            self.assert_close(inpaint_worker.fooocus_fill(self.image, mask, device=torch.device('cpu')), reference)
+
+    def test_morphological_open_parity(self):
+        for mask in self.masks:
+            self.assert_close(inpaint_worker.morphological_open(mask), morphological_open_reference(mask), tolerance=0)
+
+    def test_solve_abcd_parity(self):
+        rng = np.random.default_rng(0)
+        for _ in range(2000):
+            H, W = rng.integers(1, 200, size=2)
+            a, c = rng.integers(0, H), rng.integers(0, W)
+            b, d = rng.integers(a + 1, H + 1), rng.integers(c + 1, W + 1)
+            k = float(rng.choice([0.0, 0.5, 0.618, 0.99, 1.0, rng.random()]))
+            x = np.zeros((H, W), dtype=np.uint8)
+            self.assertEqual(tuple(inpaint_worker.solve_abcd(x, a, b, c, d, k)),
+                             tuple(solve_abcd_reference(x, a, b, c, d, k)))
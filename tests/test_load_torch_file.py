@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+import safetensors.torch
+import torch
+
+import ldm_patched.modules.utils as utils
+
+
+class TestLoadTorchFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        generator = torch.Generator().manual_seed(0)
+        self.sd = {
+            'model.diffusion_model.weight': torch.randn((4, 3, 3, 3), generator=generator).half(),
+            'model.diffusion_model.bias': torch.randn((4,), generator=generator).bfloat16(),
+            'cond_stage_model.position_ids': torch.arange(77, dtype=torch.int64)[None],
+        }
+
+    def tearDown(self):
+        utils.args.disable_mmap = False
+        self.directory.cleanup()
+
+    def assert_state_dict_equal(self, sd):
+        self.assertEqual(sorted(sd.keys()), sorted(self.sd.keys()))
+        for k, v in self.sd.items():
+            self.assertEqual(sd[k].dtype, v.dtype)
+            self.assertTrue(torch.equal(sd[k], v))
+
+    def test_checkpoint_formats(self):
+        for zip_format in [True, False]:
+            filename = os.path.join(self.directory.name, f'model_{zip_format}.ckpt')
+            torch.save({'state_dict': self.sd}, filename, _use_new_zipfile_serialization=zip_format)
+            for disable_mmap in [False, True]:
+                utils.args.disable_mmap = disable_mmap
+                for safe_load in [False, True]:
+                    self.assert_state_dict_equal(utils.load_torch_file(filename, safe_load=safe_load))
+
+    def test_safetensors(self):
+        filename = os.path.join(self.directory.name, 'model.safetensors')
+        safetensors.torch.save_file(self.sd, filename)
+        for disable_mmap in [False, True]:
+            utils.args.disable_mmap = disable_mmap
+            self.assert_state_dict_equal(utils.load_torch_file(filename))
+
+    def test_mapped_tensors_are_private(self):
+        filename = os.path.join(self.directory.name, 'model.ckpt')
+        torch.save(self.sd, filename)
+        sd = utils.load_torch_file(filename, safe_load=True)
+        sd['model.diffusion_model.weight'].zero_()
+        del sd
+        self.assert_state_dict_equal(utils.load_torch_file(filename, safe_load=True))
+
+    def test_streaming_safetensors_writer(self):
+        filename = os.path.join(self.directory.name, 'streamed.safetensors')
+        sd = dict(self.sd)
+        sd['transposed'] = torch.randn((2, 3)).t()
+        sd['scalar'] = torch.tensor(0.5)
+        sd['empty'] = torch.zeros((0, 4))
+        sd['mask'] = torch.tensor([True, False, True])
+        utils.save_safetensors_streaming(sd, filename, metadata={'format': 'pt'})
+
+        loaded = safetensors.torch.load_file(filename)
+        self.assertEqual(sorted(loaded.keys()), sorted(sd.keys()))
+        for k, v in sd.items():
+            self.assertEqual(loaded[k].dtype, v.dtype)
+            self.assertTrue(torch.equal(loaded[k], v))
@@ -0,0 +1,46 @@
+import unittest
+
+from modules.lru_cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        evicted = []
+        cache = LRUCache(max_size=2, on_evict=lambda key, value: evicted.append(key))
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        self.assertEqual(evicted, ['b'])
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 1, 'items': 2, 'size': 2})
+
+    def test_size_budget(self):
+        cache = LRUCache(max_size=10, size_fn=len)
+        cache.put('a', 'x' * 4)
+        cache.put('b', 'x' * 4)
+        cache.put('c', 'x' * 4)
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('a', cache)
+
+        cache.put('d', 'x' * 11)
+        self.assertNotIn('d', cache)
+
+    def test_oversized_item_is_not_kept(self):
+        evicted = []
+        cache = LRUCache(max_size=10, size_fn=len, on_evict=lambda key, value: evicted.append(key))
+        cache.put('a', 'x' * 4)
+        cache.put('b', 'x' * 4)
+        cache.put('c', 'x' * 11)
+
+        self.assertEqual(evicted, [])
+        self.assertNotIn('c', cache)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 0, 'evictions': 0, 'items': 2, 'size': 8})
+
+    def test_disabled(self):
+        cache = LRUCache(max_size=0)
+        cache.put('a', 1)
+        self.assertEqual(len(cache), 0)
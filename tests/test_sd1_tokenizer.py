@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+
+import safetensors.torch
+import torch
+
+import ldm_patched.modules.sd1_clip as sd1_clip
+import ldm_patched.modules.sdxl_clip as sdxl_clip
+from modules.sdxl_styles import styles
+
+
+def tokenize_with_weights_reference(self, text, return_word_ids=False):
+    # tokenization with one tokenizer call per word as done before the token caches
+    if self.pad_with_end:
+        pad_token = self.end_token
+    else:
+        pad_token = 0
+
+    text = sd1_clip.escape_important(text)
+    parsed_weights = sd1_clip.token_weights(text, 1.0)
+
+    tokens = []
+    for weighted_segment, weight in parsed_weights:
+        to_tokenize = sd1_clip.unescape_important(weighted_segment).replace("\n", " ").split(' ')
+        to_tokenize = [x for x in to_tokenize if x != ""]
+        for word in to_tokenize:
+            if word.startswith(self.embedding_identifier) and self.embedding_directory is not None:
+                embedding_name = word[len(self.embedding_identifier):].strip('\n')
+                embed, leftover = self._try_get_embedding(embedding_name)
+                if embed is not None:
+                    if len(embed.shape) == 1:
+                        tokens.append([(embed, weight)])
+                    else:
+                        tokens.append([(embed[x], weight) for x in range(embed.shape[0])])
+                if leftover != "":
+                    word = leftover
+                else:
+                    continue
+            tokens.append([(t, weight) for t in self.tokenizer(word)["input_ids"][self.tokens_start:-1]])
+
+    batched_tokens = []
+    batch = []
+    if self.start_token is not None:
+        batch.append((self.start_token, 1.0, 0))
+    batched_tokens.append(batch)
+    for i, t_group in enumerate(tokens):
+        is_large = len(t_group) >= self.max_word_length
+
+        while len(t_group) > 0:
+            if len(t_group) + len(batch) > self.max_length - 1:
+                remaining_length = self.max_length - len(batch) - 1
+                if is_large:
+                    batch.extend([(t, w, i + 1) for t, w in t_group[:remaining_length]])
+                    batch.append((self.end_token, 1.0, 0))
+                    t_group = t_group[remaining_length:]
+                else:
+                    batch.append((self.end_token, 1.0, 0))
+                    if self.pad_to_max_length:
+                        batch.extend([(pad_token, 1.0, 0)] * (remaining_length))
+                batch = []
+                if self.start_token is not None:
+                    batch.append((self.start_token, 1.0, 0))
+                batched_tokens.append(batch)
+            else:
+                batch.extend([(t, w, i + 1) for t, w in t_group])
+                t_group = []
+
+    batch.append((self.end_token, 1.0, 0))
+    if self.pad_to_max_length:
+        batch.extend([(pad_token, 1.0, 0)] * (self.max_length - len(batch)))
+
+    if not return_word_ids:
+        batched_tokens = [[(t, w) for t, w, _ in x] for x in batched_tokens]
+
+    return batched_tokens
+
+
+class TestSDTokenizer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        safetensors.torch.save_file({'clip_l': torch.ones((2, 768)), 'clip_g': torch.ones((2, 1280))},
+                                    os.path.join(cls.directory.name, 'negative.safetensors'))
+        cls.tokenizers = [sd1_clip.SDTokenizer(embedding_directory=cls.directory.name),
+                          sdxl_clip.SDXLClipGTokenizer(embedding_directory=cls.directory.name)]
+
+        cls.texts = ['', 'a cat', '(masterpiece:1.2), (best quality), ((cat)), \\(escaped\\)',
+                     'embedding:negative, (embedding:negative:1.3), embedding:missing lowres',
+                     'supercalifragilisticexpialidocious ' * 30, 'line\nbreak  double  space']
+        for positive, negative in list(styles.values())[:100]:
+            cls.texts += [positive.replace('{prompt}', 'a cat'), negative]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def assert_tokens_equal(self, tokens, reference):
+        self.assertEqual(len(tokens), len(reference))
+        for batch, reference_batch in zip(tokens, reference):
+            self.assertEqual(len(batch), len(reference_batch))
+            for token, reference_token in zip(batch, reference_batch):
+                if isinstance(reference_token[0], torch.Tensor):
+                    self.assertTrue(torch.equal(token[0], reference_token[0]))
+                    self.assertEqual(token[1:], reference_token[1:])
+                else:
+                    self.assertEqual(token, reference_token)
+
+    def test_parity(self):
+        for tokenizer in self.tokenizers:
+            for _ in range(2):
+                for text in self.texts:
+                    for return_word_ids in [False, True]:
+                        self.assert_tokens_equal(tokenizer.tokenize_with_weights(text, return_word_ids),
+                                                 tokenize_with_weights_reference(tokenizer, text, return_word_ids))
+
+    def test_cached_results_are_copies(self):
+        tokenizer = self.tokenizers[0]
+        tokens = tokenizer.tokenize_with_weights('a cat', return_word_ids=True)
+        tokens[0].append(tokens[0][0])
+        tokens += tokenizer.tokenize_with_weights('')
+        self.assertIn('a cat', tokenizer.text_cache)
+        self.assert_tokens_equal(tokenizer.tokenize_with_weights('a cat', return_word_ids=True),
+                                 tokenize_with_weights_reference(tokenizer, 'a cat', return_word_ids=True))
+
+    def test_texts_with_embeddings_are_not_cached(self):
+        tokenizer = self.tokenizers[0]
+        tokenizer.tokenize_with_weights('embedding:negative')
+        self.assertNotIn('embedding:negative', tokenizer.text_cache)
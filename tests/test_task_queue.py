@@ -0,0 +1,118 @@
+import copy
+import tempfile
+import threading
+import unittest
+
+from modules.task_queue import TaskQueue, TaskYields
+
+
+class DummyTask:
+    def __init__(self, name, image_number=1, priority=0, user=None, model=None):
+        self.name = name
+        self.model = model
+        self.args = [name, image_number]
+        self.image_number = image_number
+        self.priority = priority
+        self.user = user
+        self.processing = False
+        self.disable_preview = False
+
+
+class TestTaskQueue(unittest.TestCase):
+    def test_fifo_without_fair_share(self):
+        queue = TaskQueue()
+        tasks = [DummyTask(str(i), user=i % 2) for i in range(4)]
+        for task in tasks:
+            queue.put(task)
+
+        self.assertEqual([queue.get() for _ in tasks], tasks)
+        self.assertEqual(len(queue), 0)
+
+    def test_priority_first(self):
+        queue = TaskQueue()
+        low = DummyTask('low')
+        high = DummyTask('high', priority=1)
+        queue.put(low)
+        queue.put(high)
+
+        self.assertEqual(queue.position(high), 1)
+        self.assertEqual(queue.position(low), 2)
+        self.assertIs(queue.get(), high)
+        self.assertTrue(high.processing)
+
+    def test_fair_share_does_not_starve_users(self):
+        queue = TaskQueue(fair_share=True)
+        big = [DummyTask(f'a{i}', image_number=32, user='a') for i in range(3)]
+        small = [DummyTask(f'b{i}', image_number=1, user='b') for i in range(3)]
+        for task in big + small:
+            queue.put(task)
+
+        order = [task.name for task in queue]
+        self.assertEqual(order, ['a0', 'b0', 'b1', 'b2', 'a1', 'a2'])
+        self.assertEqual([queue.get().name for _ in order], order)
+
+    def test_cancel(self):
+        queue = TaskQueue()
+        first, second = DummyTask('first'), DummyTask('second')
+        queue.put(first)
+        queue.put(second)
+
+        self.assertTrue(queue.cancel(first))
+        self.assertFalse(queue.cancel(first))
+        self.assertNotIn(first, queue)
+        self.assertEqual(queue.position(second), 1)
+
+    def test_get_wakes_up_on_put(self):
+        queue = TaskQueue()
+        task = DummyTask('task')
+        threading.Timer(0.05, queue.put, args=[task]).start()
+
+        self.assertIs(queue.get(timeout=5), task)
+        self.assertIsNone(queue.get(timeout=0.01))
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as path:
+            queue = TaskQueue(persist_path=path)
+            queue.put(DummyTask('first', priority=2, user='u'))
+            queue.put(DummyTask('second'))
+            queue.get()
+
+            restored_queue = TaskQueue(persist_path=path)
+            self.assertEqual(restored_queue.restore(lambda args: DummyTask(*args)), 1)
+            task = restored_queue.get()
+            self.assertEqual(task.name, 'second')
+            self.assertTrue(task.disable_preview)
+
+            self.assertEqual(TaskQueue(persist_path=path).restore(lambda args: DummyTask(*args)), 0)
+
+    def test_model_affinity(self):
+        queue = TaskQueue(affinity_key=lambda task: task.model)
+        tasks = [DummyTask(f'{model}{i}', model=model) for i, model in enumerate('abab')]
+        for task in tasks:
+            queue.put(task)
+
+        order = [queue.get().name for _ in tasks]
+        self.assertEqual(order, ['a0', 'a2', 'b1', 'b3'])
+        self.assertEqual(queue.stats(average_swap_time=2.0),
+                         {'model_swaps': 1, 'model_swaps_avoided': 1, 'time_saved': 2.0})
+
+    def test_model_affinity_max_wait(self):
+        queue = TaskQueue(affinity_key=lambda task: task.model, affinity_max_wait=0.0)
+        tasks = [DummyTask(f'{model}{i}', model=model) for i, model in enumerate('abab')]
+        for task in tasks:
+            queue.put(task)
+
+        self.assertEqual([queue.get().name for _ in tasks], ['a0', 'b1', 'a2', 'b3'])
+
+
+class TestTaskYields(unittest.TestCase):
+    def test_wait_and_copy(self):
+        yields = TaskYields()
+        self.assertFalse(yields.wait(timeout=0.01))
+
+        threading.Timer(0.05, yields.append, args=[['preview', None]]).start()
+        self.assertTrue(yields.wait(timeout=5))
+
+        copied = copy.deepcopy(yields)
+        self.assertIsInstance(copied, TaskYields)
+        self.assertEqual(copied, [['preview', None]])
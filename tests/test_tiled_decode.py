@@ -0,0 +1,96 @@
+import unittest
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+
+import ldm_patched.modules.model_management as model_management
+import ldm_patched.modules.sd as sd
+import ldm_patched.modules.utils as utils
+
+
+def decode_pointwise(a):
+    return F.interpolate(torch.tanh(a[:, :3] + a[:, 3:4]), scale_factor=8, mode='nearest')
+
+
+def decode_with_context(a):
+    # like a VAE decoder, output pixels depend on neighbouring latents
+    a = F.avg_pool2d(a, kernel_size=3, stride=1, padding=1, count_include_pad=False)
+    return decode_pointwise(a)
+
+
+def decode_tiled_three_passes(samples, function, tile_x, tile_y, overlap):
+    # tiled decode as done before the single pass engine
+    return (utils.tiled_scale(samples, function, tile_x // 2, tile_y * 2, overlap, upscale_amount=8) +
+            utils.tiled_scale(samples, function, tile_x * 2, tile_y // 2, overlap, upscale_amount=8) +
+            utils.tiled_scale(samples, function, tile_x, tile_y, overlap, upscale_amount=8)) / 3.0
+
+
+def get_vae(decode):
+    vae = sd.VAE.__new__(sd.VAE)
+    vae.first_stage_model = SimpleNamespace(decode=decode)
+    vae.memory_used_decode = lambda shape, dtype: 1
+    vae.vae_dtype = torch.float32
+    vae.device = torch.device('cpu')
+    vae.output_device = torch.device('cpu')
+    vae.downscale_ratio = 8
+    vae.latent_channels = 4
+    return vae
+
+
+class TestTiledDecode(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        # smooth latents with a size that leaves partial tiles at the borders
+        latent = torch.randn((2, 4, 19, 25), generator=generator)
+        self.samples = F.interpolate(latent, size=(76, 100), mode='bilinear', align_corners=False)
+
+    def test_blend_mask_matches_per_pixel_loop(self):
+        feather = 24
+        mask = torch.ones((1, 3, 64, 80))
+        for t in range(feather):
+            mask[:, :, t:1 + t, :] *= ((1.0 / feather) * (t + 1))
+            mask[:, :, mask.shape[2] - 1 - t: mask.shape[2] - t, :] *= ((1.0 / feather) * (t + 1))
+            mask[:, :, :, t:1 + t] *= ((1.0 / feather) * (t + 1))
+            mask[:, :, :, mask.shape[3] - 1 - t: mask.shape[3] - t] *= ((1.0 / feather) * (t + 1))
+
+        self.assertTrue(torch.allclose(utils.get_tile_blend_mask(64, 80, feather).expand_as(mask), mask, atol=1e-6))
+
+    def test_single_pass_is_exact_for_pointwise_decoder(self):
+        reference = decode_pointwise(self.samples)
+        output = utils.tiled_scale_batched(self.samples, decode_pointwise, 32, 32, 8, upscale_amount=8, max_batch_size=3)
+        self.assertTrue(torch.allclose(output, reference, atol=1e-5))
+
+    def test_parity_with_one_tile_at_a_time(self):
+        reference = utils.tiled_scale(self.samples, decode_with_context, 32, 32, 8, upscale_amount=8)
+        for max_batch_size in [1, 3, 8]:
+            output = utils.tiled_scale_batched(self.samples, decode_with_context, 32, 32, 8, upscale_amount=8,
+                                               max_batch_size=max_batch_size)
+            self.assertTrue(torch.equal(output, reference))
+
+    def test_quality_parity_with_three_passes(self):
+        # a single pass with feathered seams stays as close to the untiled decode as the three pass average
+        reference = (decode_with_context(self.samples) + 1.0) / 2.0
+        single_pass = get_vae(decode_with_context).decode_tiled_(self.samples, 32, 32, 8)
+        three_passes = (decode_tiled_three_passes(self.samples, decode_with_context, 32, 32, 8) + 1.0) / 2.0
+
+        single_pass_error = (single_pass - reference).abs()
+        three_passes_error = (three_passes - reference).abs()
+        self.assertLess(single_pass_error.mean(), 1e-2)
+        self.assertLess(single_pass_error.max(), 0.1)
+        self.assertLess(single_pass_error.mean(), three_passes_error.mean() * 2.0 + 1e-4)
+
+    def test_out_of_memory_falls_back_to_one_tile_at_a_time(self):
+        batch_sizes = []
+
+        def decode(a):
+            batch_sizes.append(a.shape[0])
+            if a.shape[0] > 1:
+                raise model_management.OOM_EXCEPTION('out of memory')
+            return decode_with_context(a) * 2.0 - 1.0
+
+        output = get_vae(decode).decode_tiled_(self.samples, 32, 32, 8)
+        reference = utils.tiled_scale(self.samples, decode_with_context, 32, 32, 8, upscale_amount=8)
+        self.assertGreater(batch_sizes[0], 1)
+        self.assertEqual(set(batch_sizes[1:]), {1})
+        self.assertTrue(torch.allclose(output, reference.clamp(0.0, 1.0), atol=1e-6))
@@ -1,6 +1,7 @@
 import os
 import unittest
 
+import modules.config
 import modules.flags
 from modules import util
 
@@ -135,3 +136,26 @@ class TestUtils(unittest.TestCase):
             expected = test["output"]
             actual = util.parse_lora_references_from_prompt(prompt, loras, loras_limit=loras_limit, lora_filenames=lora_filenames)
             self.assertEqual(expected, actual)
+
+    def test_apply_wildcards_uses_cached_index(self):
+        import random
+        import tempfile
+        from unittest import mock
+
+        with tempfile.TemporaryDirectory() as path:
+            os.makedirs(os.path.join(path, 'sub'))
+            with open(os.path.join(path, 'sub', 'color.txt'), 'w', encoding='utf-8') as fp:
+                fp.write('red\n\nblue\n')
+            with open(os.path.join(path, 'animal.txt'), 'w', encoding='utf-8') as fp:
+                fp.write('__color__ cat\n')
+
+            filenames = [os.path.join('sub', 'color.txt'), 'animal.txt']
+            with mock.patch.object(modules.config, 'path_wildcards', path), \
+                    mock.patch.object(modules.config, 'wildcard_filenames', filenames):
+                rng = random.Random(0)
+                self.assertEqual(util.apply_wildcards('a __animal__', rng, 1, True), 'a blue cat')
+                self.assertEqual(util.apply_wildcards('__missing__ dog', rng, 0, True), 'missing dog')
+
+                with open(os.path.join(path, 'sub', 'color.txt'), 'w', encoding='utf-8') as fp:
+                    fp.write('green\n')
+                self.assertEqual(util.apply_wildcards('__color__', rng, 0, True), 'green')
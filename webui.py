@@ -20,7 +20,7 @@ import launch
 from extras.inpaint_mask import SAMOptions
 
 from modules.sdxl_styles import legal_style_names
-from modules.private_logger import get_current_html_path
+from modules.private_logger import get_current_html_path, wait_for_images
 from modules.ui_gradio_extensions import reload_javascript
 from modules.auth import auth_enabled, check_auth
 from modules.util import is_json
@@ -31,7 +31,7 @@ def get_task(*args):
 
     return worker.AsyncTask(args=args)
 
-def generate_clicked(task: worker.AsyncTask):
+def generate_clicked(task: worker.AsyncTask, request: gr.Request = None):
     import ldm_patched.modules.model_management as model_management
 
     with model_management.interrupt_processing_mutex:
@@ -54,10 +54,30 @@ def generate_clicked(task: worker.AsyncTask):
             gr.update(), \
             gr.update()
 
-        worker.async_tasks.append(task)
+        if args_manager.args.multi_user and request is not None:
+            task.user = request.username or request.session_hash
+
+        worker.async_tasks.put(task)
+        queue_position = None
 
         while not finished:
-            time.sleep(0.01)
+            if not task.yields.wait(timeout=1.0):
+                position = worker.async_tasks.position(task)
+                if position is not None:
+                    if position != queue_position:
+                        queue_position = position
+                        yield gr.update(visible=True, value=modules.html.make_progress_html(1, f'Waiting in queue, position {position} ...')), \
+                            gr.update(), \
+                            gr.update(), \
+                            gr.update(visible=False), \
+                            gr.update(), \
+                            gr.update()
+                elif not task.processing:
+                    # Safety break if task is no longer processing and not in queue
+                    finished = True
+                    yield gr.update(visible=False), gr.update(visible=False), gr.update(visible=False), gr.update(visible=True), gr.update(visible=False), gr.update()
+                continue
+
             if len(task.yields) > 0:
                 flag, product = task.yields.pop(0)
                 if flag == 'preview':
@@ -75,6 +95,7 @@ def generate_clicked(task: worker.AsyncTask):
                         gr.update(), \
                         gr.update()
                 if flag == 'results':
+                    wait_for_images(product)
                     yield gr.update(visible=True), \
                         gr.update(visible=True), \
                         gr.update(visible=True, value=product), \
@@ -82,6 +103,7 @@ def generate_clicked(task: worker.AsyncTask):
                         gr.update(), \
                         gr.update()
                 if flag == 'finish':
+                    wait_for_images(product)
                     if not args_manager.args.disable_enhance_output_sorting:
                         product = sort_enhance_images(product, task)
                     
@@ -109,10 +131,6 @@ def generate_clicked(task: worker.AsyncTask):
                         for filepath in product:
                             if isinstance(filepath, str) and os.path.exists(filepath):
                                 os.remove(filepath)
-            elif not task.processing and len(worker.async_tasks) == 0 and not any(t == task for t in worker.async_tasks):
-                # Safety break if task is no longer processing and not in queue
-                finished = True
-                yield gr.update(visible=False), gr.update(visible=False), gr.update(visible=False), gr.update(visible=True), gr.update(visible=False), gr.update()
     except Exception as e:
         print(f'Error in generation: {str(e)}')
         import traceback
@@ -252,7 +270,9 @@ with shared.gradio_root:
                     def stop_clicked(currentTask):
                         import ldm_patched.modules.model_management as model_management
                         currentTask.last_stop = 'stop'
-                        if (currentTask.processing):
+                        if worker.async_tasks.cancel(currentTask):
+                            currentTask.yields.append(['finish', currentTask.results])
+                        elif (currentTask.processing):
                             model_management.interrupt_current_processing()
                         return currentTask
 
@@ -1402,6 +1422,10 @@ def setup_custom_routes(app):
             return FileResponse(abs_path)
         raise HTTPException(status_code=404, detail="Image not found")
 
+    if args_manager.args.enable_api:
+        from modules.api import setup_api_routes
+        setup_api_routes(app)
+
 # Use Blocks.launch with a custom app setup
 from fastapi import FastAPI
 from gradio.routes import App